@@ -0,0 +1,206 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from bot_scheduler import PRIORITY_ADMIN, send_priority
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+class AdminNotifier:
+    """
+    Queue of notifications for the developer chat: new users and verified feedback.
+
+    Events are stored in sqlite right away and sent by `flush` in batches: consecutive new users are
+    coalesced into a single digest message, feedback goes as one header listing the senders followed by
+    the forwards in the order they were submitted. Sent items are deleted one message at a time,
+    so pending items survive restarts and a crash resends at most one message.
+
+    When `max_pending` items are waiting, new users are only counted and feedback is rejected,
+    so the caller can ask the user to try later.
+    """
+
+    KIND_NEW_USER = 'new_user'
+    KIND_FEEDBACK = 'feedback'
+
+    def __init__(self, bot, chat_id, db_fp=':memory:', max_pending=10_000, messages_per_minute=20,
+                 max_feedback_per_header=10):
+        """
+        :param messages_per_minute: budget of messages to the developer chat
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.db_fp = db_fp
+        self.max_pending = max_pending
+        self.max_feedback_per_header = max_feedback_per_header
+        self.limiter = TokenBucket(messages_per_minute / 60, capacity=messages_per_minute)
+
+        self._conn = sqlite3.connect(db_fp, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS admin_notifications ('
+                               'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, created_at REAL NOT NULL, '
+                               'payload TEXT NOT NULL)')
+            self._n_pending = self._conn.execute('SELECT COUNT(*) FROM admin_notifications').fetchone()[0]
+
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+        self.n_dropped_new_users = 0
+        self.n_rejected_feedback = 0
+        self.n_sent_messages = 0
+        self.n_sent_items = 0
+        self.last_flush_duration = 0.0
+        self.last_flush_max_delay = 0.0
+
+    @property
+    def depth(self):
+        return self._n_pending
+
+    def _push(self, kind, payload):
+        with self._lock:
+            if self._n_pending >= self.max_pending:
+                return False
+            self._conn.execute('INSERT INTO admin_notifications (kind, created_at, payload) VALUES (?, ?, ?)',
+                               (kind, time.time(), json.dumps(payload, ensure_ascii=False)))
+            self._n_pending += 1
+        return True
+
+    def notify_new_user(self, user_info):
+        if not self._push(self.KIND_NEW_USER, {'user_info': user_info}):
+            self.n_dropped_new_users += 1
+
+    def notify_feedback(self, user_info, from_chat_id, message_id):
+        """
+        :return: False if the queue is full and the feedback was not accepted
+        """
+        accepted = self._push(self.KIND_FEEDBACK, {'user_info': user_info, 'from_chat_id': from_chat_id,
+                                                   'message_id': message_id})
+        if not accepted:
+            self.n_rejected_feedback += 1
+        return accepted
+
+    def stats(self):
+        return {'depth': self._n_pending, 'sent_messages': self.n_sent_messages, 'sent_items': self.n_sent_items,
+                'dropped_new_users': self.n_dropped_new_users, 'rejected_feedback': self.n_rejected_feedback,
+                'last_flush_duration': round(self.last_flush_duration, 3),
+                'last_flush_max_delay': round(self.last_flush_max_delay, 1)}
+
+    # -------------- flushing --------------
+
+    def start_flush(self, context=None):
+        """
+        Flush pending items in a background thread, so the JobQueue is not blocked by rate limits.
+        Can be used as a JobQueue callback
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.flush, name='AdminNotifier', daemon=True)
+        self._thread.start()
+
+    def _pending_items(self, limit=1000):
+        with self._lock:
+            rows = self._conn.execute('SELECT id, kind, created_at, payload FROM admin_notifications '
+                                      'ORDER BY id LIMIT ?', (limit,)).fetchall()
+        return [(item_id, kind, created_at, json.loads(payload)) for item_id, kind, created_at, payload in rows]
+
+    def _delete(self, item_ids):
+        with self._lock:
+            self._conn.executemany('DELETE FROM admin_notifications WHERE id = ?', ((x,) for x in item_ids))
+            self._n_pending -= len(item_ids)
+        self.n_sent_items += len(item_ids)
+
+    def _send(self, method, *args, **kwargs):
+        self.limiter.acquire()
+        with send_priority(PRIORITY_ADMIN):
+            method(*args, **kwargs)
+        self.n_sent_messages += 1
+
+    def flush(self, context=None):
+        """
+        Send all pending items
+        :return: number of sent items
+        """
+        with self._flush_lock:
+            start = time.perf_counter()
+            n_sent_items = self.n_sent_items
+            max_delay = 0.0
+            try:
+                while True:
+                    items = self._pending_items()
+                    if not items:
+                        break
+                    max_delay = max(max_delay, time.time() - items[0][2])
+                    ix = 0
+                    while ix < len(items):
+                        kind = items[ix][1]
+                        end = ix
+                        while end < len(items) and items[end][1] == kind:
+                            end += 1
+                        if kind == self.KIND_FEEDBACK:
+                            end = min(end, ix + self.max_feedback_per_header)
+                            self._send_feedback(items[ix:end])
+                        else:
+                            end = ix + self._send_new_users(items[ix:end])
+                        ix = end
+                if self.n_dropped_new_users:
+                    self._send(self.bot.send_message, self.chat_id,
+                               f'#new_user\n\n{self.n_dropped_new_users} more new users were not listed: '
+                               f'the queue was full')
+                    self.n_dropped_new_users = 0
+            except RetryAfter as e:
+                logger.warning(f'AdminNotifier. flood control exceeded. pausing for {e.retry_after} s')
+                self.limiter.pause(e.retry_after)
+            except TelegramError as e:
+                logger.error(f'AdminNotifier. flush failed: {e}')
+            finally:
+                self.last_flush_duration = time.perf_counter() - start
+                self.last_flush_max_delay = max_delay
+            n_sent = self.n_sent_items - n_sent_items
+            if n_sent:
+                logger.info(f'AdminNotifier. flushed {n_sent} items. {self.stats()}')
+            return n_sent
+
+    def _send_new_users(self, items):
+        """
+        Send as many new users as fit into a single message
+        :return: number of sent items
+        """
+        lines = []
+        length = 0
+        for _, _, _, payload in items:
+            if lines and length + len(payload['user_info']) > MAX_MESSAGE_LENGTH - 100:
+                break
+            lines.append(payload['user_info'])
+            length += len(payload['user_info']) + 2
+        n_items = len(lines)
+        text = f'#new_user ({n_items})\n\n' + '\n\n'.join(lines)
+        self._send(self.bot.send_message, self.chat_id, text[:MAX_MESSAGE_LENGTH])
+        self._delete([item_id for item_id, _, _, _ in items[:n_items]])
+        return n_items
+
+    def _send_feedback(self, items):
+        users = '\n\n'.join(f'{n}.\n{payload["user_info"]}' for n, (_, _, _, payload) in enumerate(items, start=1))
+        text = f'#feedback ({len(items)})\n\nusers:\n{users}'
+        self._send(self.bot.send_message, self.chat_id, text[:MAX_MESSAGE_LENGTH])
+        for item_id, _, _, payload in items:
+            try:
+                self._send(self.bot.forward_message, chat_id=self.chat_id, from_chat_id=payload['from_chat_id'],
+                           message_id=payload['message_id'])
+            except BadRequest as e:
+                # the message was deleted by the user
+                logger.error(f'AdminNotifier. failed to forward feedback: {e}')
+            self._delete([item_id])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
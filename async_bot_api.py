@@ -0,0 +1,119 @@
+import json
+import logging
+
+from telegram.error import (BadRequest, ChatMigrated, Conflict, InvalidToken, NetworkError, RetryAfter, TimedOut,
+                            Unauthorized)
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+from tornado.simple_httpclient import HTTPTimeoutError
+
+from bot_scheduler import LIMITED_METHODS, PRIORITY_INTERACTIVE, call_cost
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+def parse_bot_api_response(status, payload):
+    """
+    :return: `result` of the response
+    :raises TelegramError: the same errors as `telegram.Bot` raises for the response
+    """
+    try:
+        data = json.loads(payload.decode('utf-8'))
+    except ValueError:
+        raise NetworkError(f'invalid server response ({status})')
+    if 200 <= status < 300 and data.get('ok'):
+        return data.get('result')
+    parameters = data.get('parameters') or {}
+    if 'migrate_to_chat_id' in parameters:
+        raise ChatMigrated(parameters['migrate_to_chat_id'])
+    if 'retry_after' in parameters:
+        raise RetryAfter(parameters['retry_after'])
+    message = data.get('description') or 'Unknown HTTPError'
+    if status in (401, 403):
+        raise Unauthorized(message)
+    if status == 400:
+        raise BadRequest(message)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(message)
+    if status == 502:
+        raise NetworkError('Bad Gateway')
+    raise NetworkError(f'{message} ({status})')
+
+
+class AsyncBotApi:
+    """
+    Bot API client of the asyncio mode: JSON requests with a `tornado.httpclient.AsyncHTTPClient`
+    of the event loop. At most `max_connections` requests are sent at once, the others wait in its queue.
+    The client is of the implementation configured with `AsyncHTTPClient.configure`:
+    `tornado.curl_httpclient.CurlAsyncHTTPClient` keeps connections to the Bot API alive between calls.
+
+    Calls of `LIMITED_METHODS` wait for their turn in the `BotScheduler` of the bot, so flood limits
+    are shared with the threaded parts of the bot, and are retried on `RetryAfter` the same way.
+    Latencies are recorded into `bot_api` histograms as for `telegram.Bot`
+    """
+
+    def __init__(self, bot_url, scheduler=None, max_connections=100, timeout=10, connect_timeout=10,
+                 registry=REGISTRY):
+        """
+        Must be created in the event loop the calls are made in
+        :param bot_url: Bot API url with the token, e.g. `telegram.Bot.base_url`
+        :param timeout: seconds to wait for a response
+        """
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=max_connections)
+        self.bot_url = bot_url.rstrip('/')
+        self.max_connections = max_connections
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.registry = registry
+        self._posts = {}
+        self.n_requests = 0
+        self.n_in_flight = 0
+
+    async def call(self, method, params=None, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """
+        :param params: parameters of the method. objects like `InlineKeyboardMarkup` are passed as dicts
+        :return: `result` of the response
+        """
+        params = params or {}
+        post = self._posts.get(method)
+        if post is None:
+            post = self._posts[method] = self.registry.histogram('bot_api', method).wrap_async(self._post)
+        if self.scheduler is None or method not in LIMITED_METHODS:
+            return await post(method, params, timeout)
+        chat_id = params.get('chat_id')
+        cost = call_cost(method, params.get('media'))
+        for attempt in range(self.scheduler.max_retries + 1):
+            await self.scheduler.admit_async(chat_id, priority, cost)
+            try:
+                return await post(method, params, timeout)
+            except RetryAfter as e:
+                if attempt == self.scheduler.max_retries:
+                    raise
+                self.scheduler.on_retry_after(chat_id, e.retry_after)
+
+    async def _post(self, method, params, timeout):
+        request = HTTPRequest(f'{self.bot_url}/{method}', method='POST',
+                              body=json.dumps(params, ensure_ascii=False).encode('utf-8'),
+                              headers={'Content-Type': 'application/json'},
+                              connect_timeout=self.connect_timeout, request_timeout=timeout or self.timeout)
+        self.n_requests += 1
+        self.n_in_flight += 1
+        try:
+            # error responses of the Bot API are parsed as the others
+            response = await self.client.fetch(request, raise_error=False)
+        except HTTPTimeoutError:
+            raise TimedOut()
+        except (OSError, HTTPClientError) as e:
+            raise NetworkError(f'{type(e).__name__}: {e}')
+        finally:
+            self.n_in_flight -= 1
+        return parse_bot_api_response(response.code, response.body or b'')
+
+    def close(self):
+        self.client.close()
+
+    def stats(self):
+        return {'max_connections': self.max_connections, 'in_flight': self.n_in_flight, 'requests': self.n_requests}
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import TelegramError
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+from async_bot_api import AsyncBotApi
+from webhook_router import update_chat_key
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLanes:
+    """
+    Per-chat FIFO lanes of updates: updates of a chat are handled one at a time in arrival order,
+    updates of different chats concurrently. A lane is a deque with a single task draining it,
+    the task ends when the lane is empty, so idle chats cost nothing.
+
+    At most `max_in_flight` updates are queued or handled at once: `submit` waits for a free slot,
+    which holds back `getUpdates` and webhook responses instead of buffering without bound
+    """
+
+    def __init__(self, handle, max_in_flight=10_000):
+        """
+        :param handle: coroutine function called with the update dict
+        """
+        self.handle = handle
+        self.max_in_flight = max_in_flight
+        # chat key -> updates of the chat. the first one is being handled
+        self._lanes = {}
+        self._tasks = set()
+        # created in the event loop by the first update
+        self._slots = None
+        self.n_in_flight = 0
+        self.peak_in_flight = 0
+        self.n_handled = 0
+        self.n_failed = 0
+
+    def __len__(self):
+        return self.n_in_flight
+
+    async def submit(self, update):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+        await self._slots.acquire()
+        self.n_in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.n_in_flight)
+        key = update_chat_key(update)
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append(update)
+            return
+        self._lanes[key] = deque([update])
+        task = asyncio.ensure_future(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        lane = self._lanes[key]
+        while lane:
+            try:
+                await self.handle(lane[0])
+                self.n_handled += 1
+            except Exception as e:
+                self.n_failed += 1
+                logger.exception(f'ChatLanes. failed to handle an update of chat {key}: {e}')
+            finally:
+                lane.popleft()
+                self.n_in_flight -= 1
+                self._slots.release()
+        # nothing is awaited between the check of the lane and its removal: `submit` can't append in between
+        del self._lanes[key]
+
+    async def join(self, timeout=None):
+        """
+        Wait for the queued updates to be handled
+        :return: True if all of them were handled in time
+        """
+        tasks = list(self._tasks)
+        if not tasks:
+            return True
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        return not pending
+
+    def stats(self):
+        return {'in_flight': self.n_in_flight, 'peak_in_flight': self.peak_in_flight, 'chats': len(self._lanes),
+                'handled': self.n_handled, 'failed': self.n_failed}
+
+
+class WebhookHandler(RequestHandler):
+    """
+    Takes updates posted to the webhook of `AsyncDispatcher`
+    """
+
+    def initialize(self, receive):
+        """
+        :param receive: coroutine function called with the update dict
+        """
+        self.receive = receive
+
+    async def post(self):
+        try:
+            update = json.loads(self.request.body.decode('utf-8'))
+        except ValueError as e:
+            logger.error(f'AsyncDispatcher. failed to parse an update: {e}')
+            self.set_status(400)
+            return
+        # acknowledged once queued: a full `ChatLanes` holds the sender back
+        await self.receive(update)
+
+
+class AsyncDispatcher:
+    """
+    asyncio execution mode: receives updates with long polling or a webhook server and handles them
+    in `ChatLanes` in an event loop running in its own thread.
+
+    Every update goes to `handle(api, update)` first, a coroutine function answering it with `AsyncBotApi`.
+    Updates it returns False for are passed to `fallback(update)` in a small thread pool, e.g. to
+    the `telegram.ext.Dispatcher` of the bot. The lane of the chat waits for the fallback as well,
+    so the updates of a chat stay in order whichever path handles them.
+
+    While an update waits for the Bot API, the event loop handles other chats: in-flight updates are limited
+    by `max_in_flight` and the connections of the pool, not by threads
+    """
+
+    def __init__(self, bot_url, handle, fallback, scheduler=None, max_in_flight=10_000, max_connections=100,
+                 n_fallback_threads=8, poll_timeout=10, poll_retry_interval=1.0, max_update_size=2 ** 20,
+                 max_header_size=64 * 2 ** 10):
+        """
+        :param bot_url: Bot API url with the token, e.g. `telegram.Bot.base_url`
+        :param scheduler: `BotScheduler` shared with the threaded parts of the bot
+        :param poll_timeout: seconds of `getUpdates` long polling
+        :param max_update_size: bytes of the body of a webhook request. larger requests are rejected
+        :param max_header_size: bytes of the headers of a webhook request
+        """
+        self.bot_url = bot_url
+        self.handle = handle
+        self.fallback = fallback
+        self.scheduler = scheduler
+        self.max_in_flight = max_in_flight
+        self.max_connections = max_connections
+        self.poll_timeout = poll_timeout
+        self.poll_retry_interval = poll_retry_interval
+        self.max_update_size = max_update_size
+        self.max_header_size = max_header_size
+        self.executor = ThreadPoolExecutor(n_fallback_threads, thread_name_prefix='AsyncDispatcher.fallback')
+
+        self.api = None
+        self.lanes = ChatLanes(self._dispatch, max_in_flight)
+        self.n_fallback = 0
+        self.n_received = 0
+        self._loop = None
+        self._stopped = None
+        self._stop_timeout = None
+        self._started = threading.Event()
+        self._thread = None
+        self._server = None
+
+    # -------------- lifecycle --------------
+
+    def start_polling(self):
+        return self._start(self._poll_loop())
+
+    def start_webhook(self, listen, port, url_path):
+        """
+        Serve updates posted by Telegram or by `webhook_router.WebhookRouter` to `http://listen:port/url_path`
+        """
+        return self._start(self._serve_webhook(listen, port, '/' + url_path.lstrip('/')))
+
+    def _start(self, receiver):
+        self._thread = threading.Thread(target=asyncio.run, args=(self._main(receiver),), name='AsyncDispatcher',
+                                        daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self, timeout=10):
+        """
+        Stop receiving updates and wait up to `timeout` seconds for the received ones to be handled
+        """
+        if self._thread is None:
+            return
+        self._stop_timeout = timeout
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        self._thread.join()
+        self._thread = None
+        self.executor.shutdown()
+
+    async def _main(self, receiver):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self.api = AsyncBotApi(self.bot_url, self.scheduler, self.max_connections)
+        receiving = asyncio.ensure_future(receiver)
+        receiving.add_done_callback(self._on_receiving_done)
+        self._started.set()
+        await self._stopped.wait()
+        receiving.cancel()
+        await asyncio.gather(receiving, return_exceptions=True)
+        if self._server is not None:
+            self._server.stop()
+            try:
+                # keep-alive connections of the sender wait for the next request
+                await asyncio.wait_for(self._server.close_all_connections(), 1)
+            except asyncio.TimeoutError:
+                pass
+        if not await self.lanes.join(self._stop_timeout):
+            logger.warning(f'AsyncDispatcher. stopped with {len(self.lanes)} updates not handled')
+        self.api.close()
+
+    @staticmethod
+    def _on_receiving_done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'AsyncDispatcher. stopped receiving updates: {task.exception()}')
+
+    def stats(self):
+        return {**self.lanes.stats(), 'received': self.n_received, 'fallback': self.n_fallback,
+                'bot_api': self.api.stats() if self.api is not None else None}
+
+    # -------------- handling --------------
+
+    async def _dispatch(self, update):
+        if await self.handle(self.api, update):
+            return
+        self.n_fallback += 1
+        await self._loop.run_in_executor(self.executor, self.fallback, update)
+
+    async def _receive(self, update):
+        self.n_received += 1
+        await self.lanes.submit(update)
+
+    # -------------- update sources --------------
+
+    async def _poll_loop(self):
+        offset = 0
+        logger.info('AsyncDispatcher. polling for updates')
+        while True:
+            try:
+                updates = await self.api.call('getUpdates', {'offset': offset, 'timeout': self.poll_timeout},
+                                              timeout=self.poll_timeout + 5)
+            except TelegramError as e:
+                logger.error(f'AsyncDispatcher. getUpdates failed: {e}. retrying in {self.poll_retry_interval} s')
+                await asyncio.sleep(self.poll_retry_interval)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                await self._receive(update)
+
+    @staticmethod
+    def _log_webhook_request(handler):
+        # accepted updates are not logged one by one: handlers log them
+        if handler.get_status() >= 400:
+            logger.warning(f'AsyncDispatcher. webhook request {handler.request.method} {handler.request.path} '
+                           f'answered {handler.get_status()}')
+
+    async def _serve_webhook(self, listen, port, url_path):
+        app = Application([(re.escape(url_path), WebhookHandler, {'receive': self._receive})],
+                          log_function=self._log_webhook_request)
+        self._server = HTTPServer(app, max_body_size=self.max_update_size, max_header_size=self.max_header_size)
+        self._server.listen(port, listen)
+        logger.info(f'AsyncDispatcher. receiving updates at http://{listen}:{port}{url_path}')
+        # served by the event loop until cancelled
+        await asyncio.get_running_loop().create_future()
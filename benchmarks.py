@@ -0,0 +1,1550 @@
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import os
+import json
+import multiprocessing
+import random
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import requests
+import telegram
+from telegram.ext import CallbackContext, JobQueue
+from telegram.utils.request import Request
+
+import load_test
+import log_config
+import page_ingest
+import utils
+from async_dispatch import AsyncDispatcher
+from bot_scheduler import PRIORITY_ADMIN, PRIORITY_BULK, PRIORITY_NAMES, BotScheduler, call_cost, send_priority
+from broadcast import Broadcaster, SubscriberRegistry
+from conversation_store import ConversationStore
+from conversation_timeouts import ConversationTimeouts, TimerWheel
+from engagement import ACCEPTED, SHOWN, SKIPPED, AliasTable, EngagementCounters, EngagementSampler
+from error_reporter import ErrorReporter
+from fake_bot_api import FakeBotApiServer
+from inline_results import InlineResultCache
+from lieksika_bot import log_method_name_and_chat_id_from_update
+from metrics import COUNT, MetricsRegistry
+from photo_catalog import PhotoCatalog
+from review_scheduler import ReviewScheduler
+from state_journal import StateJournal
+from user_state import SharedReviewScheduler, SharedWordSampler, UserStateDb
+from webhook_router import HashRing
+from word_catalog import WordIndex, read_catalog, write_catalog
+from word_sampler import WordSampler
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def percentiles(latencies, ps=(50, 99)):
+    latencies = sorted(latencies)
+    return {p: latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in ps}
+
+
+def benchmark_word_sampler(n_users=1_000_000, n_words=300, n_draws=200_000):
+    logger.info(f'benchmark_word_sampler. users: {n_users}, words: {n_words}, draws: {n_draws}')
+    sampler = WordSampler(n_words, seed=0)
+
+    start = time.perf_counter()
+    for chat_id in range(1, n_users + 1):
+        sampler.draw(chat_id)
+    elapsed = time.perf_counter() - start
+    logger.info(f'first draw for {n_users} users: {elapsed:.2f} s, {elapsed / n_users * 1e6:.2f} us/draw')
+
+    chat_ids = [random.randint(1, n_users) for _ in range(n_draws)]
+    latencies = []
+    for chat_id in chat_ids:
+        t0 = time.perf_counter()
+        sampler.draw(chat_id)
+        latencies.append(time.perf_counter() - t0)
+    p = percentiles(latencies)
+    logger.info(f'repeated draws: p50: {p[50] * 1e6:.2f} us, p99: {p[99] * 1e6:.2f} us')
+    logger.info(f'state size: {sampler.nbytes() / 2 ** 20:.1f} MB, '
+                f'{sampler.nbytes() / len(sampler):.1f} bytes/user')
+
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        fp = os.path.join(tmp_dp, 'sampler_state.bin')
+        t0 = time.perf_counter()
+        sampler.save(fp)
+        t1 = time.perf_counter()
+        WordSampler.load(fp, n_words)
+        t2 = time.perf_counter()
+    logger.info(f'save: {t1 - t0:.3f} s, load: {t2 - t1:.3f} s')
+
+    # sanity check: no repeats within a permutation
+    seen = {sampler.draw(-1) for _ in range(n_words)}
+    assert len(seen) == n_words, 'sampler repeated a word within a permutation'
+    check_word_sampler_growth(n_words)
+    check_shared_word_sampler(n_words)
+
+
+def check_word_sampler_growth(n_words=300):
+    """
+    A growing catalog doesn't restart permutations: the current epoch of a chat goes on over the old words,
+    the new words join the next one. State files of version 1 are loaded the same way
+    """
+    def finish_epoch(sampler, chat_id, n_drawn, n_words):
+        drawn = [sampler.draw(chat_id) for _ in range(n_drawn)]
+        assert len(set(drawn)) == n_drawn and max(drawn) < n_words, 'permutation restarted on growth'
+        return drawn
+
+    sampler = WordSampler(n_words, seed=0)
+    first_half = [sampler.draw(1) for _ in range(n_words // 2)]
+    sampler.resize(2 * n_words)
+    rest = finish_epoch(sampler, 1, n_words - n_words // 2, n_words)
+    assert not set(first_half) & set(rest), 'a word repeated within the epoch after growth'
+    assert len({sampler.draw(1) for _ in range(2 * n_words)}) == 2 * n_words, 'new words did not join the next epoch'
+    sampler.resize(n_words)
+    assert max(sampler.draw(1) for _ in range(n_words)) < n_words, 'permutation of a shrunk catalog is out of it'
+
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        fp = os.path.join(tmp_dp, 'sampler_state.bin')
+        sampler = WordSampler(n_words, seed=0)
+        first_half = [sampler.draw(1) for _ in range(n_words // 2)]
+        sampler.save(fp)
+        # version 1: no sizes of the epochs after the epochs
+        with open(fp, 'rb') as fin:
+            data = bytearray(fin.read())
+        struct.pack_into('<I', data, 4, 1)
+        with open(fp, 'wb') as fout:
+            fout.write(data[:len(data) - 4 * sampler.capacity])
+        loaded = WordSampler.load(fp, 2 * n_words)
+        rest = finish_epoch(loaded, 1, n_words - n_words // 2, n_words)
+        assert not set(first_half) & set(rest), 'a word repeated after loading a version 1 file'
+
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        db = UserStateDb(os.path.join(tmp_dp, 'user_state.sqlite'))
+        sampler = SharedWordSampler(db, n_words, block_size=7)
+        first_half = [sampler.draw(1) for _ in range(n_words // 2)]
+        SharedWordSampler(db, 2 * n_words).resize(2 * n_words)
+        sampler.resize(2 * n_words)
+        rest = finish_epoch(sampler, 1, n_words - n_words // 2, n_words)
+        assert not set(first_half) & set(rest), 'shared sampler repeated a word within the epoch after growth'
+        db.close()
+
+
+def check_shared_word_sampler(n_words=300, n_chats=1000, n_draws=20_000):
+    """
+    Two workers drawing for the same chat in turns never repeat a word within an epoch: each of them
+    draws from the blocks of positions it reserved. Reserving blocks saves write transactions
+    """
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        db = UserStateDb(os.path.join(tmp_dp, 'user_state.sqlite'))
+        workers = [SharedWordSampler(db, n_words), SharedWordSampler(db, n_words)]
+        drawn = [workers[ix // 3 % 2].draw(1) for ix in range(n_words // 2)]
+        assert len(set(drawn)) == len(drawn), 'workers repeated a word within an epoch'
+
+        rng = random.Random(0)
+        chat_ids = [rng.randrange(n_chats) for _ in range(n_draws)]
+        for block_size in (1, workers[0].block_size):
+            sampler = SharedWordSampler(db, n_words, block_size=block_size)
+            start = time.perf_counter()
+            for chat_id in chat_ids:
+                sampler.draw(chat_id)
+            elapsed = time.perf_counter() - start
+            logger.info(f'shared sampler, blocks of {block_size} positions: {elapsed / n_draws * 1e6:.1f} us/draw')
+        db.close()
+
+
+def make_fake_bot(server, con_pool_size=8):
+    return telegram.Bot('123456:fake', base_url=server.base_url, request=Request(con_pool_size=con_pool_size))
+
+
+class FailingUploadBot:
+    """
+    Fails uploads of the photos named in `failing` as Telegram does for a broken image
+    """
+
+    def __init__(self, bot, failing):
+        self.bot = bot
+        self.failing = failing
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        if os.path.basename(photo.name) in self.failing:
+            raise telegram.error.BadRequest('Photo_invalid_dimensions')
+        return self.bot.send_photo(chat_id, photo, **kwargs)
+
+
+class UnauthorizedUploadBot:
+    """
+    Fails the first upload with `Unauthorized` right away, the others succeed after `delay` seconds
+    """
+
+    def __init__(self, bot, delay=0.2):
+        self.bot = bot
+        self.delay = delay
+        self.n_calls = 0
+        self.n_uploaded = 0
+        self._lock = threading.Lock()
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        with self._lock:
+            self.n_calls += 1
+            if self.n_calls == 1:
+                raise telegram.error.Unauthorized('Forbidden: bot was blocked by the user')
+        time.sleep(self.delay)
+        res = self.bot.send_photo(chat_id, photo, **kwargs)
+        with self._lock:
+            self.n_uploaded += 1
+        return res
+
+
+def check_upload_unauthorized(server, tmp_dp, photos_dp, max_workers=4):
+    """
+    `Unauthorized` cancels pending uploads, the ones that finished before are journaled
+    """
+    json_fp = os.path.join(tmp_dp, 'file_ids_unauthorized.json')
+    bot = UnauthorizedUploadBot(make_fake_bot(server))
+    try:
+        utils.upload_photos_and_store_file_ids(bot, 1, [photos_dp], json_fp, max_workers=max_workers, rate=1000)
+        raise AssertionError('Unauthorized was not raised')
+    except telegram.error.Unauthorized:
+        pass
+    n_journaled = len(utils.read_upload_journal(f'{json_fp}.journal'))
+    assert n_journaled == bot.n_uploaded >= max_workers - 1, (n_journaled, bot.n_uploaded)
+    logger.info(f'upload stopped by Unauthorized: {n_journaled} finished uploads journaled')
+
+
+def check_upload_failures(server, tmp_dp, photos_dp, n_photos):
+    """
+    Failed uploads are reported after the others are journaled, a re-run uploads just the failed ones
+    """
+    json_fp = os.path.join(tmp_dp, 'file_ids_failing.json')
+    bot = make_fake_bot(server)
+    failing = {'0.jpg', '1.jpg'}
+    try:
+        utils.upload_photos_and_store_file_ids(FailingUploadBot(bot, failing), 1, [photos_dp], json_fp, rate=1000)
+        raise AssertionError('failed uploads were not reported')
+    except RuntimeError as e:
+        logger.info(f'upload with failures: {e}')
+    assert not os.path.isfile(json_fp)
+    assert len(utils.read_upload_journal(f'{json_fp}.journal')) == n_photos - len(failing)
+
+    calls_before = server.calls.get('sendPhoto', 0)
+    photo_file_ids = utils.upload_photos_and_store_file_ids(bot, 1, [photos_dp], json_fp, rate=1000)
+    assert server.calls.get('sendPhoto', 0) - calls_before == len(failing)
+    assert len(photo_file_ids) == n_photos
+    # the fake Bot API scales every photo to 1080x1920
+    with open(os.path.join(tmp_dp, 'photo_orientations.json')) as fin:
+        assert json.load(fin) == dict.fromkeys(photo_file_ids, 'vertical'), 'orientations were not stored'
+
+
+def benchmark_photo_upload(n_photos=200, photo_size=100 * 1024, latency=0.05, error_rate=0.01):
+    logger.info(f'benchmark_photo_upload. photos: {n_photos}, latency: {latency} s, 429 rate: {error_rate}')
+    with tempfile.TemporaryDirectory() as tmp_dp, \
+            FakeBotApiServer(latency=latency, error_rate=error_rate, retry_after=1) as server:
+        photos_dp = os.path.join(tmp_dp, 'photos')
+        os.makedirs(photos_dp)
+        for ix in range(n_photos):
+            with open(os.path.join(photos_dp, f'{ix}.jpg'), 'wb') as fout:
+                fout.write(os.urandom(photo_size))
+
+        for max_workers in (1, 8):
+            json_fp = os.path.join(tmp_dp, f'file_ids_{max_workers}.json')
+            bot = make_fake_bot(server, con_pool_size=max_workers + 1)
+            t0 = time.perf_counter()
+            utils.upload_photos_and_store_file_ids(bot, 1, [photos_dp], json_fp, max_workers=max_workers, rate=1000)
+            elapsed = time.perf_counter() - t0
+            logger.info(f'workers: {max_workers}. {n_photos / elapsed:.1f} photos/s')
+
+            # re-run must skip everything
+            calls_before = server.calls.get('sendPhoto', 0)
+            t0 = time.perf_counter()
+            utils.upload_photos_and_store_file_ids(bot, 1, [photos_dp], json_fp, max_workers=max_workers, rate=1000)
+            logger.info(f'workers: {max_workers}. re-run took {time.perf_counter() - t0:.2f} s, '
+                        f'uploads: {server.calls.get("sendPhoto", 0) - calls_before}')
+
+        check_upload_failures(server, tmp_dp, photos_dp, n_photos)
+        check_upload_unauthorized(server, tmp_dp, photos_dp)
+
+
+def make_synthetic_png_dir(photos_dp, n_photos, size=(1440, 3040)):
+    import numpy as np
+    from PIL import Image
+
+    os.makedirs(photos_dp, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for ix in range(n_photos):
+        width, height = size if ix % 4 else size[::-1]
+        # smooth gradient with light noise compresses like a screenshot, not like pure noise
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * np.ones((height, 1, 3), np.float32)
+        noise = rng.integers(0, 16, (height, width, 3), dtype=np.uint8)
+        pixels = (gradient.astype(np.uint8) // 2 + noise)
+        Image.fromarray(pixels).save(os.path.join(photos_dp, f'{ix}.png'))
+
+
+def benchmark_photo_preprocessing(n_photos=40):
+    logger.info(f'benchmark_photo_preprocessing. photos: {n_photos}')
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        photos_dp = os.path.join(tmp_dp, 'new')
+        make_synthetic_png_dir(photos_dp, n_photos)
+
+        t0 = time.perf_counter()
+        utils.sort_vertical_from_horizontal_photos(photos_dp)
+        utils.crop_and_save_photo_dir(os.path.join(photos_dp, 'vertical'), 0, 117, 1065, 2019)
+        utils.crop_and_save_photo_dir(os.path.join(photos_dp, 'horizontal'), 116, 72, 2119, 930)
+        logger.info(f'sequential sort + crop: {n_photos / (time.perf_counter() - t0):.2f} photos/s')
+
+        for n_processes in sorted({1, os.cpu_count()}):
+            out_dp = os.path.join(tmp_dp, f'prepared_{n_processes}')
+            t0 = time.perf_counter()
+            utils.preprocess_photo_dir(photos_dp, out_dp, crop_vertical=(0, 117, 1065, 2019),
+                                       crop_horizontal=(116, 72, 2119, 930), n_processes=n_processes)
+            logger.info(f'pipeline, processes: {n_processes}: {n_photos / (time.perf_counter() - t0):.2f} photos/s')
+
+        t0 = time.perf_counter()
+        n_processed, n_skipped = utils.preprocess_photo_dir(photos_dp, out_dp, crop_vertical=(0, 117, 1065, 2019),
+                                                            crop_horizontal=(116, 72, 2119, 930))
+        logger.info(f'incremental re-run: {time.perf_counter() - t0:.2f} s, processed: {n_processed}, '
+                    f'skipped: {n_skipped}')
+
+
+def make_synthetic_screenshot(rng, size=(540, 1140)):
+    """
+    :return: grayscale screenshot-like photo: the same app header on every photo and lines of "words" below it
+    """
+    import numpy as np
+
+    width, height = size
+    pixels = np.full((height, width), 250, dtype=np.uint8)
+    pixels[:height // 12] = 60
+    for y in range(height // 8, height - 40, 36):
+        x = 20
+        while x < width - 40:
+            word_width = int(rng.integers(20, 120))
+            pixels[y:y + 20, x:min(x + word_width, width - 20)] = rng.integers(0, 80)
+            x += word_width + 12
+    return pixels
+
+
+def benchmark_photo_dedup(n_photos=2000, duplicate_share=0.1, n_index=100_000, radius=16):
+    """
+    Hash synthetic screenshots, `duplicate_share` of them rescaled and recompressed copies of others,
+    and find the duplicates among `n_index` hashes
+    """
+    import numpy as np
+    from PIL import Image
+
+    import photo_dedup
+
+    logger.info(f'benchmark_photo_dedup. photos: {n_photos}, index: {n_index} hashes, radius: {radius}')
+    rng = np.random.default_rng(0)
+    n_duplicates = int(n_photos * duplicate_share)
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        for ix in range(n_photos - n_duplicates):
+            Image.fromarray(make_synthetic_screenshot(rng)).save(os.path.join(tmp_dp, f'{ix}.jpg'), quality=90)
+        planted = set()
+        # photo -> the photo it is a copy of
+        origin = {f'{ix}.jpg': ix for ix in range(n_photos - n_duplicates)}
+        for ix in range(n_duplicates):
+            original_ix = int(rng.integers(n_photos - n_duplicates))
+            with Image.open(os.path.join(tmp_dp, f'{original_ix}.jpg')) as img:
+                copy = img.resize((img.width * 4 // 5, img.height * 4 // 5), Image.BILINEAR)
+            copy.save(os.path.join(tmp_dp, f'dup_{ix}.png'))
+            planted.add((f'{original_ix}.jpg', f'dup_{ix}.png'))
+            origin[f'dup_{ix}.png'] = original_ix
+        fps = utils.get_photos_fps_from_dp(tmp_dp)
+
+        for n_processes in sorted({1, os.cpu_count()}):
+            t0 = time.perf_counter()
+            hashed_fps, hashes = photo_dedup.compute_photo_hashes(fps, n_processes=n_processes)
+            elapsed = time.perf_counter() - t0
+            logger.info(f'hashing, processes: {n_processes}: {len(fps) / elapsed:.0f} photos/s, '
+                        f'100k photos in {100_000 / (len(fps) / elapsed) / 60:.1f} min')
+
+    # real hashes padded with random ones to the catalog size
+    all_hashes = np.concatenate([hashes, rng.integers(0, 256, (n_index - len(hashes), hashes.shape[1]),
+                                                      dtype=np.uint8)])
+    t0 = time.perf_counter()
+    index = photo_dedup.MultiIndexHash(all_hashes, radius)
+    built_at = time.perf_counter()
+    i, j, _ = index.pairs()
+    elapsed = time.perf_counter() - built_at
+    logger.info(f'index of {n_index} hashes: built in {built_at - t0:.2f} s, all pairs in {elapsed:.2f} s')
+
+    names = [os.path.basename(fp) for fp in hashed_fps]
+    found = {tuple(sorted((names[a], names[b]), key=lambda x: x.startswith('dup'))) for a, b in zip(i, j)
+             if a < len(names) and b < len(names)}
+    n_false = sum(origin[a] != origin[b] for a, b in found)
+    logger.info(f'duplicates found: {len(planted & found)} of {len(planted)}, false pairs: {n_false}')
+
+    t0 = time.perf_counter()
+    for h in all_hashes[:1000]:
+        index.query(h)
+    logger.info(f'single query: {(time.perf_counter() - t0) / 1000 * 1e6:.0f} us')
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+def benchmark_broadcast(n_subscribers=100_000, n_blocked=1000, latency=0.005, global_rate=5000, crash_after=20_000):
+    """
+    Deliver a single bucket to `n_subscribers` through the fake Bot API.
+    The first attempt crashes after `crash_after` deliveries, the second one must resume from checkpoints
+    """
+    logger.info(f'benchmark_broadcast. subscribers: {n_subscribers}, blocked: {n_blocked}, '
+                f'latency: {latency} s, global rate: {global_rate} msg/s')
+    blocked = set(range(1, n_blocked + 1))
+    with tempfile.TemporaryDirectory() as tmp_dp, \
+            FakeBotApiServer(latency=latency, blocked_chat_ids=blocked) as server:
+        registry = SubscriberRegistry(os.path.join(tmp_dp, 'subscribers.sqlite'))
+        registry.subscribe_many((chat_id, 0) for chat_id in range(1, n_subscribers + 1))
+        bot = make_fake_bot(server, con_pool_size=16)
+
+        n_calls = 0
+
+        def show_word_crashing(chat_id):
+            nonlocal n_calls
+            n_calls += 1
+            if n_calls > crash_after:
+                raise SimulatedCrash()
+            return 0, 'fake_file_id'
+
+        broadcaster = Broadcaster(bot, registry, show_word_crashing, global_rate=global_rate, per_chat_interval=0)
+        try:
+            broadcaster.run('benchmark', 0)
+        except SimulatedCrash:
+            logger.info(f'simulated crash after {server.calls.get("sendPhoto", 0)} deliveries')
+
+        broadcaster = Broadcaster(bot, registry, lambda chat_id: (0, 'fake_file_id'), global_rate=global_rate,
+                                  per_chat_interval=0)
+        metrics = broadcaster.run('benchmark', 0)
+        logger.info(f'resumed run: {metrics}')
+
+        n_calls = server.calls.get('sendPhoto', 0)
+        logger.info(f'sendPhoto calls: {n_calls}, subscribers: {n_subscribers}, '
+                    f'left after pruning: {registry.count()}')
+        assert n_calls == n_subscribers, 'some chats were skipped or received the word twice'
+        registry.close()
+
+
+def benchmark_review_scheduler(n_users=10_000, n_words_per_user=100, n_ops=100_000):
+    n_items = n_users * n_words_per_user
+    logger.info(f'benchmark_review_scheduler. user-word pairs: {n_items}')
+    now = int(time.time())
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        fp = os.path.join(tmp_dp, 'review_state.bin')
+        scheduler = ReviewScheduler(fp)
+
+        t0 = time.perf_counter()
+        for chat_id in range(n_users):
+            for word_ix in range(n_words_per_user):
+                scheduler.add(chat_id, word_ix, now=now - random.randint(0, 10 * 24 * 60 * 60))
+        elapsed = time.perf_counter() - t0
+        logger.info(f'add: {elapsed / n_items * 1e6:.2f} us/item, '
+                    f'memory: {scheduler.nbytes() / 2 ** 20:.1f} MB, {scheduler.nbytes() / n_items:.1f} bytes/item')
+
+        t0 = time.perf_counter()
+        n_flushed = scheduler.flush()
+        logger.info(f'initial flush of {n_flushed} items: {time.perf_counter() - t0:.2f} s')
+
+        latencies = []
+        for _ in range(n_ops):
+            chat_id = random.randrange(n_users)
+            word_ix = random.randrange(n_words_per_user)
+            t0 = time.perf_counter()
+            scheduler.grade(chat_id, word_ix, knew=random.random() < 0.8, now=now)
+            latencies.append(time.perf_counter() - t0)
+        p = percentiles(latencies)
+        logger.info(f'grade: p50: {p[50] * 1e6:.2f} us, p99: {p[99] * 1e6:.2f} us')
+
+        latencies = []
+        for _ in range(n_ops // 10):
+            t0 = time.perf_counter()
+            scheduler.next_due_word(random.randrange(n_users), now=now)
+            latencies.append(time.perf_counter() - t0)
+        p = percentiles(latencies)
+        logger.info(f'next_due_word: p50: {p[50] * 1e6:.2f} us, p99: {p[99] * 1e6:.2f} us')
+
+        t0 = time.perf_counter()
+        n_popped = len(scheduler.due_heap)
+        chats = scheduler.pop_due_chats(now=now)
+        n_popped -= len(scheduler.due_heap)
+        elapsed = time.perf_counter() - t0
+        logger.info(f'pop_due_chats: {n_popped} due items of {len(chats)} chats in {elapsed:.2f} s, '
+                    f'{elapsed / max(n_popped, 1) * 1e6:.2f} us/item')
+
+        t0 = time.perf_counter()
+        n_flushed = scheduler.flush()
+        logger.info(f'batched flush of {n_flushed} changed items: {time.perf_counter() - t0:.2f} s')
+
+        t0 = time.perf_counter()
+        ReviewScheduler(fp)
+        logger.info(f'load: {time.perf_counter() - t0:.2f} s')
+
+        check_review_scheduler(tmp_dp)
+
+
+def check_review_scheduler(tmp_dp):
+    """
+    Words out of the catalog are not due, dropped words are not reviewed anymore, also after a reload,
+    a failed flush is repeated by the next one
+    """
+    now = int(time.time())
+    for scheduler in (ReviewScheduler(os.path.join(tmp_dp, 'review_check.bin')),
+                      SharedReviewScheduler(UserStateDb(os.path.join(tmp_dp, 'review_check.sqlite')))):
+        scheduler.add(1, 500, now=now - 20)
+        scheduler.add(1, 7, now=now - 10)
+        assert scheduler.next_due_word(1, now=now) == 500
+        assert scheduler.next_due_word(1, n_words=300, now=now) == 7
+        scheduler.drop(1, 500)
+        assert scheduler.next_due_word(1, now=now) == 7
+        assert scheduler.progress(1) == (1, 0)
+        scheduler.flush()
+    reloaded = ReviewScheduler(os.path.join(tmp_dp, 'review_check.bin'))
+    assert reloaded.next_due_word(1, now=now) == 7 and reloaded.progress(1) == (1, 0), 'dropped word came back'
+    assert reloaded.pop_due_chats(now=now) == {1} and not reloaded.pop_due_chats(now=now + 10 ** 9)
+
+    scheduler = ReviewScheduler(os.path.join(tmp_dp, 'missing_dir', 'review_check.bin'))
+    scheduler.add(1, 7, now=now)
+    try:
+        scheduler.flush()
+        raise AssertionError('flush into a missing directory succeeded')
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(scheduler.state_fp))
+    assert scheduler.flush() == 1, 'items of the failed flush were not written by the next one'
+    assert len(ReviewScheduler(scheduler.state_fp)) == 1
+
+
+BELARUSIAN_ALPHABET = 'абвгдеёжзійклмнопрстуўфхцчшыьэюя'
+
+
+def make_synthetic_words(n_words, seed=0):
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(BELARUSIAN_ALPHABET) for _ in range(rng.randint(4, 12))))
+    return sorted(words)
+
+
+def with_typo(word, rng):
+    ix = rng.randrange(len(word))
+    return word[:ix] + rng.choice(BELARUSIAN_ALPHABET) + word[ix + 1:]
+
+
+def benchmark_word_index(n_words=100_000, n_queries=10_000):
+    logger.info(f'benchmark_word_index. words: {n_words}, queries: {n_queries}')
+    words = make_synthetic_words(n_words)
+    entries = ({'headword': word, 'definition': f'азначэнне слова {word}', 'file_id': None} for word in words)
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        fp = os.path.join(tmp_dp, 'word_index.bin')
+        t0 = time.perf_counter()
+        WordIndex.build(entries, fp)
+        logger.info(f'build: {time.perf_counter() - t0:.2f} s, size: {os.path.getsize(fp) / 2 ** 20:.1f} MB')
+
+        t0 = time.perf_counter()
+        index = WordIndex(fp)
+        logger.info(f'open: {(time.perf_counter() - t0) * 1e3:.2f} ms')
+
+        queries = {
+            'exact': [rng.choice(words) for _ in range(n_queries)],
+            'prefix': [rng.choice(words)[:3] for _ in range(n_queries)],
+            'typo': [with_typo(rng.choice(words), rng) for _ in range(n_queries)],
+        }
+        for kind, kind_queries in queries.items():
+            latencies = []
+            for query in kind_queries:
+                t0 = time.perf_counter()
+                index.find(query)
+                latencies.append(time.perf_counter() - t0)
+            p = percentiles(latencies)
+            logger.info(f'{kind} queries: p50: {p[50] * 1e3:.3f} ms, p99: {p[99] * 1e3:.3f} ms')
+        index.close()
+
+
+def replay_inline_queries(words, n_queries, rng):
+    """
+    Queries as sent by Telegram while users type a word: every prefix of the word, sometimes followed by
+    requests of the next pages. Popular words are typed more often
+    """
+    queries = []
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    while len(queries) < n_queries:
+        word = rng.choices(words, weights)[0]
+        if rng.random() < 0.1:
+            queries.append(('', ''))
+            continue
+        for length in range(1, len(word) + 1):
+            queries.append((word[:length], ''))
+        if rng.random() < 0.2:
+            queries.append((word[:2], '1'))
+    return queries[:n_queries]
+
+
+def check_random_pages(cache, n_photos):
+    """
+    Walking the pages of a random order shows every photo once
+    """
+    shown = []
+    page, offset = cache.get('')
+    shown.extend(page)
+    while offset:
+        page, offset = cache.get('', offset)
+        shown.extend(page)
+    assert sorted(int(result.id[1:]) for result in shown) == list(range(n_photos))
+    assert cache.get('', '0.0') == cache.get('', '0.0')
+
+
+def benchmark_inline_query(n_words=100_000, n_photos=300, n_queries=100_000):
+    logger.info(f'benchmark_inline_query. words: {n_words}, photos: {n_photos}, queries: {n_queries}')
+    words = make_synthetic_words(n_words)
+    entries = ({'headword': word, 'definition': f'азначэнне слова {word}', 'file_id': f'file_id_{word}'}
+               for word in words)
+    photos_file_ids = [(f'{ix}.jpg', f'photo_file_id_{ix}') for ix in range(n_photos)]
+    rng = random.Random(2)
+    queries = replay_inline_queries(words, n_queries, rng)
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        fp = os.path.join(tmp_dp, 'word_index.bin')
+        WordIndex.build(entries, fp)
+        index = WordIndex(fp)
+
+        t0 = time.perf_counter()
+        cache = InlineResultCache(photos_file_ids, index)
+        logger.info(f'cache created in {(time.perf_counter() - t0) * 1e3:.3f} ms')
+        check_random_pages(cache, n_photos)
+
+        latencies = []
+        for query, offset in queries:
+            t0 = time.perf_counter()
+            cache.get(query, offset)
+            latencies.append(time.perf_counter() - t0)
+        p = percentiles(latencies, (50, 99, 99.9))
+        logger.info(f'inline queries: p50: {p[50] * 1e3:.3f} ms, p99: {p[99] * 1e3:.3f} ms, '
+                    f'p99.9: {p[99.9] * 1e3:.3f} ms. cache: {cache.stats()}')
+        cache.clear()
+        index.close()
+
+
+ERROR_TYPES = (ValueError, KeyError, TypeError, RuntimeError, IndexError)
+
+
+def benchmark_error_reporter(n_errors=10_000, n_kinds=5, latency=0.01):
+    logger.info(f'benchmark_error_reporter. errors: {n_errors}, distinct errors: {n_kinds}')
+    with FakeBotApiServer(latency=latency) as server:
+        reporter = ErrorReporter(make_fake_bot(server), chat_id=1)
+        reporter.start()
+        latencies = []
+        for ix in range(n_errors):
+            try:
+                # every occurrence has its own message, fingerprints differ only by the error type
+                raise ERROR_TYPES[ix % n_kinds](f'error #{ix} for chat_id {ix * 7919}')
+            except Exception as e:
+                t0 = time.perf_counter()
+                reporter.report(None, e, user_info='benchmark')
+                latencies.append(time.perf_counter() - t0)
+        reporter.digest()
+        reporter.stop()
+
+        p = percentiles(latencies)
+        n_calls = sum(server.calls.get(method, 0) for method in ('sendDocument', 'sendMessage'))
+        logger.info(f'report: p50: {p[50] * 1e6:.1f} us, p99: {p[99] * 1e6:.1f} us. '
+                    f'outbound calls: {n_calls}, stats: {reporter.stats()}')
+        # one document per fingerprint and a single digest for all repeats
+        assert n_calls <= len(reporter) + 1, n_calls
+
+
+def benchmark_metrics(n_calls=1_000_000, n_threads=4):
+    logger.info(f'benchmark_metrics. calls: {n_calls}, threads: {n_threads}')
+    registry = MetricsRegistry()
+
+    def handler(update, context):
+        return update
+
+    timed_handler = registry.timed('handler', 'handler')(handler)
+    for name, func in (('bare', handler), ('timed', timed_handler)):
+        t0 = time.perf_counter()
+        for ix in range(n_calls):
+            func(ix, None)
+        logger.info(f'{name}: {(time.perf_counter() - t0) / n_calls * 1e9:.0f} ns per call')
+
+    # shards are per thread, concurrent writers must not lose counts
+    threads = [threading.Thread(target=lambda: [timed_handler(ix, None) for ix in range(n_calls // n_threads)])
+               for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # shards of the exited threads are folded into the retired one, their counts stay
+    histogram = registry.histogram('handler', 'handler')
+    assert len(histogram._shards) == 1, len(histogram._shards)
+    assert histogram.snapshot()[COUNT] == n_calls + n_threads * (n_calls // n_threads), histogram.snapshot()[COUNT]
+    t0 = time.perf_counter()
+    text = registry.render_prometheus()
+    logger.info(f'render_prometheus: {(time.perf_counter() - t0) * 1e3:.2f} ms, {len(text)} bytes. '
+                f'{registry.summary()}')
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeUpdate:
+    def __init__(self, user_id):
+        self.effective_user = FakeUser(user_id)
+
+
+class LoggingHandlers:
+    """
+    Handler with the same logging as `LieksikaBot.get`: the decorator line and a line from the handler body
+    """
+
+    @log_method_name_and_chat_id_from_update
+    def get(self, update, context):
+        chat_id = update.effective_user.id
+        logger.info('send_word. chat_id: %s, word_ix: %s', chat_id, 0, extra={'chat_id': chat_id})
+
+
+def benchmark_logging(n_calls=100_000, n_threads=4):
+    logger.info(f'benchmark_logging. calls: {n_calls}, threads: {n_threads}')
+    handlers = LoggingHandlers()
+    modes = [('plain', None), ('json', None), ('json', {'get': 0.1, 'send_word': 0.1})]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        for mode, sample_rates in modes:
+            log_fp = os.path.join(tmp_dp, f'{mode}.log')
+            with open(log_fp, 'w') as stream:
+                log_config.setup_logging(mode, sample_rates=sample_rates, stream=stream)
+
+                def worker(thread_ix):
+                    update = FakeUpdate(thread_ix)
+                    for _ in range(n_calls // n_threads):
+                        handlers.get(update, None)
+
+                threads = [threading.Thread(target=worker, args=(ix,)) for ix in range(n_threads)]
+                t0 = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - t0
+                # time to drain the queue is not on the handler path, but must stay bounded
+                t0 = time.perf_counter()
+                log_config.stop_listener()
+                drain = time.perf_counter() - t0
+            results.append((mode, sample_rates, n_calls / elapsed, drain, os.path.getsize(log_fp)))
+    log_config.setup_logging('plain')
+    for mode, sample_rates, throughput, drain, size in results:
+        logger.info(f'{mode}, sampling: {sample_rates}: {throughput:.0f} handler calls/s, '
+                    f'queue drained in {drain:.2f} s, log size: {size / 2 ** 20:.1f} MB')
+
+
+SKARNIK_PAGE_TEMPLATE = (
+    '<!DOCTYPE html><html><head><meta charset="utf-8"><title>{word} - skarnik.by</title>'
+    '<link rel="canonical" href="https://www.skarnik.by/tsbm/{ix}"></head><body>'
+    '<div class="menu">{padding}</div><h1>{word}</h1>'
+    '<p id="trn"><span>1.</span> азначэнне слова <i>{word}</i><br><span>2.</span> {padding}</p>'
+    '</body></html>'
+)
+
+
+def make_synthetic_pages(pages_dp, words):
+    os.makedirs(pages_dp, exist_ok=True)
+    padding = 'тэкст ' * 200
+    for ix, word in enumerate(words):
+        with open(os.path.join(pages_dp, f'{ix}.html'), 'w', encoding='utf-8') as fout:
+            fout.write(SKARNIK_PAGE_TEMPLATE.format(word=word, ix=ix, padding=padding))
+
+
+def check_ingest_sources(tmp_dp, words):
+    """
+    Sources don't remove pages of each other, words added to the catalog by hand are kept
+    """
+    catalog_fp = os.path.join(tmp_dp, 'sources.jsonl')
+    state_fp = os.path.join(tmp_dp, 'sources.sqlite')
+    first_dp, second_dp = os.path.join(tmp_dp, 'first'), os.path.join(tmp_dp, 'second')
+    make_synthetic_pages(first_dp, words[:10])
+    make_synthetic_pages(second_dp, words[10:20])
+    write_catalog(catalog_fp, [{'headword': 'уручную', 'definition': '', 'file_id': 'manual'}])
+
+    page_ingest.ingest_pages(first_dp, catalog_fp, state_fp, n_processes=2)
+    stats = page_ingest.ingest_pages(second_dp, catalog_fp, state_fp, n_processes=2)
+    assert stats['removed'] == 0 and stats['words'] == 21, stats
+    os.remove(os.path.join(first_dp, '0.html'))
+    stats = page_ingest.ingest_pages(first_dp, catalog_fp, state_fp, n_processes=2)
+    headwords = {entry['headword'] for entry in read_catalog(catalog_fp)}
+    assert stats['removed'] == 1 and stats['kept'] == 1, stats
+    assert words[0] not in headwords and words[10] in headwords and 'уручную' in headwords
+
+
+def benchmark_page_ingest(n_pages=20_000, n_changed=200):
+    logger.info(f'benchmark_page_ingest. pages: {n_pages}, changed on rebuild: {n_changed}')
+    words = make_synthetic_words(n_pages)
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        pages_dp = os.path.join(tmp_dp, 'pages')
+        catalog_fp = os.path.join(tmp_dp, 'words.jsonl')
+        state_fp = os.path.join(tmp_dp, 'ingest_state.sqlite')
+        make_synthetic_pages(pages_dp, words)
+        check_ingest_sources(tmp_dp, words)
+
+        stats = page_ingest.ingest_pages(pages_dp, catalog_fp, state_fp)
+        logger.info(f'full ingest: {stats["pages_per_s"]:.0f} pages/s')
+        stats = page_ingest.ingest_pages(pages_dp, catalog_fp, state_fp)
+        logger.info(f'unchanged rebuild: {stats["pages_per_s"]:.0f} pages/s')
+        for ix in range(n_changed):
+            with open(os.path.join(pages_dp, f'{ix}.html'), 'a', encoding='utf-8') as fout:
+                fout.write('\n')
+        stats = page_ingest.ingest_pages(pages_dp, catalog_fp, state_fp)
+        logger.info(f'rebuild with {stats["parsed"]} changed pages: {stats["elapsed"]:.2f} s')
+
+
+def benchmark_bot_load(n_updates=5000, n_users=200, latency=0.01, error_rate=0.001):
+    logger.info(f'benchmark_bot_load. updates: {n_updates}, users: {n_users}, Bot API latency: {latency} s, '
+                f'429 rate: {error_rate}')
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        events_fp = os.path.join(tmp_dp, 'events.jsonl')
+        load_test.write_events(events_fp, load_test.generate_events(n_updates, n_users, seed=0))
+        events = load_test.read_events(events_fp)
+    for mode in ('polling', 'webhook'):
+        report = load_test.run_load_test(events, mode, latency, error_rate)
+        logger.info(f'{mode}: {report}')
+        assert report['answered'] + report['lost'] == report['updates'] >= n_updates
+
+
+def benchmark_webhook_scaling(n_updates=4000, n_users=400, latency=0.01, worker_counts=(1, 2, 4), rate=10_000,
+                              min_efficiency=0.6, conversation_timeout=10):
+    """
+    :param rate: messages per second of the scheduler of every worker, overall and to a chat.
+    with Telegram's limits users would wait for the scheduler whatever the number of workers
+    :param conversation_timeout: longer than the replay takes to send the first update of every user,
+    so conversations don't time out before the users get to answer
+    :param min_efficiency: the most workers must be at least as much faster than the fewest
+    as the share of the extra CPU cores they can use
+    """
+    logger.info(f'benchmark_webhook_scaling. updates: {n_updates}, users: {n_users}, Bot API latency: {latency} s, '
+                f'workers: {worker_counts}')
+    chat_ids = range(100_000)
+    ring = HashRing([f'worker_{ix}' for ix in range(4)])
+    before = [ring.node_for(chat_id) for chat_id in chat_ids]
+    ring.add('worker_4')
+    n_moved = sum(node != ring.node_for(chat_id) for chat_id, node in zip(chat_ids, before))
+    logger.info(f'adding the 5th worker moved {n_moved / len(chat_ids):.1%} of chats')
+    assert n_moved / len(chat_ids) < 1.5 / 5, 'adding a worker moved more than its share of chats'
+
+    events = load_test.generate_events(n_updates, n_users, seed=0)
+    throughputs = {}
+    for n_workers in worker_counts:
+        report = load_test.run_sharded_load_test(events, n_workers, latency, conversation_timeout=conversation_timeout,
+                                                 global_rate=rate, chat_rate=rate)
+        throughput = throughputs[n_workers] = report['updates_per_second']
+        logger.info(f'{n_workers} workers: {throughput:.0f} updates/s '
+                    f'(x{throughput / throughputs[worker_counts[0]]:.2f} of {worker_counts[0]} workers), '
+                    f'p50: {report["p50_ms"]} ms, p99: {report["p99_ms"]} ms, lost: {report["lost"]}, '
+                    f'forwarded by worker: {list(report["router"]["forwarded_by_worker"].values())}')
+        assert report['lost'] == 0, f'{n_workers} workers lost {report["lost"]} of {report["updates"]} updates'
+    speedup = throughputs[worker_counts[-1]] / throughputs[worker_counts[0]]
+    n_cores = os.cpu_count() or 1
+    expected = min_efficiency * min(worker_counts[-1], n_cores) / min(worker_counts[0], n_cores)
+    logger.info(f'{worker_counts[-1]} workers: x{speedup:.2f} of {worker_counts[0]} on {n_cores} CPU cores')
+    assert speedup >= expected, f'{worker_counts[-1]} workers are only x{speedup:.2f} of {worker_counts[0]}, ' \
+                                f'expected x{expected:.2f} on {n_cores} CPU cores'
+
+
+# run in a fresh interpreter, so RSS only holds the loaded catalog
+PHOTO_CATALOG_LOAD_CODE = '''
+import json, os, random, sys, time
+sys.path.insert(0, sys.argv[3])
+from photo_catalog import PhotoCatalog
+
+def rss():
+    with open('/proc/self/statm') as fin:
+        return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+mode, fp = sys.argv[1:3]
+rss_start = rss()
+start = time.perf_counter()
+if mode == 'json':
+    with open(fp) as fin:
+        photos = tuple(json.load(fin).items())
+else:
+    photos = PhotoCatalog(fp)
+load_time = time.perf_counter() - start
+rss_loaded = rss()
+ixs = [random.randrange(len(photos)) for _ in range(100_000)]
+start = time.perf_counter()
+for ix in ixs:
+    photos[ix][1]
+lookup_time = (time.perf_counter() - start) / len(ixs)
+print(json.dumps({'load_s': load_time, 'rss_mb': (rss_loaded - rss_start) / 2 ** 20, 'lookup_us': lookup_time * 1e6,
+                  'rss_after_lookups_mb': (rss() - rss_start) / 2 ** 20}))
+'''
+
+
+def benchmark_photo_catalog(sizes=(10_000, 100_000, 1_000_000)):
+    logger.info(f'benchmark_photo_catalog. catalog sizes: {sizes}')
+    repo_dp = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        for n_photos in sizes:
+            json_fp = os.path.join(tmp_dp, f'photo_file_ids_{n_photos}.json')
+            catalog_fp = os.path.join(tmp_dp, f'photo_catalog_{n_photos}.bin')
+            with open(json_fp, 'w') as fout:
+                # file_ids of real photos are ~80 characters long
+                json.dump({f'Screenshot_{ix:07d}.jpg': f'AgACAgIAAxkDAAI{ix:07d}' + 'x' * 60
+                           for ix in range(n_photos)}, fout)
+            start = time.perf_counter()
+            PhotoCatalog.build_from_json(json_fp, catalog_fp)
+            build_time = time.perf_counter() - start
+            for mode, fp in (('json', json_fp), ('mmap', catalog_fp)):
+                output = subprocess.run([sys.executable, '-c', PHOTO_CATALOG_LOAD_CODE, mode, fp, repo_dp],
+                                        check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                logger.info(f'{n_photos} photos, {mode}: startup load {result["load_s"] * 1e3:.1f} ms, '
+                            f'RSS +{result["rss_mb"]:.1f} MB (+{result["rss_after_lookups_mb"]:.1f} MB after '
+                            f'100k random lookups), lookup {result["lookup_us"]:.2f} us')
+            logger.info(f'{n_photos} photos: catalog built in {build_time:.2f} s, '
+                        f'{os.path.getsize(catalog_fp) / 2 ** 20:.1f} MB on disk')
+        check_catalog_tombstones(tmp_dp)
+
+
+def check_catalog_tombstones(tmp_dp):
+    """
+    Removed photos stay in the catalog as tombstones, so positions of the others don't shift,
+    and a photo that comes back gets its old position
+    """
+    json_fp = os.path.join(tmp_dp, 'photo_file_ids_tombstones.json')
+    catalog_fp = os.path.join(tmp_dp, 'photo_catalog_tombstones.bin')
+
+    def build(photo_file_ids):
+        with open(json_fp, 'w') as fout:
+            json.dump(photo_file_ids, fout)
+        PhotoCatalog.build_from_json(json_fp, catalog_fp)
+        catalog = PhotoCatalog(catalog_fp)
+        items = list(catalog)
+        removed = [ix for ix in range(len(catalog)) if catalog.is_removed(ix)]
+        catalog.close()
+        return items, removed
+
+    build({'a.jpg': 'id_a', 'b.jpg': 'id_b', 'c.jpg': 'id_c'})
+    items, removed = build({'a.jpg': 'id_a', 'c.jpg': 'id_c', 'd.jpg': 'id_d'})
+    assert items == [('a.jpg', 'id_a'), ('b.jpg', ''), ('c.jpg', 'id_c'), ('d.jpg', 'id_d')], items
+    assert removed == [1], removed
+    items, removed = build({'b.jpg': 'id_b2', 'c.jpg': 'id_c', 'd.jpg': 'id_d'})
+    assert items == [('a.jpg', ''), ('b.jpg', 'id_b2'), ('c.jpg', 'id_c'), ('d.jpg', 'id_d')], items
+    assert removed == [0], removed
+
+
+
+def benchmark_callback_pipeline(n_callbacks=100, latency=0.05):
+    logger.info(f'benchmark_callback_pipeline. "next" callbacks: {n_callbacks}, Bot API latency: {latency} s')
+    chat_id = 1000
+    with tempfile.TemporaryDirectory() as tmp_dp, FakeBotApiServer(latency=latency) as server:
+        catalog_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        load_test.write_photo_catalog(catalog_fp, 300)
+        lieksika = load_test.make_bot(server.base_url, catalog_fp, conversation_timeout=600)
+        lieksika.callback_pipeline.start()
+        bot = lieksika.updater.bot
+        context = CallbackContext(lieksika.dp)
+        keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton('next', callback_data='1')]])
+
+        calls = {}
+        server.on_call = lambda method, params: calls.setdefault(method, time.perf_counter())
+
+        def measure(handle):
+            spinner, photo = [], []
+            for ix in range(n_callbacks):
+                calls.clear()
+                start = time.perf_counter()
+                handle(ix)
+                while 'answerCallbackQuery' not in calls:
+                    time.sleep(0.001)
+                spinner.append(calls['answerCallbackQuery'] - start)
+                photo.append(calls['sendPhoto'] - start)
+            return percentiles(spinner), percentiles(photo)
+
+        def sequential(ix):
+            # the calls `get_word_send_next` made one after another before the pipeline
+            bot.edit_message_reply_markup(chat_id, server.last_message_ids.get(chat_id, 1), reply_markup=None)
+            bot.send_photo(chat_id, 'fake_photo_1', reply_markup=keyboard)
+            bot.answer_callback_query(str(ix))
+
+        def pipelined(ix):
+            update = telegram.Update.de_json({
+                'update_id': ix,
+                'callback_query': {
+                    'id': str(ix), 'chat_instance': str(chat_id), 'data': '1',
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+                    'message': {'message_id': server.last_message_ids.get(chat_id, 0), 'date': 0,
+                                'chat': {'id': chat_id, 'type': 'private'}}}
+            }, bot)
+            lieksika.get_word_send_next(update, context)
+
+        logging.disable(logging.INFO)
+        try:
+            results = {'sequential': measure(sequential), 'pipelined': measure(pipelined)}
+            lieksika.callback_pipeline.stop()
+        finally:
+            logging.disable(logging.NOTSET)
+        for name, (spinner, photo) in results.items():
+            logger.info(f'{name}: time to spinner clear p50: {spinner[50] * 1e3:.0f} ms, '
+                        f'p99: {spinner[99] * 1e3:.0f} ms; time to photo p50: {photo[50] * 1e3:.0f} ms, '
+                        f'p99: {photo[99] * 1e3:.0f} ms')
+        logger.info(f'pipeline: {lieksika.callback_pipeline.stats()}')
+
+
+def benchmark_word_bundles(n_words=200, bundle_size=10, latency=0.05):
+    logger.info(f'benchmark_word_bundles. words: {n_words}, bundle size: {bundle_size}, '
+                f'Bot API latency: {latency} s')
+    chat_id = 1000
+    with tempfile.TemporaryDirectory() as tmp_dp, FakeBotApiServer(latency=latency) as server:
+        catalog_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        load_test.write_photo_catalog(catalog_fp, 3000)
+        lieksika = load_test.make_bot(server.base_url, catalog_fp, conversation_timeout=600)
+        bot = lieksika.updater.bot
+
+        def single():
+            lieksika._send_photo(bot, chat_id, lieksika.show_word(chat_id)[1])
+            return 1
+
+        def bundle():
+            return lieksika._send_bundle(bot, chat_id, bundle_size)
+
+        logging.disable(logging.INFO)
+        try:
+            for name, send in (('single photo', single), ('album', bundle)):
+                n_calls = sum(server.calls.values())
+                n_sent = 0
+                start = time.perf_counter()
+                while n_sent < n_words:
+                    n_sent += send()
+                elapsed = time.perf_counter() - start
+                n_calls = sum(server.calls.values()) - n_calls
+                logger.info(f'{name}: {n_sent / elapsed:.1f} words/s, {n_calls / n_sent:.2f} API calls per word')
+        finally:
+            logging.disable(logging.NOTSET)
+
+        seen = set()
+        for _ in range(10):
+            word_ixs = lieksika.draw_bundle(chat_id + 1, bundle_size)
+            assert len(set(lieksika.photos_file_ids.orientation(ix) for ix in word_ixs)) == 1
+            assert not seen.intersection(word_ixs), 'words repeat across bundles'
+            seen.update(word_ixs)
+
+
+def benchmark_joke_provider(n_jokes=10, n_requests=1000, latency=0.1):
+    """
+    /joke is answered from the buffer of `JokeProvider`, the jokes server is never waited on. Jokes the server
+    repeats are skipped, the buffer is refilled as it is read. A server slower than the read timeout counts
+    as an error, and /joke answers with the apology while the buffer is empty
+    """
+    logger.info(f'benchmark_joke_provider. jokes on the server: {n_jokes}, /joke requests: {n_requests}, '
+                f'jokes server latency: {latency} s')
+    chat_id = 1000
+    with tempfile.TemporaryDirectory() as tmp_dp, FakeBotApiServer() as server:
+        server.jokes = server.jokes[:n_jokes]
+        server.joke_delay = latency
+        catalog_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        load_test.write_photo_catalog(catalog_fp, 300)
+        lieksika = load_test.make_bot(server.base_url, catalog_fp, conversation_timeout=600)
+        provider = lieksika.joke_provider
+        provider.min_backoff, provider.max_backoff = 0.01, 0.05
+        replies = []
+        server.on_call = lambda method, params: method == 'sendMessage' and replies.append(params['text'])
+
+        def joke():
+            user = {'id': chat_id, 'is_bot': False, 'first_name': f'user_{chat_id}'}
+            update = telegram.Update.de_json({'update_id': 1, 'message': {
+                'message_id': 1, 'date': int(time.time()), 'from': user, 'text': '/joke',
+                'chat': {'id': chat_id, 'type': 'private', 'first_name': user['first_name']}}}, lieksika.updater.bot)
+            lieksika.dad_joke(update, CallbackContext(lieksika.dp))
+            return replies[-1]
+
+        def wait_for(condition, timeout=30):
+            deadline = time.monotonic() + timeout
+            while not condition() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            return condition()
+
+        jokes = {text for _, text in server.jokes}
+        assert joke() not in jokes, 'no apology while the buffer is empty'
+        provider.start()
+        try:
+            # fewer distinct jokes than the buffer holds: the server has to repeat them
+            assert wait_for(lambda: provider.n_fetched == n_jokes and provider.n_duplicates), provider.n_fetched
+            buffered = list(provider._buffer)
+            assert len(buffered) == len(set(buffered)) and set(buffered) <= jokes, 'buffered a repeated joke'
+
+            latencies = []
+            for _ in range(n_requests):
+                start = time.perf_counter()
+                joke()
+                latencies.append(time.perf_counter() - start)
+            p = percentiles(latencies)
+            logger.info(f'/joke: p50: {p[50] * 1e3:.2f} ms, p99: {p[99] * 1e3:.2f} ms, '
+                        f'answered with a joke: {sum(1 for text in replies[-n_requests:] if text in jokes)}')
+            assert len(provider) == 0 and replies[-1] not in jokes, 'no apology after the buffer ran out'
+
+            # new jokes on the server refill the buffer
+            server.jokes = [(f'new_joke_{ix}', f'New joke #{ix}') for ix in range(n_jokes)]
+            assert wait_for(lambda: len(provider) == min(n_jokes, provider._buffer.maxlen)), 'buffer was not refilled'
+            assert joke().startswith('New joke'), replies[-1]
+
+            # the server answers slower than the read timeout
+            provider.timeout = (latency / 4, latency / 4)
+            n_errors = provider.n_errors
+            while len(provider):
+                joke()
+            assert wait_for(lambda: provider.n_errors > n_errors), 'slow jokes server did not time out'
+            start = time.perf_counter()
+            assert joke() not in jokes and time.perf_counter() - start < latency, 'waited for the jokes server'
+            logger.info(f'joke provider: fetched {provider.n_fetched}, duplicates {provider.n_duplicates}, '
+                        f'errors {provider.n_errors}')
+        finally:
+            provider.stop()
+
+
+def _journal_crash_writer(journal_fp, first_k, n_chats, acked):
+    """
+    Put k to chat k % n_chats for k = first_k, first_k + 1, ... until killed. `acked` is the last k
+    that was committed. Runs in a child process
+    """
+    journal = StateJournal(journal_fp, commit_interval=0.01, segment_bytes=64 * 2 ** 10)
+    journal.load()
+    journal.start()
+    for k in itertools.count(first_k):
+        journal.put(0, k % n_chats, 0, (k,))
+        if k % 100 == 99:
+            journal.flush()
+            acked.value = k
+
+
+def check_journal_crashes(journal_fp, n_kills=20, n_chats=1000):
+    """
+    Kill a writer process at random moments, e.g. in the middle of a write or a compaction,
+    and check that every committed change is restored and nothing else is
+    """
+    first_k = 0
+    for _ in range(n_kills):
+        acked = multiprocessing.Value('q', -1)
+        process = multiprocessing.Process(target=_journal_crash_writer, args=(journal_fp, first_k, n_chats, acked))
+        process.start()
+        time.sleep(random.uniform(0.05, 0.3))
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        state = StateJournal(journal_fp).load()
+        values = {chat_id: values[0] for (_, chat_id, _), (values, _) in state.items()}
+        for chat_id, k in values.items():
+            assert k % n_chats == chat_id, f'chat {chat_id} has a value of another chat: {k}'
+        for k in range(max(first_k, acked.value - n_chats + 1), acked.value + 1):
+            assert values.get(k % n_chats, -1) >= k, f'committed change {k} is lost'
+        first_k = max(values.values(), default=-1) + 1
+    logger.info(f'{n_kills} crashes: no committed change lost, no torn record restored. changes: {first_k}')
+
+
+def benchmark_state_journal(n_chats=1_000_000, n_tail=100_000, n_updates=100_000):
+    logger.info(f'benchmark_state_journal. chats: {n_chats}, journal tail: {n_tail}, updates: {n_updates}')
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        check_journal_crashes(os.path.join(tmp_dp, 'crash'))
+
+        # write overhead: what a handler pays to touch its conversation context
+        journal = StateJournal(os.path.join(tmp_dp, 'overhead'))
+        journal.load()
+        journal.start()
+        for name, store in (('no journal', ConversationStore(ttl=600)),
+                            ('journal', ConversationStore(ttl=600, journal=journal))):
+            t0 = time.perf_counter()
+            for ix in range(n_updates):
+                store.get_or_create(ix % 10_000).last_photo_message_id = ix
+            elapsed = time.perf_counter() - t0
+            logger.info(f'{name}: {elapsed / n_updates * 1e6:.2f} us/update')
+        journal.close()
+        logger.info(f'journal: {journal.stats()}, '
+                    f'{journal.n_records / journal.n_commits:.0f} records per fsync')
+
+        # recovery: snapshot of `n_chats` live chats and a journal tail
+        journal_fp = os.path.join(tmp_dp, 'recovery')
+        journal = StateJournal(journal_fp, segment_bytes=2 ** 40)
+        journal.load()
+        t0 = time.perf_counter()
+        for chat_id in range(n_chats):
+            journal.put(0, chat_id, 0, (chat_id, None, None, 1))
+        journal.commit()
+        journal.rotate()
+        journal.compact()
+        for chat_id in range(n_tail):
+            journal.put(0, chat_id, 0, (chat_id + 1, None, None, 1))
+        journal.close()
+        logger.info(f'wrote {n_chats + n_tail} records and compacted in {time.perf_counter() - t0:.1f} s. '
+                    f'snapshot: {os.path.getsize(journal.snapshot_fp) / 2 ** 20:.0f} MB')
+
+        t0 = time.perf_counter()
+        restored = StateJournal(journal_fp).load()
+        loaded_at = time.perf_counter()
+        store = ConversationStore(ttl=600, max_entries=n_chats)
+        store.restore(restored)
+        logger.info(f'recovery of {len(restored)} chats: load {loaded_at - t0:.2f} s, '
+                    f'conversation context {time.perf_counter() - loaded_at:.2f} s')
+        assert store.get(0).last_photo_message_id == 1 and store.get(n_chats - 1).last_photo_message_id == n_chats - 1
+
+
+def _send_spike(bot, n_users, n_replies, n_bulk, n_admin, n_threads, retry_after_sleep):
+    """
+    A traffic spike: users get several replies each, while a broadcast and admin notifications go out
+    :param retry_after_sleep: sleep on RetryAfter and retry once, as the components did on their own
+    :return: (seconds until every message was sent or failed, failed messages)
+    """
+    failed = []
+
+    def send(chat_id, priority):
+        with send_priority(priority):
+            for attempt in range(2):
+                try:
+                    bot.send_message(chat_id, 'benchmark')
+                    return
+                except telegram.error.RetryAfter as e:
+                    if not retry_after_sleep or attempt:
+                        failed.append(chat_id)
+                        return
+                    time.sleep(e.retry_after)
+                except telegram.error.TelegramError:
+                    failed.append(chat_id)
+                    return
+
+    tasks = [(chat_id, None) for _ in range(n_replies) for chat_id in range(1, n_users + 1)]
+    tasks += [(chat_id, PRIORITY_BULK) for chat_id in range(1_000_000, 1_000_000 + n_bulk)]
+    tasks += [(n_users + 1, PRIORITY_ADMIN)] * n_admin
+    random.Random(0).shuffle(tasks)
+    t0 = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        for chat_id, priority in tasks:
+            executor.submit(send, chat_id, 0 if priority is None else priority)
+    return time.perf_counter() - t0, len(failed)
+
+
+def check_scheduled_media_calls(latency=0.0):
+    """
+    Calls with `media` go through an installed scheduler: a single photo of `editMessageMedia`
+    counts as one message, an album as a message per photo
+    """
+    with FakeBotApiServer(latency=latency) as server:
+        bot = make_fake_bot(server)
+        scheduler = BotScheduler(registry=MetricsRegistry()).install(bot).start()
+        try:
+            message = bot.send_photo(1, 'fake_photo')
+            bot.edit_message_media(chat_id=1, message_id=message.message_id,
+                                   media=telegram.InputMediaPhoto(media='fake_photo_2'))
+            bot.send_media_group(2, [telegram.InputMediaPhoto(media=f'fake_photo_{ix}') for ix in range(3)])
+            assert server.calls.get('editMessageMedia') == 1, server.calls
+            assert server.calls.get('sendMediaGroup') == 1, server.calls
+            assert scheduler.stats()['granted'] == 3, scheduler.stats()
+        finally:
+            scheduler.stop()
+    assert call_cost('editMessageMedia', {'type': 'photo', 'media': 'x'}) == 1
+    assert call_cost('sendMediaGroup', [{'type': 'photo', 'media': 'x'}] * 4) == 4
+    assert call_cost('sendMessage', None) == 1
+    logger.info('check_scheduled_media_calls. editMessageMedia and albums pass the scheduler')
+
+
+def check_paced_chat_isolation(n_photos=300, bundle_size=10):
+    """
+    A chat waiting for its turn in the scheduler holds back only its own updates: two `/get 10` of one chat
+    take ~20 s of its pacing, `/get` of another chat sent right after them is answered at once
+    """
+    def command(chat_id, text):
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f'user_{chat_id}'}
+        return {'message': {'message_id': 1, 'date': int(time.time()), 'from': user, 'text': text,
+                            'chat': {'id': chat_id, 'type': 'private', 'first_name': user['first_name']},
+                            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]}}
+
+    answered = {}
+    with tempfile.TemporaryDirectory() as tmp_dp, FakeBotApiServer() as server:
+        photos_file_ids_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        load_test.write_photo_catalog(photos_file_ids_fp, n_photos)
+        bot = load_test.make_bot(server.base_url, photos_file_ids_fp, conversation_timeout=60)
+        bot.metrics_port = 0
+        server.on_answer = lambda chat_id, update_id, latency: answered.setdefault(chat_id, latency)
+        bot.launch()
+        try:
+            server.push_update(command(1, f'/get {bundle_size}'))
+            time.sleep(0.5)
+            server.push_update(command(1, f'/get {bundle_size}'))
+            server.push_update(command(2, '/get'))
+            deadline = time.monotonic() + 5
+            while 2 not in answered and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            bot.updater.stop()
+            bot.shutdown()
+    assert answered.get(2, float('inf')) < 1.0, answered
+    logger.info(f'check_paced_chat_isolation. /get of a chat behind a paced chat answered in {answered[2]:.2f} s')
+
+
+def benchmark_bot_scheduler(n_users=150, n_replies=2, n_bulk=200, n_admin=20, n_threads=64, latency=0.02):
+    check_scheduled_media_calls()
+    check_paced_chat_isolation()
+    n_messages = n_users * n_replies + n_bulk + n_admin
+    logger.info(f'benchmark_bot_scheduler. messages: {n_messages}: {n_replies} replies to {n_users} users, '
+                f'broadcast to {n_bulk} chats, {n_admin} admin notifications')
+    for scheduled in (False, True):
+        with FakeBotApiServer(latency=latency, flood_limits=True) as server:
+            bot = make_fake_bot(server, con_pool_size=n_threads)
+            registry = MetricsRegistry()
+            scheduler = None
+            if scheduled:
+                scheduler = BotScheduler(registry=registry).install(bot).start()
+            elapsed, n_failed = _send_spike(bot, n_users, n_replies, n_bulk, n_admin, n_threads,
+                                            retry_after_sleep=not scheduled)
+            n_sent = server.calls.get('sendMessage', 0) - server.n_flood_errors
+            logger.info(f'{"scheduled" if scheduled else "direct"}: {elapsed:.1f} s, '
+                        f'{n_sent / elapsed:.1f} messages/s, 429 responses: {server.n_flood_errors}, '
+                        f'failed messages: {n_failed}')
+            if scheduler is not None:
+                for name in PRIORITY_NAMES:
+                    histogram = registry.histogram('bot_queue', name)
+                    snapshot = histogram.snapshot()
+                    logger.info(f'{name}: queue wait p50: {histogram.quantile(snapshot, 0.5):.2f} s, '
+                                f'p99: {histogram.quantile(snapshot, 0.99):.2f} s')
+                logger.info(f'scheduler: {scheduler.stats()}')
+                scheduler.stop()
+                assert n_failed == 0, n_failed
+
+
+def benchmark_word_weights(n_words=1_000_000, n_events=1_000_000, n_draws=1_000_000, n_threads=4):
+    import numpy as np
+
+    logger.info(f'benchmark_word_weights. words: {n_words}, reactions: {n_events}, draws: {n_draws}')
+    rng = np.random.default_rng(0)
+    counters = EngagementCounters(n_words)
+    # a tenth of the words is disliked: skipped 4 times out of 5
+    disliked = rng.random(n_words) < 0.1
+    word_ixs = rng.integers(0, n_words, n_events).tolist()
+    skips = (rng.random(n_events) < np.where(disliked, 0.8, 0.2)[word_ixs]).tolist()
+    t0 = time.perf_counter()
+    for ix, skip in zip(word_ixs, skips):
+        counters.record(SHOWN, ix)
+        counters.record(SKIPPED if skip else ACCEPTED, ix)
+    logger.info(f'record: {(time.perf_counter() - t0) / (2 * n_events) * 1e6:.2f} us')
+
+    weights = counters.weights()
+    t0 = time.perf_counter()
+    table = AliasTable(weights)
+    logger.info(f'alias table build: {time.perf_counter() - t0:.3f} s, '
+                f'max probability error: {np.abs(table.probabilities() - table.p).max():.1e}')
+    small = AliasTable(weights[:100])
+    frequencies = np.bincount(small.draw_many(10_000_000, rng), minlength=100) / 10_000_000
+    logger.info(f'100 words, 10M draws: max frequency error: {np.abs(frequencies - small.p).max():.1e}')
+    assert np.abs(frequencies - small.p).max() < 1e-3
+
+    sampler = EngagementSampler(counters)
+    t0 = time.perf_counter()
+    for _ in range(n_draws):
+        sampler.draw()
+    logger.info(f'draw: {(time.perf_counter() - t0) / n_draws * 1e9:.0f} ns, 1 thread')
+    t0 = time.perf_counter()
+    table.draw_many(10 * n_draws, rng)
+    logger.info(f'draw_many: {(time.perf_counter() - t0) / (10 * n_draws) * 1e9:.1f} ns per draw')
+
+    def draw_loop(n):
+        for _ in range(n):
+            sampler.draw()
+
+    # draws go on while the tables are rebuilt: the rebuild never blocks them
+    for ix in word_ixs[:n_events // 10]:
+        counters.record(SKIPPED, ix)
+    threads = [threading.Thread(target=draw_loop, args=(n_draws // n_threads,)) for _ in range(n_threads)]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    rebuild_start = time.perf_counter()
+    drift = sampler.drift()
+    n_rebuilt = sampler.rebuild_if_drifted()
+    rebuild_elapsed = time.perf_counter() - rebuild_start
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+    logger.info(f'{n_threads} threads: {n_draws / elapsed / 1e6:.2f}M draws/s during a rebuild. '
+                f'drift: {drift:.3f}, rebuilt: {n_rebuilt}, rebuild: {rebuild_elapsed:.3f} s')
+    t0 = time.perf_counter()
+    assert sampler.rebuild_if_drifted() == 0
+    logger.info(f'drift check without rebuild: {time.perf_counter() - t0:.3f} s')
+
+
+def benchmark_conversation_timeouts(n_conversations=100_000, n_rearms=3, timeout=600, n_expire=20_000):
+    logger.info(f'benchmark_conversation_timeouts. conversations: {n_conversations}, '
+                f're-arms per conversation: {n_rearms}')
+    with warnings.catch_warnings():
+        # a bot instead of a dispatcher: callbacks get (bot, job), enough for the benchmark
+        warnings.simplefilter('ignore')
+        job_queue = JobQueue(bot=object())
+    # as ConversationHandler does: a job per conversation, removed and scheduled again on every update
+    t0 = time.perf_counter()
+    jobs = [job_queue.run_once(lambda bot, job: None, timeout) for _ in range(n_conversations)]
+    armed_at = time.perf_counter()
+    for _ in range(n_rearms):
+        for ix in range(n_conversations):
+            jobs[ix].schedule_removal()
+            jobs[ix] = job_queue.run_once(lambda bot, job: None, timeout)
+    elapsed = time.perf_counter() - armed_at
+    logger.info(f'JobQueue: arm: {(armed_at - t0) / n_conversations * 1e6:.2f} us, '
+                f're-arm: {elapsed / (n_conversations * n_rearms) * 1e6:.2f} us, '
+                f'jobs in the heap: {job_queue._queue.qsize()}')
+
+    timeouts = ConversationTimeouts(bot=None)
+    handler = type('Handler', (), {'name': 'get_word'})()
+    t0 = time.perf_counter()
+    for chat_id in range(n_conversations):
+        timeouts.arm(handler, (chat_id, chat_id), timeout)
+    armed_at = time.perf_counter()
+    for _ in range(n_rearms):
+        for chat_id in range(n_conversations):
+            timeouts.arm(handler, (chat_id, chat_id), timeout)
+    elapsed = time.perf_counter() - armed_at
+    logger.info(f'timer wheel: arm: {(armed_at - t0) / n_conversations * 1e6:.2f} us, '
+                f're-arm: {elapsed / (n_conversations * n_rearms) * 1e6:.2f} us, timers: {len(timeouts.wheel)}')
+
+    # expiry: all conversations time out within the same minute
+    fired = []
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        job_queue = JobQueue(bot=object())
+    for _ in range(n_expire):
+        job_queue.run_once(lambda bot, job: fired.append(1), 0.5)
+    t0 = time.perf_counter()
+    job_queue.start()
+    while len(fired) < n_expire:
+        time.sleep(0.01)
+    job_queue.stop()
+    logger.info(f'JobQueue: expired {n_expire} in {time.perf_counter() - t0 - 0.5:.2f} s after the first was due')
+
+    clock = [0.0]
+    wheel = TimerWheel(clock=lambda: clock[0])
+    for chat_id in range(n_expire):
+        wheel.arm(chat_id, timeout - 60 + chat_id * 60 / n_expire)
+    t0 = time.perf_counter()
+    n_expired = 0
+    for second in range(timeout + 1):
+        clock[0] = second
+        n_expired += len(wheel.advance())
+    elapsed = time.perf_counter() - t0
+    logger.info(f'timer wheel: expired {n_expired} in {elapsed:.3f} s of ticking, '
+                f'{n_expired / elapsed / 1e6:.2f}M timers/s')
+    assert n_expired == n_expire
+
+
+# run in a fresh interpreter per mode, so RSS of one mode does not include the heap left by the other
+ASYNC_DISPATCH_CODE = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import load_test
+
+events_fp, latency, use_asyncio = sys.argv[2], float(sys.argv[3]), sys.argv[4] == '1'
+report = load_test.run_load_test(load_test.read_events(events_fp), 'polling', latency, answer_timeout=600,
+                                 use_asyncio=use_asyncio, global_rate=10_000)
+report['rss_mb'] = load_test.rss_bytes() / 2 ** 20
+print(json.dumps(report))
+'''
+
+
+def check_async_webhook(max_update_size=1024, max_header_size=1024):
+    """
+    The webhook of the asyncio mode takes updates posted to its path only,
+    malformed and oversized requests are rejected before they reach `ChatLanes`
+    """
+    received = []
+
+    async def handle(api, update):
+        received.append(update)
+        return True
+
+    def post(path, **kwargs):
+        try:
+            return requests.post(f'http://127.0.0.1:{port}/{path}', timeout=5, **kwargs).status_code
+        except requests.ConnectionError:
+            # the server may close the connection before the whole request is sent
+            return None
+
+    port = load_test.free_port()
+    dispatcher = AsyncDispatcher('http://127.0.0.1:1/bot123456:fake', handle, lambda update: None,
+                                 max_update_size=max_update_size, max_header_size=max_header_size)
+    dispatcher.start_webhook('127.0.0.1', port, '123456:fake')
+    try:
+        assert post('123456:fake', json={'update_id': 1}) == 200
+        assert post('123456:fake', data=b'{') == 400
+        assert post('other', json={'update_id': 2}) == 404
+        assert post('123456:fake', data=b'{"update_id": 3, "x": "' + b'x' * max_update_size + b'"}') in (400, None)
+        assert post('123456:fake', json={'update_id': 4}, headers={'X-Padding': 'x' * max_header_size}) != 200
+        assert requests.get(f'http://127.0.0.1:{port}/123456:fake', timeout=5).status_code == 405
+    finally:
+        dispatcher.stop()
+    assert received == [{'update_id': 1}], received
+    logger.info('check_async_webhook. malformed, oversized and misdirected requests are rejected')
+
+
+def benchmark_async_dispatch(n_updates=1000, n_users=500, latency=0.05):
+    logger.info(f'benchmark_async_dispatch. updates: {n_updates}, users: {n_users}, Bot API latency: {latency} s')
+    check_async_webhook()
+    repo_dp = os.path.dirname(os.path.abspath(__file__))
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmp_dp:
+        events_fp = os.path.join(tmp_dp, 'events.jsonl')
+        load_test.write_events(events_fp, load_test.generate_events(n_updates, n_users, seed=0))
+        for mode, use_asyncio in (('threaded', '0'), ('asyncio', '1')):
+            out = subprocess.run([sys.executable, '-c', ASYNC_DISPATCH_CODE, repo_dp, events_fp, str(latency),
+                                  use_asyncio], cwd=tmp_dp, check=True, stdout=subprocess.PIPE).stdout
+            report = reports[mode] = json.loads(out.decode().strip().splitlines()[-1])
+            logger.info(f'{mode}: {report["updates_per_second"]} updates/s, p50: {report["p50_ms"]} ms, '
+                        f'p99: {report["p99_ms"]} ms, lost: {report["lost"]}, '
+                        f'Bot API calls in flight: {report["peak_bot_api_calls"]}, RSS: {report["rss_mb"]:.1f} MB')
+    logger.info(f'asyncio lanes: {reports["asyncio"]["asyncio"]}')
+    threaded, asyncio_ = reports['threaded'], reports['asyncio']
+    logger.info(f'asyncio vs threaded: x{asyncio_["peak_bot_api_calls"] / threaded["peak_bot_api_calls"]:.1f} '
+                f'calls in flight, x{asyncio_["updates_per_second"] / threaded["updates_per_second"]:.1f} '
+                f'throughput, RSS {asyncio_["rss_mb"] - threaded["rss_mb"]:+.1f} MB')
+
+
+BENCHMARKS = {
+    'word_sampler': benchmark_word_sampler,
+    'photo_upload': benchmark_photo_upload,
+    'photo_preprocessing': benchmark_photo_preprocessing,
+    'photo_dedup': benchmark_photo_dedup,
+    'broadcast': benchmark_broadcast,
+    'review_scheduler': benchmark_review_scheduler,
+    'word_index': benchmark_word_index,
+    'inline_query': benchmark_inline_query,
+    'error_reporter': benchmark_error_reporter,
+    'metrics': benchmark_metrics,
+    'logging': benchmark_logging,
+    'page_ingest': benchmark_page_ingest,
+    'bot_load': benchmark_bot_load,
+    'webhook_scaling': benchmark_webhook_scaling,
+    'photo_catalog': benchmark_photo_catalog,
+    'callback_pipeline': benchmark_callback_pipeline,
+    'word_bundles': benchmark_word_bundles,
+    'joke_provider': benchmark_joke_provider,
+    'state_journal': benchmark_state_journal,
+    'bot_scheduler': benchmark_bot_scheduler,
+    'word_weights': benchmark_word_weights,
+    'conversation_timeouts': benchmark_conversation_timeouts,
+    'async_dispatch': benchmark_async_dispatch,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LieksikaBot benchmarks')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run: {", ".join(BENCHMARKS)}. '
+                                                 f'run all if not specified')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
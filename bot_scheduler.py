@@ -0,0 +1,415 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+from telegram.error import RetryAfter, TelegramError
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# lower value goes first
+PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITY_ADMIN = range(3)
+PRIORITY_NAMES = ('interactive', 'bulk', 'admin')
+
+# Bot API methods counted by Telegram flood limits. other calls, e.g. answerCallbackQuery, are not delayed
+LIMITED_METHODS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendMediaGroup', 'sendDocument', 'sendAudio', 'sendVideo', 'sendAnimation',
+    'sendVoice', 'sendSticker', 'sendLocation', 'sendContact', 'sendPoll', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup',
+})
+
+_local = threading.local()
+
+
+def call_cost(method, media):
+    """
+    :param media: `media` parameter of the call: a list of photos of an album, a single one of `editMessageMedia`
+    :return: messages the call counts as. an album counts as a message per photo
+    """
+    if method == 'sendMediaGroup' and isinstance(media, (list, tuple)) and media:
+        return len(media)
+    return 1
+
+
+@contextmanager
+def send_priority(priority):
+    """
+    Bot API calls made by the current thread inside the block are scheduled with `priority`.
+    Calls outside of any block are `PRIORITY_INTERACTIVE`
+    """
+    previous = getattr(_local, 'priority', PRIORITY_INTERACTIVE)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class SchedulerOverloaded(TelegramError):
+    """
+    The call was shed: the queue is full of calls of the same or higher priority, or the call waited too long
+    """
+
+
+class _Ticket:
+    __slots__ = ('chat_id', 'priority', 'cost', 'seq', 'enqueued_at', 'event', 'future', 'state')
+
+    WAITING, GRANTED, SHED = range(3)
+
+    def __init__(self, chat_id, priority, cost, seq, enqueued_at, future=None):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.cost = cost
+        self.seq = seq
+        self.enqueued_at = enqueued_at
+        # callers of the asyncio mode wait on the future instead of blocking the event loop
+        self.event = threading.Event() if future is None else None
+        self.future = future
+        self.state = self.WAITING
+
+    def wake(self):
+        if self.future is None:
+            self.event.set()
+        else:
+            self.future.get_loop().call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        # the caller may have given up waiting already
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class BotScheduler:
+    """
+    Paces outbound Bot API calls to stay within Telegram flood limits: ~30 messages per second overall,
+    ~1 per second to a chat and 20 per minute to a group.
+
+    `install` wraps the request of the bot, so every call goes through the scheduler whoever makes it.
+    The calling thread waits for its turn and makes the call itself, coroutines of the asyncio mode wait
+    with `admit_async` without blocking the event loop. Turns are given by a dispatcher thread:
+    - every chat is limited by GCRA, a token bucket kept as a single "theoretical arrival time" per chat.
+      Calls to a chat go out in FIFO order;
+    - chats that have to wait are put to a hashed timing wheel: slots of `tick` seconds, so the dispatcher
+      only looks at the chats that become ready, not at all waiting chats;
+    - ready chats are taken by priority of their next call, then in arrival order, while the global
+      bucket has tokens.
+    `RetryAfter` is handled centrally: the chat is paused for `retry_after` seconds, and so is the whole bot
+    when several chats get it at once. The call is then retried up to `max_retries` times.
+    When `max_queued` calls wait, the oldest call of a lower priority is shed, or the new one if there is none.
+    Calls waiting longer than `max_wait` of their priority are shed as well: a late reply is useless.
+    Shed calls raise `SchedulerOverloaded`.
+    """
+
+    def __init__(self, global_rate=25, global_burst=5, chat_rate=1.0, chat_burst=3, group_rate=20 / 60,
+                 group_burst=3, max_queued=10_000, max_wait=(30, 300, 600), max_retries=3, max_chats=100_000,
+                 tick=0.01, n_slots=512, registry=REGISTRY, clock=time.monotonic):
+        """
+        :param max_wait: seconds a call may wait for its turn, by priority
+        :param max_chats: chats to remember the limits of. least recently used ones are forgotten
+        """
+        self.global_interval = 1 / global_rate
+        self.global_tolerance = (global_burst - 1) * self.global_interval
+        self.chat_interval = 1 / chat_rate
+        self.chat_tolerance = (chat_burst - 1) * self.chat_interval
+        self.group_interval = 1 / group_rate
+        self.group_tolerance = (group_burst - 1) * self.group_interval
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.tick = tick
+        self.clock = clock
+        self.wait_histograms = [registry.histogram('bot_queue', name) for name in PRIORITY_NAMES]
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        # chat_id -> theoretical arrival time of the next call
+        self._tats = OrderedDict()
+        self._global_tat = 0.0
+        # chat_id -> waiting tickets, only chats with waiting calls
+        self._queues = {}
+        # chats in `_ready` or in the wheel
+        self._scheduled = set()
+        # (priority, seq, chat_id) of chats that may send now
+        self._ready = []
+        # slot -> [(due tick, chat_id)]
+        self._wheel = [[] for _ in range(n_slots)]
+        self._wheel_tick = int(clock() / tick)
+        # priority -> tickets in arrival order, to find the oldest one to shed
+        self._by_priority = [deque() for _ in PRIORITY_NAMES]
+        self._n_waiting = 0
+        # (time, chat_id) of recent RetryAfter errors
+        self._recent_flood = deque()
+
+        self._stopped = False
+        self._thread = None
+
+        self.n_granted = 0
+        self.n_shed = 0
+        self.n_retry_after = 0
+        self.n_global_pauses = 0
+
+    def install(self, bot):
+        """
+        Schedule every call made through `bot`
+        :return: the scheduler
+        """
+        request = bot.request
+        post = request.post
+
+        @wraps(post)
+        def scheduled_post(url, data, *args, **kwargs):
+            method = url.rsplit('/', 1)[-1]
+            if method not in LIMITED_METHODS:
+                return post(url, data, *args, **kwargs)
+            chat_id = data.get('chat_id')
+            cost = call_cost(method, data.get('media'))
+            priority = getattr(_local, 'priority', PRIORITY_INTERACTIVE)
+            for attempt in range(self.max_retries + 1):
+                self.admit(chat_id, priority, cost)
+                try:
+                    return post(url, data, *args, **kwargs)
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.on_retry_after(chat_id, e.retry_after)
+
+        request.post = scheduled_post
+        return self
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stopped = False
+        self._thread = threading.Thread(target=self._dispatch_loop, name='BotScheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop pacing: waiting calls are let through
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        with self._cond:
+            for tickets in self._queues.values():
+                for ticket in tickets:
+                    self._grant(ticket, self.clock())
+            self._queues.clear()
+
+    def stats(self):
+        with self._cond:
+            return {'waiting': self._n_waiting, 'chats_waiting': len(self._queues), 'granted': self.n_granted,
+                    'shed': self.n_shed, 'retry_after': self.n_retry_after, 'global_pauses': self.n_global_pauses}
+
+    # -------------- callers --------------
+
+    def admit(self, chat_id, priority=PRIORITY_INTERACTIVE, cost=1):
+        """
+        Wait until a call to the chat is allowed. Returns at once if the scheduler is not started
+        :raises SchedulerOverloaded: if the call was shed
+        """
+        if self._thread is None:
+            return
+        ticket = self._enqueue(chat_id, priority, cost)
+        if not ticket.event.wait(self.max_wait[priority]):
+            self._give_up(ticket)
+        self._check_granted(ticket)
+
+    async def admit_async(self, chat_id, priority=PRIORITY_INTERACTIVE, cost=1):
+        """
+        `admit` for coroutines: the event loop goes on with other calls while this one waits for its turn
+        """
+        if self._thread is None:
+            return
+        ticket = self._enqueue(chat_id, priority, cost, asyncio.get_running_loop().create_future())
+        try:
+            await asyncio.wait_for(ticket.future, self.max_wait[priority])
+        except asyncio.TimeoutError:
+            self._give_up(ticket)
+        self._check_granted(ticket)
+
+    def _enqueue(self, chat_id, priority, cost, future=None):
+        with self._cond:
+            now = self.clock()
+            ticket = _Ticket(chat_id, priority, cost, next(self._seq), now, future)
+            if self._n_waiting >= self.max_queued and not self._shed_lower(priority):
+                self.n_shed += 1
+                self.wait_histograms[priority].observe(0.0, error=True)
+                raise SchedulerOverloaded(f'Bot API queue is full: {self._n_waiting} calls wait')
+            self._n_waiting += 1
+            self._by_priority[priority].append(ticket)
+            tickets = self._queues.get(chat_id)
+            if tickets is None:
+                self._queues[chat_id] = deque([ticket])
+                self._schedule_chat(chat_id, now)
+            else:
+                tickets.append(ticket)
+            self._cond.notify()
+        return ticket
+
+    def _give_up(self, ticket):
+        with self._cond:
+            if ticket.state == _Ticket.WAITING:
+                self._shed(ticket)
+
+    def _check_granted(self, ticket):
+        if ticket.state == _Ticket.SHED:
+            raise SchedulerOverloaded(f'Bot API call to chat {ticket.chat_id} was shed after '
+                                      f'{self.clock() - ticket.enqueued_at:.1f} s in the queue')
+
+    def on_retry_after(self, chat_id, retry_after):
+        """
+        Pause the chat for `retry_after` seconds. Flood errors in several chats at once pause all chats
+        """
+        with self._cond:
+            now = self.clock()
+            self.n_retry_after += 1
+            interval, tolerance = self._chat_limits(chat_id)
+            self._tats[chat_id] = max(self._tats.get(chat_id, now), now + retry_after + tolerance)
+            self._recent_flood.append((now, chat_id))
+            while self._recent_flood and self._recent_flood[0][0] < now - 1:
+                self._recent_flood.popleft()
+            if chat_id is None or len({x for _, x in self._recent_flood}) >= 3:
+                logger.warning(f'BotScheduler. flood control exceeded. pausing all chats for {retry_after} s')
+                self._global_tat = max(self._global_tat, now + retry_after + self.global_tolerance)
+                self.n_global_pauses += 1
+            else:
+                logger.warning(f'BotScheduler. flood control exceeded in chat {chat_id}. '
+                               f'pausing it for {retry_after} s')
+
+    # -------------- limits --------------
+
+    def _chat_limits(self, chat_id):
+        """
+        :return: (interval, tolerance) of GCRA of the chat
+        """
+        if isinstance(chat_id, int) and chat_id < 0:
+            return self.group_interval, self.group_tolerance
+        return self.chat_interval, self.chat_tolerance
+
+    def _chat_allowed_at(self, chat_id, now):
+        tat = self._tats.get(chat_id)
+        if tat is None:
+            return now
+        return tat - self._chat_limits(chat_id)[1]
+
+    def _charge(self, ticket, now):
+        interval, _ = self._chat_limits(ticket.chat_id)
+        self._tats[ticket.chat_id] = max(self._tats.pop(ticket.chat_id, now), now) + ticket.cost * interval
+        if len(self._tats) > self.max_chats:
+            self._tats.popitem(last=False)
+        self._global_tat = max(self._global_tat, now) + ticket.cost * self.global_interval
+
+    # -------------- queues --------------
+
+    def _schedule_chat(self, chat_id, now):
+        if chat_id in self._scheduled:
+            return
+        self._scheduled.add(chat_id)
+        allowed_at = self._chat_allowed_at(chat_id, now)
+        if allowed_at <= now:
+            head = self._queues[chat_id][0]
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            due_tick = int(allowed_at / self.tick) + 1
+            self._wheel[due_tick % len(self._wheel)].append((due_tick, chat_id))
+
+    def _advance_wheel(self, now):
+        current = int(now / self.tick)
+        n_slots = len(self._wheel)
+        for tick in range(max(self._wheel_tick + 1, current - n_slots + 1), current + 1):
+            slot = self._wheel[tick % n_slots]
+            if not slot:
+                continue
+            # entries of later rounds stay in the slot
+            self._wheel[tick % n_slots] = [x for x in slot if x[0] > current]
+            for due_tick, chat_id in slot:
+                if due_tick <= current:
+                    self._scheduled.discard(chat_id)
+                    if chat_id in self._queues:
+                        self._schedule_chat(chat_id, now)
+        self._wheel_tick = current
+
+    def _grant(self, ticket, now):
+        ticket.state = _Ticket.GRANTED
+        self._n_waiting -= 1
+        self.n_granted += 1
+        self.wait_histograms[ticket.priority].observe(now - ticket.enqueued_at)
+        ticket.wake()
+
+    def _shed(self, ticket):
+        ticket.state = _Ticket.SHED
+        self._n_waiting -= 1
+        self.n_shed += 1
+        self.wait_histograms[ticket.priority].observe(self.clock() - ticket.enqueued_at, error=True)
+        tickets = self._queues.get(ticket.chat_id)
+        if tickets is not None:
+            tickets.remove(ticket)
+            if not tickets:
+                # the chat may still be in `_ready` or in the wheel: skipped when taken from there
+                del self._queues[ticket.chat_id]
+        ticket.wake()
+
+    def _shed_lower(self, priority):
+        """
+        Shed the oldest waiting call of the lowest priority below `priority`
+        :return: False if there is no such call
+        """
+        for lower in range(len(PRIORITY_NAMES) - 1, priority, -1):
+            tickets = self._by_priority[lower]
+            while tickets:
+                ticket = tickets.popleft()
+                if ticket.state == _Ticket.WAITING:
+                    logger.warning(f'BotScheduler. queue is full. shedding a {PRIORITY_NAMES[lower]} call')
+                    self._shed(ticket)
+                    return True
+        return False
+
+    # -------------- dispatcher thread --------------
+
+    def _dispatch_loop(self):
+        with self._cond:
+            while not self._stopped:
+                now = self.clock()
+                self._advance_wheel(now)
+                while self._ready and self._global_tat - self.global_tolerance <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    self._scheduled.discard(chat_id)
+                    tickets = self._queues.get(chat_id)
+                    if not tickets:
+                        continue
+                    if self._chat_allowed_at(chat_id, now) > now:
+                        # paused by RetryAfter while it was ready
+                        self._schedule_chat(chat_id, now)
+                        continue
+                    ticket = tickets.popleft()
+                    self._charge(ticket, now)
+                    self._grant(ticket, now)
+                    if tickets:
+                        self._schedule_chat(chat_id, now)
+                    else:
+                        del self._queues[chat_id]
+                for tickets in self._by_priority:
+                    # granted tickets are dropped lazily, keep the deques short
+                    while tickets and tickets[0].state != _Ticket.WAITING:
+                        tickets.popleft()
+                if self._ready:
+                    timeout = max(self._global_tat - self.global_tolerance - now, 0.001)
+                elif self._scheduled:
+                    timeout = self.tick
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
@@ -0,0 +1,282 @@
+import concurrent.futures
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+
+from bot_scheduler import PRIORITY_BULK, send_priority
+from rate_limiter import PerKeyThrottle, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class SubscriberRegistry:
+    """
+    Subscribers of the daily words broadcast and checkpoints of broadcast runs, stored in sqlite.
+    Delivery time is stored as minute of the day in UTC.
+    Workers of the sharded mode share the database, writers wait for each other up to `busy_timeout` seconds
+    """
+
+    def __init__(self, db_fp, busy_timeout=30):
+        self.db_fp = db_fp
+        self._conn = sqlite3.connect(db_fp, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS subscribers ('
+                               'chat_id INTEGER PRIMARY KEY, delivery_minute INTEGER NOT NULL, '
+                               'subscribed_at REAL NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS subscribers_delivery '
+                               'ON subscribers (delivery_minute, chat_id)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS broadcast_checkpoints ('
+                               'run_key TEXT NOT NULL, shard INTEGER NOT NULL, last_chat_id INTEGER NOT NULL, '
+                               'done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (run_key, shard))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS broadcast_runs ('
+                               'run_key TEXT PRIMARY KEY, finished_at REAL, sent INTEGER, failed INTEGER, '
+                               'pruned INTEGER, elapsed REAL)')
+
+    def subscribe(self, chat_id, delivery_minute):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO subscribers VALUES (?, ?, ?)',
+                               (chat_id, delivery_minute % MINUTES_PER_DAY, time.time()))
+
+    def subscribe_many(self, rows):
+        """
+        :param rows: iterable of (chat_id, delivery_minute)
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO subscribers VALUES (?, ?, ?)',
+                                   ((chat_id, minute % MINUTES_PER_DAY, now) for chat_id, minute in rows))
+            self._conn.execute('COMMIT')
+
+    def unsubscribe(self, chat_id):
+        """
+        :return: True if the chat was subscribed
+        """
+        with self._lock:
+            return self._conn.execute('DELETE FROM subscribers WHERE chat_id = ?', (chat_id,)).rowcount > 0
+
+    def get_delivery_minute(self, chat_id):
+        with self._lock:
+            row = self._conn.execute('SELECT delivery_minute FROM subscribers WHERE chat_id = ?',
+                                     (chat_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM subscribers').fetchone()[0]
+
+    def iter_bucket(self, minute_from, minute_to, n_shards, shard, after_chat_id, page_size=1000):
+        """
+        Iterate chat_ids of a shard with delivery time in [minute_from, minute_to) ordered by chat_id
+        """
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT chat_id FROM subscribers WHERE delivery_minute >= ? AND delivery_minute < ? '
+                    'AND chat_id > ? AND abs(chat_id) % ? = ? ORDER BY chat_id LIMIT ?',
+                    (minute_from, minute_to, after_chat_id, n_shards, shard, page_size)).fetchall()
+            if not rows:
+                return
+            for (chat_id,) in rows:
+                yield chat_id
+            after_chat_id = rows[-1][0]
+
+    def get_checkpoint(self, run_key, shard):
+        """
+        :return: (last processed chat_id, done flag)
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT last_chat_id, done FROM broadcast_checkpoints '
+                                     'WHERE run_key = ? AND shard = ?', (run_key, shard)).fetchone()
+        return (-(1 << 63), False) if row is None else (row[0], bool(row[1]))
+
+    def set_checkpoint(self, run_key, shard, last_chat_id, done=False):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO broadcast_checkpoints VALUES (?, ?, ?, ?)',
+                               (run_key, shard, last_chat_id, int(done)))
+
+    def is_run_finished(self, run_key):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM broadcast_runs WHERE run_key = ?',
+                                      (run_key,)).fetchone() is not None
+
+    def finish_run(self, run_key, metrics):
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.execute('INSERT OR REPLACE INTO broadcast_runs VALUES (?, ?, ?, ?, ?, ?)',
+                               (run_key, time.time(), metrics.sent, metrics.failed, metrics.pruned,
+                                metrics.elapsed))
+            self._conn.execute('DELETE FROM broadcast_checkpoints WHERE run_key = ?', (run_key,))
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class BroadcastMetrics:
+    __slots__ = ('sent', 'failed', 'pruned', 'started_at', 'elapsed', '_lock')
+
+    def __init__(self):
+        self.sent = self.failed = self.pruned = 0
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, sent=0, failed=0, pruned=0):
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            self.pruned += pruned
+
+    def __str__(self):
+        rate = self.sent / self.elapsed if self.elapsed else 0.0
+        return (f'sent: {self.sent}, failed: {self.failed}, pruned: {self.pruned}, '
+                f'elapsed: {self.elapsed:.1f} s, {rate:.1f} msg/s')
+
+
+class Broadcaster:
+    """
+    Sends a word to every subscriber once a day at their delivery time.
+
+    The day is split into buckets of `bucket_minutes`. A run delivers words to the subscribers of one bucket:
+    they are split into `n_shards` shards by chat_id, shards are sent in parallel through a global
+    token bucket and a per-chat throttle. Every shard checkpoints the last processed chat_id,
+    so a restarted run continues where it stopped instead of sending twice or skipping chats.
+    Chats that blocked the bot are removed from subscribers.
+    """
+
+    def __init__(self, bot, registry, show_word, caption=None, bucket_minutes=15, n_shards=8,
+                 global_rate=30, per_chat_interval=1.0, max_catch_up_buckets=4, max_retries=3):
+        """
+        :param show_word: callable chat_id -> (word index, photo file_id), e.g. `LieksikaBot.show_word`
+        :param max_catch_up_buckets: number of missed buckets to deliver after a restart
+        """
+        if MINUTES_PER_DAY % bucket_minutes:
+            raise ValueError(f'bucket_minutes must divide the day evenly, got {bucket_minutes}')
+        self.bot = bot
+        self.registry = registry
+        self.show_word = show_word
+        self.caption = caption
+        self.bucket_minutes = bucket_minutes
+        self.n_shards = n_shards
+        self.max_catch_up_buckets = max_catch_up_buckets
+        self.max_retries = max_retries
+
+        self.global_limiter = TokenBucket(global_rate)
+        self.chat_throttle = PerKeyThrottle(per_chat_interval)
+
+        self._thread = None
+        self._lock = threading.Lock()
+        self.last_metrics = None
+
+    @staticmethod
+    def now():
+        return datetime.datetime.utcnow()
+
+    def run_key(self, day, bucket):
+        return f'{day.isoformat()}/{bucket}'
+
+    def due_runs(self, now=None):
+        """
+        :return: list of (run_key, bucket) that are due and not finished yet, oldest first
+        """
+        now = now or self.now()
+        current_bucket = (now.hour * 60 + now.minute) // self.bucket_minutes
+        runs = []
+        for lag in range(self.max_catch_up_buckets, -1, -1):
+            bucket = current_bucket - lag
+            day = now.date()
+            if bucket < 0:
+                bucket += MINUTES_PER_DAY // self.bucket_minutes
+                day -= datetime.timedelta(days=1)
+            run_key = self.run_key(day, bucket)
+            if not self.registry.is_run_finished(run_key):
+                runs.append((run_key, bucket))
+        return runs
+
+    def start_due_runs(self, context=None):
+        """
+        Start delivering due buckets in a background thread, so the JobQueue is not blocked.
+        Can be used as a JobQueue callback
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                logger.info('Broadcaster. previous runs are still in progress')
+                return
+            self._thread = threading.Thread(target=self.run_due, name='Broadcaster', daemon=True)
+            self._thread.start()
+
+    def run_due(self):
+        for run_key, bucket in self.due_runs():
+            self.run(run_key, bucket)
+
+    def run(self, run_key, bucket):
+        minute_from = bucket * self.bucket_minutes
+        minute_to = minute_from + self.bucket_minutes
+        metrics = BroadcastMetrics()
+        logger.info(f'Broadcaster. starting run {run_key}, delivery minutes: [{minute_from}, {minute_to})')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.n_shards) as executor:
+            futures = [executor.submit(self._run_shard, run_key, minute_from, minute_to, shard, metrics)
+                       for shard in range(self.n_shards)]
+            for future in futures:
+                future.result()
+
+        metrics.elapsed = time.perf_counter() - metrics.started_at
+        self.registry.finish_run(run_key, metrics)
+        self.last_metrics = metrics
+        logger.info(f'Broadcaster. finished run {run_key}. {metrics}')
+        return metrics
+
+    def _run_shard(self, run_key, minute_from, minute_to, shard, metrics):
+        last_chat_id, done = self.registry.get_checkpoint(run_key, shard)
+        if done:
+            return
+        for chat_id in self.registry.iter_bucket(minute_from, minute_to, self.n_shards, shard, last_chat_id):
+            metrics.add(**self._deliver(chat_id))
+            self.registry.set_checkpoint(run_key, shard, chat_id)
+            last_chat_id = chat_id
+        self.registry.set_checkpoint(run_key, shard, last_chat_id, done=True)
+
+    def _deliver(self, chat_id):
+        """
+        :return: dict with metrics increments
+        """
+        for attempt in range(self.max_retries + 1):
+            self.global_limiter.acquire()
+            wait = self.chat_throttle.reserve(chat_id)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with send_priority(PRIORITY_BULK):
+                    _, photo = self.show_word(chat_id)
+                    self.bot.send_photo(chat_id, photo=photo, caption=self.caption)
+                return {'sent': 1}
+            except RetryAfter as e:
+                logger.warning(f'Broadcaster. flood control exceeded. pausing for {e.retry_after} s')
+                self.global_limiter.pause(e.retry_after)
+            except Unauthorized as e:
+                # bot was blocked by the user or the user was deactivated
+                logger.info(f'Broadcaster. pruning chat_id: {chat_id}: {e}')
+                self.registry.unsubscribe(chat_id)
+                return {'pruned': 1}
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    self.registry.unsubscribe(chat_id)
+                    return {'pruned': 1}
+                logger.error(f'Broadcaster. failed to deliver to chat_id: {chat_id}: {e}')
+                return {'failed': 1}
+            except TelegramError as e:
+                logger.error(f'Broadcaster. failed to deliver to chat_id: {chat_id}: {e}')
+                time.sleep(min(2 ** attempt, 10))
+        return {'failed': 1}
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class CallbackPipeline:
+    """
+    Takes Bot API calls the user does not wait for off the critical path of handlers.
+
+    Callback queries are answered by a small thread pool, so the button spinner clears after a single
+    round trip while the handler makes its main call (e.g. `send_photo`) in parallel.
+    Inline keyboards of previous messages are stripped by a background thread. Pending removals are keyed
+    by (chat_id, message_id), so repeated cleanups of the same message collapse into one edit,
+    and the queue is drained at `edits_per_second` to leave the Bot API budget to handlers.
+    When `max_pending` removals are waiting the oldest one is dropped: a stale keyboard is only cosmetic.
+    """
+
+    def __init__(self, bot, n_answer_threads=4, max_pending=10_000, edits_per_second=20):
+        self.bot = bot
+        self.max_pending = max_pending
+        self.limiter = TokenBucket(edits_per_second)
+
+        self._answer_pool = ThreadPoolExecutor(n_answer_threads, thread_name_prefix='CallbackAnswer')
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+        self.n_answered = 0
+        self.n_answer_failures = 0
+        self.n_edits = 0
+        self.n_collapsed = 0
+        self.n_dropped = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self._edit_loop, name='CallbackPipeline', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Send pending answers and keyboard removals and stop the threads
+        """
+        self._answer_pool.shutdown(wait=True)
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        with self._cond:
+            return {'pending_edits': len(self._pending), 'edits': self.n_edits, 'collapsed': self.n_collapsed,
+                    'dropped': self.n_dropped, 'answered': self.n_answered,
+                    'answer_failures': self.n_answer_failures}
+
+    # -------------- callback answers --------------
+
+    def answer_callback(self, callback_query_id, **kwargs):
+        """
+        Answer the callback query without waiting for the Bot API
+        :return: Future of the call
+        """
+        return self._answer_pool.submit(self._answer, callback_query_id, kwargs)
+
+    def _answer(self, callback_query_id, kwargs):
+        try:
+            self.bot.answer_callback_query(callback_query_id=callback_query_id, **kwargs)
+            self.n_answered += 1
+        except TelegramError as e:
+            # an unanswered query only keeps the spinner until Telegram gives up on it
+            logger.error(f'CallbackPipeline. failed to answer callback query: {e}')
+            self.n_answer_failures += 1
+
+    # -------------- keyboard removal --------------
+
+    def strip_keyboard(self, chat_id, message_id):
+        """
+        Schedule removal of the inline keyboard of the message
+        """
+        if message_id is None:
+            return
+        key = (chat_id, message_id)
+        with self._cond:
+            if key in self._pending:
+                self.n_collapsed += 1
+                return
+            self._pending[key] = time.monotonic()
+            if len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+                self.n_dropped += 1
+            self._cond.notify()
+
+    def _edit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                (chat_id, message_id), _ = self._pending.popitem(last=False)
+            self.limiter.acquire()
+            try:
+                self.bot.edit_message_reply_markup(chat_id, message_id, reply_markup=None)
+                self.n_edits += 1
+            except RetryAfter as e:
+                logger.warning(f'CallbackPipeline. flood control exceeded. pausing for {e.retry_after} s')
+                self.limiter.pause(e.retry_after)
+                self.strip_keyboard(chat_id, message_id)
+            except BadRequest as e:
+                # the message was deleted or has no keyboard already
+                logger.info(f'CallbackPipeline. keyboard of message {message_id} in chat {chat_id} '
+                            f'was not removed: {e}')
+            except TelegramError as e:
+                logger.error(f'CallbackPipeline. failed to remove keyboard: {e}')
@@ -0,0 +1,249 @@
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationRecord:
+    """
+    Conversation context of a single chat, such as ids of the messages with InlineKeyboard to remove.
+    None means that the value is not set
+    """
+
+    __slots__ = ('last_photo_message_id', 'fb_message_id', 'fb_message_with_inline_keyboard_id', 'review_word_ix',
+                 'touched_at')
+
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, last_photo_message_id=None, fb_message_id=None, fb_message_with_inline_keyboard_id=None,
+                 review_word_ix=None, touched_at=0.0):
+        self.last_photo_message_id = last_photo_message_id
+        self.fb_message_id = fb_message_id
+        self.fb_message_with_inline_keyboard_id = fb_message_with_inline_keyboard_id
+        self.review_word_ix = review_word_ix
+        self.touched_at = touched_at
+
+    def is_empty(self):
+        return all(getattr(self, name) is None for name in self.FIELDS)
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.FIELDS)
+
+
+class ConversationStore:
+    """
+    Bounded store of `ConversationRecord` objects keyed by chat_id.
+
+    Records that were not accessed for `ttl` seconds are dropped: `ttl` should be a bit longer than
+    `conversation_timeout` of ConversationHandlers, so timeout callbacks still find their record.
+    When the number of records exceeds `max_entries`, least recently used ones are evicted.
+    If `spill_fp` is provided, evicted non-empty records are moved to an sqlite file
+    and are transparently restored on the next access.
+    If `journal` is provided, records survive restarts: records are changed in place by the callers,
+    so every accessed record is marked dirty and its current values are journaled at the next commit.
+    """
+
+    def __init__(self, ttl, max_entries=100_000, spill_fp=None, clock=time.time, journal=None, journal_table=0):
+        """
+        :param journal: `state_journal.StateJournal` to journal records to
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._records = OrderedDict()
+        self._lock = threading.RLock()
+
+        self.n_expired = 0
+        self.n_evicted = 0
+        self.n_spilled = 0
+        self.n_restored = 0
+
+        self.journal = journal
+        self.journal_table = journal_table
+        self._dirty = set()
+        if journal is not None:
+            journal.add_commit_hook(self._journal_dirty)
+
+        self.spill_fp = spill_fp
+        self._spill = None
+        if spill_fp is not None:
+            self._spill = sqlite3.connect(spill_fp, check_same_thread=False, isolation_level=None)
+            self._spill.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in self._spill.execute('PRAGMA table_info(context)')]
+            if columns and columns != ['chat_id', *ConversationRecord.__slots__]:
+                # spilled records are short-lived, it's fine to drop them when the record layout changes
+                logger.info(f'ConversationStore. dropping spilled records with outdated layout: {columns}')
+                self._spill.execute('DROP TABLE context')
+            self._spill.execute(
+                f'CREATE TABLE IF NOT EXISTS context (chat_id INTEGER PRIMARY KEY, '
+                f'{", ".join(f"{name} INTEGER" for name in ConversationRecord.FIELDS)}, touched_at REAL)')
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def _is_expired(self, record, now):
+        return self._is_expired_at(record.touched_at, now)
+
+    def _is_expired_at(self, touched_at, now):
+        return now - touched_at > self.ttl
+
+    def get(self, chat_id):
+        """
+        :return: record of the chat or None. Accessed record becomes the most recently used one
+        """
+        with self._lock:
+            now = self.clock()
+            record = self._records.get(chat_id)
+            if record is None:
+                record = self._restore(chat_id, now)
+                if record is None:
+                    return None
+            elif self._is_expired(record, now):
+                del self._records[chat_id]
+                self.n_expired += 1
+                return None
+            record.touched_at = now
+            self._records.move_to_end(chat_id)
+            if self.journal is not None:
+                self._dirty.add(chat_id)
+            return record
+
+    def get_or_create(self, chat_id):
+        with self._lock:
+            record = self.get(chat_id)
+            if record is None:
+                record = ConversationRecord(touched_at=self.clock())
+                self._records[chat_id] = record
+                if self.journal is not None:
+                    self._dirty.add(chat_id)
+                self._evict_lru()
+            return record
+
+    def pop(self, chat_id):
+        with self._lock:
+            record = self._records.pop(chat_id, None)
+            if self._spill is not None:
+                self._spill.execute('DELETE FROM context WHERE chat_id = ?', (chat_id,))
+            if self.journal is not None:
+                self._dirty.discard(chat_id)
+                self.journal.delete(self.journal_table, chat_id, 0)
+            return record
+
+    def restore(self, records):
+        """
+        Add records restored by `StateJournal.load`. Records of other tables and expired ones are skipped
+        :param records: dict: (table, chat_id, user_id) -> (values, touched_at)
+        :return: number of restored records
+        """
+        with self._lock:
+            now = self.clock()
+            n_fields = len(ConversationRecord.FIELDS)
+            n_restored = 0
+            # `StateJournal.load` returns records in the order of touches, so the LRU order is kept
+            for (table, chat_id, _), (values, touched_at) in records.items():
+                if table != self.journal_table or self._is_expired_at(touched_at, now):
+                    continue
+                values = values[:n_fields]
+                if values.count(None) < n_fields:
+                    self._records[chat_id] = ConversationRecord(*values, touched_at=touched_at)
+                    self._records.move_to_end(chat_id)
+                    n_restored += 1
+            self._evict_lru()
+            return n_restored
+
+    def _journal_dirty(self):
+        """
+        Commit hook of the journal: journal current values of the records accessed since the last commit.
+        Records evicted in the meantime keep their last journaled values
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            for chat_id in dirty:
+                record = self._records.get(chat_id)
+                if record is not None:
+                    self.journal.put(self.journal_table, chat_id, 0, record.values(), record.touched_at)
+
+    def _evict_lru(self):
+        while len(self._records) > self.max_entries:
+            chat_id, record = self._records.popitem(last=False)
+            self.n_evicted += 1
+            if self._spill is not None and not record.is_empty():
+                self._spill.execute(f'INSERT OR REPLACE INTO context VALUES (?, ?{", ?" * len(record.FIELDS)})',
+                                    (chat_id, *record.values(), record.touched_at))
+                self.n_spilled += 1
+
+    def _restore(self, chat_id, now):
+        if self._spill is None:
+            return None
+        row = self._spill.execute(f'SELECT {", ".join(ConversationRecord.__slots__)} FROM context WHERE chat_id = ?',
+                                  (chat_id,)).fetchone()
+        if row is None:
+            return None
+        self._spill.execute('DELETE FROM context WHERE chat_id = ?', (chat_id,))
+        record = ConversationRecord(*row)
+        if self._is_expired(record, now):
+            self.n_expired += 1
+            return None
+        self._records[chat_id] = record
+        self.n_restored += 1
+        self._evict_lru()
+        return record
+
+    def expire(self):
+        """
+        Drop all records that were not accessed for `ttl` seconds.
+        Records are kept in LRU order, so only the head of the dict needs to be checked
+        """
+        with self._lock:
+            now = self.clock()
+            n_expired = 0
+            while self._records:
+                chat_id, record = next(iter(self._records.items()))
+                if not self._is_expired(record, now):
+                    break
+                del self._records[chat_id]
+                n_expired += 1
+            if self._spill is not None:
+                cur = self._spill.execute('DELETE FROM context WHERE touched_at < ?', (now - self.ttl,))
+                n_expired += cur.rowcount
+            self.n_expired += n_expired
+            return n_expired
+
+    def nbytes(self):
+        """
+        :return: approximate memory used by in-memory records
+        """
+        with self._lock:
+            n = len(self._records)
+            if n == 0:
+                return sys.getsizeof(self._records)
+            record_size = sys.getsizeof(next(iter(self._records.values())))
+            # key is a python int, ~28-32 bytes
+            return sys.getsizeof(self._records) + n * (record_size + 32)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'live': len(self._records),
+                'expired': self.n_expired,
+                'evicted': self.n_evicted,
+                'spilled': self.n_spilled,
+                'restored': self.n_restored,
+                'bytes': self.nbytes(),
+            }
+            if self._spill is not None:
+                stats['spill_rows'] = self._spill.execute('SELECT COUNT(*) FROM context').fetchone()[0]
+            return stats
+
+    def close(self):
+        if self._spill is not None:
+            with self._lock:
+                self._spill.close()
+                self._spill = None
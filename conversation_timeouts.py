@@ -0,0 +1,260 @@
+import logging
+import math
+import queue
+import threading
+import time
+
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel: arm, re-arm and cancel of a timer are O(1), expiring is O(1) per timer.
+
+    Time is counted in ticks. Level 0 has a slot per tick, every next level has slots `slots_per_level`
+    times wider. A timer goes to the lowest level that spans its delay. When the ticks reach the start
+    of a slot of a higher level, its timers are cascaded to the lower levels, so every timer is moved at most
+    `n_levels - 1` times. Slots are dicts keyed by the timer key: a timer is cancelled without scanning its slot.
+    Not thread safe: see `ConversationTimeouts`
+    """
+
+    def __init__(self, tick=1.0, slot_bits=6, n_levels=4, clock=time.monotonic):
+        """
+        :param slot_bits: log2 of slots per level. 64 slots and 4 levels of 1 s ticks span ~194 days
+        """
+        self.tick = tick
+        self.slot_bits = slot_bits
+        self.slot_mask = (1 << slot_bits) - 1
+        self.n_levels = n_levels
+        self.clock = clock
+        self._levels = [[{} for _ in range(1 << slot_bits)] for _ in range(n_levels)]
+        # key -> (due tick, slot dict)
+        self._timers = {}
+        self._tick = int(clock() / tick)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def _place(self, key, due_tick, value):
+        delta = due_tick - self._tick
+        level = 0
+        while level < self.n_levels - 1 and delta >> (self.slot_bits * (level + 1)):
+            level += 1
+        # the farthest timers wait in the top level and are cascaded again on its wrap
+        slot = self._levels[level][(due_tick >> (self.slot_bits * level)) & self.slot_mask]
+        slot[key] = value
+        self._timers[key] = (due_tick, slot)
+
+    def arm(self, key, delay, value=None):
+        """
+        Fire `key` in `delay` seconds, replacing its previous timer if any
+        """
+        self.cancel(key)
+        due_tick = max(math.ceil((self.clock() + delay) / self.tick), self._tick + 1)
+        self._place(key, due_tick, value)
+
+    def cancel(self, key):
+        """
+        :return: True if the timer was armed
+        """
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del timer[1][key]
+        return True
+
+    def advance(self, now=None):
+        """
+        Move to the current time
+        :return: list of (key, value) of expired timers
+        """
+        target = int((self.clock() if now is None else now) / self.tick)
+        expired = []
+        bits, mask = self.slot_bits, self.slot_mask
+        while self._tick < target:
+            if not self._timers:
+                # nothing to cascade or expire on the way
+                self._tick = target
+                break
+            self._tick += 1
+            tick = self._tick
+            for level in range(1, self.n_levels):
+                if tick & ((1 << (bits * level)) - 1):
+                    break
+                slot = self._levels[level][(tick >> (bits * level)) & mask]
+                if slot:
+                    timers = list(slot.items())
+                    slot.clear()
+                    for key, value in timers:
+                        self._place(key, self._timers[key][0], value)
+            slot = self._levels[0][tick & mask]
+            if slot:
+                for key, value in slot.items():
+                    del self._timers[key]
+                    expired.append((key, value))
+                slot.clear()
+        return expired
+
+
+class ConversationTimeouts:
+    """
+    Timeouts of all `TimedConversationHandler`s of the bot in a single `TimerWheel`, instead of a JobQueue job
+    per conversation that is removed and scheduled again on every update.
+
+    A ticker thread expires timers once per tick and hands the whole batch to a single cleanup worker,
+    so a burst of timeouts never blocks the ticker or the dispatcher. The worker runs TIMEOUT handlers
+    of the conversations one by one: their messages and keyboard removals go through the rate-limited
+    callback pipeline and `bot_scheduler`, and a large batch is spread out instead of hitting flood limits.
+    """
+
+    def __init__(self, bot, tick=1.0, clock=time.monotonic):
+        self.bot = bot
+        self.wheel = TimerWheel(tick, clock=clock)
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._batches = queue.Queue()
+        self._stopped = threading.Event()
+        self._threads = []
+        self.n_expired = 0
+        self.n_batches = 0
+
+    def register(self, handler):
+        self._handlers[handler.name] = handler
+
+    def arm(self, handler, key, delay, update=None):
+        with self._lock:
+            self.wheel.arm((handler.name, key), delay, update)
+
+    def cancel(self, handler, key):
+        with self._lock:
+            return self.wheel.cancel((handler.name, key))
+
+    def is_armed(self, handler, key):
+        with self._lock:
+            return (handler.name, key) in self.wheel
+
+    def expire(self, now=None):
+        """
+        Queue the batch of expired conversations for the cleanup worker
+        :return: number of expired conversations
+        """
+        with self._lock:
+            batch = self.wheel.advance(now)
+        if batch:
+            self._batches.put(batch)
+        return len(batch)
+
+    def run_batch(self, batch):
+        for (name, key), update in batch:
+            try:
+                self._handlers[name].expire(key, update, self.bot)
+            except Exception as e:
+                logger.exception(f'ConversationTimeouts. failed to end conversation {name} {key}: {e}')
+        self.n_expired += len(batch)
+        self.n_batches += 1
+
+    def start(self):
+        self._stopped.clear()
+        self._threads = [threading.Thread(target=self._tick_loop, name='ConversationTimeouts.tick', daemon=True),
+                         threading.Thread(target=self._worker_loop, name='ConversationTimeouts.cleanup', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop expiring. Conversations that are still armed are ended by the next run, see `JournalPersistence`
+        """
+        self._stopped.set()
+        self._batches.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            n_armed = len(self.wheel)
+        return {'armed': n_armed, 'expired': self.n_expired, 'batches': self.n_batches,
+                'queued_batches': self._batches.qsize()}
+
+    def _tick_loop(self):
+        while not self._stopped.wait(self.wheel.tick):
+            self.expire()
+
+    def _worker_loop(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            self.run_batch(batch)
+
+
+class TimedConversationHandler(ConversationHandler):
+    """
+    ConversationHandler whose `conversation_timeout` is kept by `ConversationTimeouts` instead of JobQueue.
+    TIMEOUT state handlers are called with the last update of the conversation, as by ConversationHandler.
+    Conversations restored by persistence have no update: they are ended with `restored_cleanup(chat_id, bot)`
+    """
+
+    def __init__(self, *args, timeouts, conversation_timeout, restored_cleanup=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeouts = timeouts
+        self.timeout = conversation_timeout
+        self.restored_cleanup = restored_cleanup
+        self._dispatcher = None
+        timeouts.register(self)
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        self._dispatcher = dispatcher
+        conversation_key = check_result[0]
+        result = super().handle_update(update, dispatcher, check_result, context)
+        if conversation_key in self.conversations:
+            self.timeouts.arm(self, conversation_key, self.timeout, update)
+        else:
+            self.timeouts.cancel(self, conversation_key)
+        return result
+
+    def update_state_and_arm(self, key, new_state=None):
+        """
+        Account for an update handled outside of `handle_update`, e.g. by a coroutine of the asyncio mode:
+        move the conversation to `new_state`, unless it is None, and arm its timeout again.
+        There is no `Update` to call TIMEOUT handlers with: the conversation ends with `restored_cleanup`
+        """
+        if new_state is not None:
+            self.update_state(new_state, key)
+        self.timeouts.arm(self, key, self.timeout)
+
+    def arm_restored(self, restored, now=None):
+        """
+        Arm timeouts of conversations restored by persistence with the time they have left
+        :param restored: dict: conversation key -> (state, touched_at), see `JournalPersistence.restored_conversations`
+        :return: number of armed conversations
+        """
+        now = time.time() if now is None else now
+        n_armed = 0
+        for key, (_, touched_at) in restored.items():
+            if key in self.conversations and not self.timeouts.is_armed(self, key):
+                self.timeouts.arm(self, key, max(touched_at + self.timeout - now, 0.0))
+                n_armed += 1
+        return n_armed
+
+    def expire(self, key, update, bot):
+        """
+        End the conversation. Runs in the cleanup worker of `ConversationTimeouts`
+        """
+        if self.timeouts.is_armed(self, key):
+            # the user went on while the batch was waiting for the worker
+            return
+        if update is not None:
+            for handler in self.states.get(self.TIMEOUT, []):
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    handler.handle_update(update, self._dispatcher, check)
+        elif self.restored_cleanup is not None:
+            self.restored_cleanup(key[0], bot)
+        self.update_state(self.END, key)
@@ -0,0 +1,287 @@
+import fcntl
+import logging
+import os
+import random
+import struct
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SHOWN, SKIPPED, ACCEPTED = range(3)
+COUNTER_NAMES = ('shown', 'skipped', 'accepted')
+
+
+class AliasTable:
+    """
+    Vose alias table: draws an index with probability proportional to its weight in O(1).
+
+    Every index gets a bucket of equal probability `1 / n`: the bucket is the index itself with probability
+    `prob[ix]` and `alias[ix]` otherwise. The table is immutable, so it is shared by threads without locks.
+
+    Built without the sequential small/large worklists of Vose: deficits `1 - scaled` of small weights and
+    excesses `scaled - 1` of large ones are laid out on the same line with cumulative sums. Every small
+    bucket is aliased to the large index whose excess covers the start of its deficit, a large index whose
+    excess ends inside a deficit becomes small itself and is aliased to the next large index.
+    That is exactly the order in which Vose serves the worklists, so the whole build is a few numpy passes.
+    """
+
+    def __init__(self, weights):
+        """
+        :param weights: non-negative weights, at least one positive
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        total = weights.sum()
+        if n == 0 or not total > 0 or (weights < 0).any():
+            raise ValueError('weights must be non-negative with a positive sum')
+        self.n = n
+        self.p = weights / total
+        scaled = self.p * n
+        self.prob = np.ones(n, dtype=np.float64)
+        self.alias = np.arange(n, dtype=np.int32)
+
+        small = np.flatnonzero(scaled < 1)
+        large = np.flatnonzero(scaled >= 1)
+        # all weights within rounding of each other: every bucket is its own index
+        if len(small) and len(large):
+            deficit_ends = np.cumsum(1 - scaled[small])
+            deficit_starts = deficit_ends - (1 - scaled[small])
+            excess_ends = np.cumsum(scaled[large] - 1)
+            # large index serving every small one
+            donors = np.minimum(np.searchsorted(excess_ends, deficit_starts, side='right'), len(large) - 1)
+            self.prob[small] = scaled[small]
+            self.alias[small] = large[donors]
+            # small index whose deficit contains the end of the excess of every large one
+            ixs = np.minimum(np.searchsorted(deficit_ends, excess_ends, side='right'), len(small) - 1)
+            inside = deficit_starts[ixs] < excess_ends
+            self.prob[large] = np.where(inside, 1 - (deficit_ends[ixs] - excess_ends), 1.0).clip(0, 1)
+            self.alias[large[:-1]] = large[1:]
+            # rounding leftovers of the last one
+            self.prob[large[-1]] = 1.0
+        # plain views: indexing them is a few times faster than indexing numpy arrays
+        self._prob = memoryview(self.prob)
+        self._alias = memoryview(self.alias)
+
+    def __len__(self):
+        return self.n
+
+    def draw(self):
+        """
+        :return: index drawn with probability proportional to its weight
+        """
+        # integer part of a single uniform draw picks the bucket, fractional part flips its coin
+        x = random.random() * self.n
+        ix = int(x)
+        return ix if x - ix < self._prob[ix] else self._alias[ix]
+
+    def draw_many(self, size, rng=None):
+        """
+        :return: int array of `size` indices, vectorized
+        """
+        rng = rng or np.random.default_rng()
+        ixs = rng.integers(0, self.n, size)
+        return np.where(rng.random(size) < self.prob[ixs], ixs, self.alias[ixs])
+
+    def probabilities(self):
+        """
+        :return: probability of every index as encoded in the table, to verify it against `p`
+        """
+        p = self.prob.copy()
+        np.add.at(p, self.alias, 1 - self.prob)
+        return p / self.n
+
+
+class EngagementCounters:
+    """
+    How users react to every word: `SHOWN`, `SKIPPED` ("Змяніць бягучае") and `ACCEPTED` ("Даслаць наступнае")
+    counters per (cohort, word) in a single uint32 array, 12 bytes per word and cohort.
+
+    Word indices are positions in `PhotoCatalog`, so counters stay valid when new photos are appended.
+    Workers of the sharded mode share the file: every save adds the events of the worker to it, see `save`.
+
+    File layout (little endian):
+        header
+        counters:   uint32[n_cohorts, n_words, 3]
+    """
+
+    MAGIC = b'LKEC'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQ')  # magic, version, n_cohorts, n_words
+
+    def __init__(self, n_words, n_cohorts=1):
+        self.counts = np.zeros((n_cohorts, n_words, len(COUNTER_NAMES)), dtype=np.uint32)
+        # counters as of the last save or load: `counts - saved` are the events not in the file yet
+        self._saved = self.counts.copy()
+        self._lock = threading.Lock()
+        self.n_events = 0
+
+    @property
+    def n_words(self):
+        return self.counts.shape[1]
+
+    @property
+    def n_cohorts(self):
+        return self.counts.shape[0]
+
+    def record(self, kind, word_ix, cohort=0):
+        """
+        :param kind: `SHOWN`, `SKIPPED` or `ACCEPTED`
+        """
+        with self._lock:
+            if word_ix < self.counts.shape[1]:
+                self.counts[cohort, word_ix, kind] += 1
+                self.n_events += 1
+
+    def resize(self, n_words):
+        """
+        Follow the catalog size. Counters of new words start from zero
+        """
+        with self._lock:
+            if n_words == self.n_words:
+                return
+            self.counts = self._resized(self.counts, n_words)
+            self._saved = self._resized(self._saved, n_words)
+
+    @staticmethod
+    def _resized(counts, n_words):
+        resized = np.zeros((counts.shape[0], n_words, len(COUNTER_NAMES)), dtype=np.uint32)
+        n = min(n_words, counts.shape[1])
+        resized[:, :n] = counts[:, :n]
+        return resized
+
+    def weights(self, cohort=0, prior_accepted=4, prior_skipped=1, min_weight=0.05):
+        """
+        Words are weighted by their acceptance rate smoothed with a Beta prior:
+        a word nobody reacted to yet gets the prior rate, a word that is always skipped goes down to `min_weight`
+        :return: float64 array (n_words,)
+        """
+        counts = self.counts[cohort]
+        accepted = counts[:, ACCEPTED].astype(np.float64)
+        skipped = counts[:, SKIPPED].astype(np.float64)
+        weights = (accepted + prior_accepted) / (accepted + skipped + prior_accepted + prior_skipped)
+        return np.maximum(weights, min_weight)
+
+    def totals(self):
+        """
+        :return: uint64 array (n_words, 3) of counters summed over cohorts
+        """
+        return self.counts.sum(axis=0, dtype=np.uint64)
+
+    def save(self, fp):
+        """
+        Add the events recorded since the last save to the counters of `fp` and take the sums,
+        so counters of workers sharing the file include the events of each other.
+        The file is locked while it is merged and replaced atomically
+        """
+        with open(f'{fp}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            stored = None
+            if os.path.isfile(fp):
+                try:
+                    stored = self.load(fp, self.n_words)
+                except (OSError, ValueError, struct.error) as e:
+                    logger.error(f'EngagementCounters. failed to load counters from "{fp}": {e}. overwriting')
+            with self._lock:
+                if stored is None or stored.counts.shape != self.counts.shape:
+                    counts = self.counts.copy()
+                else:
+                    delta = self.counts.astype(np.int64) - self._saved
+                    counts = np.clip(stored.counts + delta, 0, 0xFFFFFFFF).astype(np.uint32)
+                self.counts = counts
+                self._saved = counts.copy()
+            tmp_fp = f'{fp}.tmp'
+            with open(tmp_fp, 'wb') as fout:
+                fout.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.n_cohorts, counts.shape[1]))
+                counts.astype('<u4', copy=False).tofile(fout)
+            os.replace(tmp_fp, fp)
+        logger.info(f'EngagementCounters. saved counters of {counts.shape[1]} words to "{fp}"')
+
+    @classmethod
+    def load(cls, fp, n_words=None):
+        """
+        :param n_words: resize to the current catalog size
+        """
+        with open(fp, 'rb') as fin:
+            magic, version, n_cohorts, stored_n_words = cls.HEADER.unpack(fin.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f'"{fp}" is not an engagement counters file')
+            counters = cls(stored_n_words, n_cohorts)
+            counts = np.fromfile(fin, dtype='<u4', count=counters.counts.size)
+        if counts.size != counters.counts.size:
+            raise ValueError(f'"{fp}" is truncated')
+        counters.counts = counts.reshape(counters.counts.shape).astype(np.uint32)
+        counters._saved = counters.counts.copy()
+        if n_words is not None:
+            counters.resize(n_words)
+        return counters
+
+    @classmethod
+    def load_or_create(cls, fp, n_words, n_cohorts=1):
+        if fp is not None and os.path.isfile(fp):
+            try:
+                counters = cls.load(fp, n_words)
+                if counters.n_cohorts == n_cohorts:
+                    return counters
+                logger.warning(f'EngagementCounters. "{fp}" has {counters.n_cohorts} cohorts, expected '
+                               f'{n_cohorts}. starting from scratch')
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f'EngagementCounters. failed to load counters from "{fp}": {e}')
+        return cls(n_words, n_cohorts)
+
+
+class EngagementSampler:
+    """
+    Draws words proportionally to their engagement weights, with an alias table per cohort.
+
+    Draws never lock: a rebuild makes new tables and swaps the whole list with a single assignment.
+    Rebuilds are meant to run off the handler path, e.g. from a JobQueue job, and only happen when
+    the weights drifted from the ones of the current tables by more than `drift_threshold`
+    in total variation distance, so a quiet bot does not rebuild 1M word tables every minute.
+    """
+
+    def __init__(self, counters, drift_threshold=0.01, **weights_kwargs):
+        """
+        :param weights_kwargs: passed to `EngagementCounters.weights`
+        """
+        self.counters = counters
+        self.drift_threshold = drift_threshold
+        self.weights_kwargs = weights_kwargs
+        self._rebuild_lock = threading.Lock()
+        self.n_rebuilds = 0
+        self._tables = [AliasTable(counters.weights(cohort, **weights_kwargs))
+                        for cohort in range(counters.n_cohorts)]
+
+    def draw(self, cohort=0):
+        """
+        :return: word index
+        """
+        return self._tables[cohort].draw()
+
+    def drift(self, cohort=0):
+        """
+        :return: total variation distance between current weights and the ones of the table
+        """
+        table = self._tables[cohort]
+        weights = self.counters.weights(cohort, **self.weights_kwargs)
+        if len(weights) != len(table):
+            return 1.0
+        return 0.5 * float(np.abs(weights / weights.sum() - table.p).sum())
+
+    def rebuild_if_drifted(self, force=False):
+        """
+        :return: number of rebuilt tables
+        """
+        with self._rebuild_lock:
+            tables = list(self._tables)
+            n_rebuilt = 0
+            for cohort in range(len(tables)):
+                if force or self.drift(cohort) > self.drift_threshold:
+                    tables[cohort] = AliasTable(self.counters.weights(cohort, **self.weights_kwargs))
+                    n_rebuilt += 1
+            if n_rebuilt:
+                self._tables = tables
+                self.n_rebuilds += 1
+                logger.info(f'EngagementSampler. rebuilt {n_rebuilt} alias tables of {len(tables[0])} words')
+            return n_rebuilt
@@ -0,0 +1,229 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+from telegram import ParseMode
+from telegram.error import RetryAfter, TelegramError
+
+from bot_scheduler import PRIORITY_ADMIN, send_priority
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits: message text and document caption
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+
+def fingerprint_error(error):
+    """
+    Errors with the same type raised from the same code path share the fingerprint.
+    Line numbers are not used, so the fingerprint survives unrelated edits of the file
+    """
+    parts = [f'{type(error).__module__}.{type(error).__qualname__}']
+    for frame in traceback.extract_tb(error.__traceback__):
+        parts.append(f'{os.path.basename(frame.filename)}:{frame.name}:{(frame.line or "").strip()}')
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def normalize_error_message(message):
+    # ids, counters and addresses differ between occurrences of the same error
+    return re.sub(r'0x[0-9a-fA-F]+|\d+', 'N', message)
+
+
+class ErrorStats:
+    __slots__ = ('fingerprint', 'error_type', 'message', 'count', 'reported_count', 'first_seen', 'last_seen')
+
+    def __init__(self, fingerprint, error, now):
+        self.fingerprint = fingerprint
+        self.error_type = type(error).__name__
+        self.message = normalize_error_message(str(error))
+        self.count = 0
+        self.reported_count = 0
+        self.first_seen = self.last_seen = now
+
+
+class ErrorReporter:
+    """
+    Aggregates errors of the dispatcher and reports them to the developer chat.
+
+    Errors are grouped by fingerprint in a bounded LRU table. The first occurrence of a fingerprint is
+    reported with a document holding the traceback and the update, repeats are only counted and sent
+    in a periodic digest. Reports of new fingerprints are rate limited, the ones over the limit get into
+    the digest too. `report` only updates the table: serialization, disk writes and Bot API calls
+    are done by a background thread.
+    """
+
+    def __init__(self, bot, chat_id, reports_dp=None, max_fingerprints=1000, max_queue=100, reports_per_minute=10,
+                 clock=time.time):
+        """
+        :param reports_dp: directory to keep report files in. reports are sent from memory if None
+        :param max_queue: reports waiting to be sent. reports over the limit are dropped
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reports_dp = reports_dp
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock
+        self.report_limiter = TokenBucket(reports_per_minute / 60, capacity=reports_per_minute)
+
+        self._errors = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+        self.n_errors = 0
+        self.n_reported = 0
+        self.n_dropped = 0
+        self.n_evicted = 0
+        self.n_sent = 0
+        self.n_send_failures = 0
+
+    def __len__(self):
+        return len(self._errors)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        if self.reports_dp is not None:
+            os.makedirs(self.reports_dp, exist_ok=True)
+        self._thread = threading.Thread(target=self._send_loop, name='ErrorReporter', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def report(self, update, error, user_info=None):
+        """
+        Count the error and schedule a report if its fingerprint is new. Called from the dispatcher thread
+        :param user_info: description of the user to put into the report
+        :return: True if the fingerprint is seen for the first time
+        """
+        fingerprint = fingerprint_error(error)
+        now = self.clock()
+        with self._lock:
+            self.n_errors += 1
+            stats = self._errors.get(fingerprint)
+            is_new = stats is None
+            if is_new:
+                stats = self._errors[fingerprint] = ErrorStats(fingerprint, error, now)
+                if len(self._errors) > self.max_fingerprints:
+                    self._errors.popitem(last=False)
+                    self.n_evicted += 1
+            else:
+                self._errors.move_to_end(fingerprint)
+            stats.count += 1
+            stats.last_seen = now
+            if not is_new or not self.report_limiter.try_acquire():
+                return is_new
+            stats.reported_count = stats.count
+        try:
+            self._queue.put_nowait((self._send_report, (stats, update, error, user_info)))
+            self.n_reported += 1
+        except queue.Full:
+            self.n_dropped += 1
+        return is_new
+
+    def digest(self, context=None):
+        """
+        Schedule a summary of errors that occurred since they were reported last time.
+        Can be used as a JobQueue callback
+        :return: number of fingerprints in the digest
+        """
+        with self._lock:
+            pending = [(stats, stats.count - stats.reported_count) for stats in self._errors.values()
+                       if stats.count > stats.reported_count]
+            for stats, _ in pending:
+                stats.reported_count = stats.count
+        if not pending:
+            return 0
+        pending.sort(key=lambda x: x[1], reverse=True)
+
+        lines = [f'#error_digest\n\n{sum(n for _, n in pending)} errors of {len(pending)} kinds:']
+        for ix, (stats, n) in enumerate(pending):
+            line = f'{n}x {stats.error_type}: {stats.message[:200]} [{stats.fingerprint}] (total: {stats.count})'
+            if sum(len(x) + 1 for x in lines) + len(line) > MAX_MESSAGE_LENGTH - 50:
+                lines.append(f'... and {len(pending) - ix} more')
+                break
+            lines.append(line)
+        try:
+            self._queue.put_nowait((self._send_message, ('\n'.join(lines),)))
+        except queue.Full:
+            self.n_dropped += 1
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            return {'fingerprints': len(self._errors), 'errors': self.n_errors, 'reported': self.n_reported,
+                    'dropped': self.n_dropped, 'evicted': self.n_evicted, 'sent': self.n_sent,
+                    'send_failures': self.n_send_failures, 'queued': self._queue.qsize()}
+
+    # -------------- background thread --------------
+
+    def _send_loop(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                # reporting must never fail the bot
+                logger.exception(f'ErrorReporter. failed to send a report: {e}')
+                self.n_send_failures += 1
+
+    def _call_bot(self, method, *args, **kwargs):
+        for attempt in range(3):
+            try:
+                with send_priority(PRIORITY_ADMIN):
+                    method(*args, **kwargs)
+                self.n_sent += 1
+                return
+            except RetryAfter as e:
+                logger.warning(f'ErrorReporter. flood control exceeded. pausing for {e.retry_after} s')
+                time.sleep(e.retry_after)
+            except TelegramError as e:
+                logger.error(f'ErrorReporter. failed to send a report: {e}')
+                break
+        self.n_send_failures += 1
+
+    def _send_message(self, text):
+        self._call_bot(self.bot.send_message, self.chat_id, text)
+
+    def _send_report(self, stats, update, error, user_info):
+        traceback_str = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
+        update_json = json.dumps(json.loads(update.to_json()), indent=2) if update is not None else None
+        content = (f'user:\n{user_info}\n\n'
+                   f'error:\n{error}\n\n'
+                   f'fingerprint: {stats.fingerprint}\n\n'
+                   f'traceback:\n{traceback_str}\n\n'
+                   f'update:\n{update_json}').encode('utf-8')
+        caption = (f'#error\n\n'
+                   f'user:\n{user_info}\n\n'
+                   f'error:\n`{str(error)[:500]}`\n\n'
+                   f'fingerprint: `{stats.fingerprint}`')[:MAX_CAPTION_LENGTH]
+
+        error_fn = f'error_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_{stats.fingerprint}.txt'
+        if self.reports_dp is not None:
+            with open(os.path.join(self.reports_dp, error_fn), 'wb') as fout:
+                fout.write(content)
+        self._call_bot(self._send_document, content, error_fn, caption)
+
+    def _send_document(self, content, filename, caption):
+        # a new file object for every attempt: a failed upload leaves the previous one read to the end
+        self.bot.send_document(self.chat_id, document=io.BytesIO(content), filename=filename, caption=caption,
+                               parse_mode=ParseMode.MARKDOWN)
@@ -0,0 +1,352 @@
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+
+class FakeBotApiServer:
+    """
+    Local stand-in for Telegram Bot API to benchmark the bot and the tools without hitting real Telegram.
+    Point `telegram.Bot` to it with `base_url=server.base_url`.
+
+    Updates put with `push_update` are served by `getUpdates`. The bot answers the user with
+    `ANSWER_METHODS`: the first answer to the chat after an update completes the update,
+    its end-to-end latency is passed to `on_answer`.
+    `{base_url}/joke` stands in for the jokes server of `JokeProvider`: it answers like icanhazdadjoke.com
+    with a random joke of `jokes`, so jokes repeat as they do there
+    :param latency: seconds to sleep before answering every request
+    :param error_rate: share of requests answered with 429 Too Many Requests
+    :param retry_after: `retry_after` value of 429 responses
+    :param blocked_chat_ids: chats that blocked the bot. requests to them are answered with 403 Forbidden
+    :param flood_limits: answer with 429 like Telegram does when the bot sends faster than `FLOOD_LIMITS`
+    """
+
+    # not a Bot API method: the path of the jokes server
+    JOKE_METHOD = 'joke'
+    ANSWER_METHODS = ('sendMessage', 'sendPhoto', 'sendMediaGroup', 'editMessageMedia')
+    # polling and webhook management are never answered with injected errors
+    RELIABLE_METHODS = {'getMe', 'getUpdates', 'getWebhookInfo', 'setWebhook', 'deleteWebhook'}
+    # (messages per second, burst) overall, to a private chat and to a group. an album counts as its photos.
+    # allowed bursts are not documented: these are what the bot is observed to get away with
+    FLOOD_LIMITS = {'global': (30, 30), 'chat': (1, 3), 'group': (20 / 60, 3)}
+    # requests arriving up to this early are let through: the bot can't control network jitter
+    FLOOD_JITTER = 0.05
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, retry_after=1, blocked_chat_ids=(),
+                 flood_limits=False):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.blocked_chat_ids = set(blocked_chat_ids)
+        self.flood_limits = flood_limits
+        # chat_id or 'global' -> theoretical arrival time of the next message, see `flood_wait`
+        self._flood_tats = {}
+        self.n_flood_errors = 0
+
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.calls = {}
+        # requests being answered, long polling excluded: how many calls the bot keeps in flight
+        self.n_active = 0
+        self.peak_active = 0
+
+        self._updates = []
+        self._updates_cond = threading.Condition()
+        self._update_ids = itertools.count(1)
+        # chat_id -> (update_id, pushed_at) of the update waiting for an answer
+        self._pending = {}
+        self.last_message_ids = {}
+        self.on_answer = None
+        # called with (method, params) of every successful call, e.g. to time calls in benchmarks
+        self.on_call = None
+        self.webhook_url = ''
+        # (id, text) of the jokes served at `joke` and seconds to sleep before answering it
+        self.jokes = [(f'joke_{ix}', f'Joke #{ix}') for ix in range(100)]
+        self.joke_delay = 0.0
+
+        self.methods = {
+            'getMe': self.get_me,
+            'getUpdates': self.get_updates,
+            'getWebhookInfo': self.get_webhook_info,
+            'setWebhook': self.set_webhook,
+            'deleteWebhook': self.delete_webhook,
+            'sendMessage': self.send_message,
+            'sendPhoto': self.send_photo,
+            'sendDocument': self.send_document,
+            'sendMediaGroup': self.send_media_group,
+            'forwardMessage': self.forward_message,
+            'editMessageMedia': self.edit_message_media,
+            'editMessageReplyMarkup': self.edit_message_reply_markup,
+            'answerCallbackQuery': self.answer_callback_query,
+        }
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, Nagle's algorithm would delay every response by ~40 ms
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                server.handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # clients that open a connection per request, e.g. `AsyncBotApi`, connect in bursts
+            request_queue_size = 1024
+
+        self.httpd = Server((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='FakeBotApiServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    # -------------- request handling --------------
+
+    @staticmethod
+    def parse_params(request):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+            params = {}
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                payload = part.get_payload(decode=True)
+                params[name] = payload if part.get_filename() else payload.decode()
+            return params
+        return dict(parse_qsl(body.decode()))
+
+    def handle(self, request):
+        method = request.path.rsplit('/', 1)[-1]
+        params = self.parse_params(request)
+        is_polling = method == 'getUpdates'
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if not is_polling:
+                self.n_active += 1
+                self.peak_active = max(self.peak_active, self.n_active)
+
+        if self.latency:
+            time.sleep(self.latency)
+        flood_wait = self.flood_wait(method, params) if self.flood_limits and method in self.methods else 0.0
+
+        if method == self.JOKE_METHOD:
+            status, response = self.joke()
+        elif method not in self.methods:
+            status, response = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        elif self.error_rate and method not in self.RELIABLE_METHODS and random.random() < self.error_rate:
+            status, response = 429, {'ok': False, 'error_code': 429,
+                                     'description': f'Too Many Requests: retry after {self.retry_after}',
+                                     'parameters': {'retry_after': self.retry_after}}
+        elif flood_wait > 0:
+            with self._lock:
+                self.n_flood_errors += 1
+            # Telegram rounds the wait up to seconds
+            retry_after = max(1, math.ceil(flood_wait))
+            status, response = 429, {'ok': False, 'error_code': 429,
+                                     'description': f'Too Many Requests: retry after {retry_after}',
+                                     'parameters': {'retry_after': retry_after}}
+        elif self.blocked_chat_ids and int(params.get('chat_id', 0)) in self.blocked_chat_ids:
+            status, response = 403, {'ok': False, 'error_code': 403,
+                                     'description': 'Forbidden: bot was blocked by the user'}
+        else:
+            status, response = 200, {'ok': True, 'result': self.methods[method](params)}
+            if method in self.ANSWER_METHODS:
+                self._answered(int(params.get('chat_id', 0)))
+            if self.on_call is not None:
+                self.on_call(method, params)
+        if not is_polling:
+            with self._lock:
+                self.n_active -= 1
+
+        body = json.dumps(response).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        try:
+            request.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up on the call, e.g. a long poll cancelled on shutdown
+            pass
+
+    def flood_wait(self, method, params):
+        """
+        GCRA check of the global and the chat limits. A message that is allowed is counted
+        :return: seconds until the message is allowed, 0 if it is allowed now
+        """
+        if method in self.RELIABLE_METHODS or method == 'answerCallbackQuery':
+            return 0.0
+        chat_id = int(params.get('chat_id', 0))
+        media = params.get('media') or ()
+        # a JSON string in form data, a list in JSON requests
+        cost = len(json.loads(media) if isinstance(media, str) else media) if method == 'sendMediaGroup' else 1
+        keys = ('global', chat_id)
+        limits = (self.FLOOD_LIMITS['global'], self.FLOOD_LIMITS['group' if chat_id < 0 else 'chat'])
+        now = time.monotonic()
+        with self._lock:
+            wait = 0.0
+            for key, (rate, burst) in zip(keys, limits):
+                tolerance = (burst - 1) / rate + self.FLOOD_JITTER
+                wait = max(wait, self._flood_tats.get(key, now) - tolerance - now)
+            if wait > 0:
+                return wait
+            for key, (rate, _) in zip(keys, limits):
+                self._flood_tats[key] = max(self._flood_tats.get(key, now), now) + cost / rate
+            return 0.0
+
+    # -------------- updates --------------
+
+    def next_update_id(self):
+        return next(self._update_ids)
+
+    def track(self, chat_id, update_id):
+        """
+        Wait for an answer to the update, e.g. one posted to the bot's webhook
+        """
+        with self._lock:
+            self._pending[chat_id] = (update_id, time.perf_counter())
+
+    def push_update(self, update):
+        """
+        Queue an update for `getUpdates`. `update_id` is assigned if missing
+        :return: update_id
+        """
+        update.setdefault('update_id', self.next_update_id())
+        chat_id = update.get('message', update.get('callback_query', {})).get('from', {}).get('id')
+        if chat_id is not None:
+            self.track(chat_id, update['update_id'])
+        with self._updates_cond:
+            self._updates.append(update)
+            self._updates_cond.notify_all()
+        return update['update_id']
+
+    def _answered(self, chat_id):
+        with self._lock:
+            pending = self._pending.pop(chat_id, None)
+        if pending is not None and self.on_answer is not None:
+            update_id, pushed_at = pending
+            self.on_answer(chat_id, update_id, time.perf_counter() - pushed_at)
+
+    def get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._updates_cond:
+            # confirmed updates are dropped, as Telegram does
+            self._updates = [x for x in self._updates if x['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._updates_cond.wait(remaining)
+            return self._updates[:limit]
+
+    def joke(self):
+        """
+        :return: (status, response) of the jokes server
+        """
+        if self.joke_delay:
+            time.sleep(self.joke_delay)
+        if not self.jokes:
+            return 404, {'status': 404, 'message': 'Joke not found'}
+        joke_id, text = random.choice(self.jokes)
+        return 200, {'id': joke_id, 'joke': text, 'status': 200}
+
+    # -------------- Bot API methods --------------
+
+    def message(self, params, **fields):
+        chat_id = int(params.get('chat_id', 0))
+        message_id = next(self._message_ids)
+        self.last_message_ids[chat_id] = message_id
+        return {'message_id': message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **fields}
+
+    def edited_message(self, params, **fields):
+        chat_id = int(params.get('chat_id', 0))
+        return {'message_id': int(params.get('message_id', 0)), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, **fields}
+
+    def get_me(self, params):
+        return {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}
+
+    def get_webhook_info(self, params):
+        return {'url': self.webhook_url, 'has_custom_certificate': False, 'pending_update_count': 0}
+
+    def set_webhook(self, params):
+        self.webhook_url = params.get('url', '')
+        return True
+
+    def delete_webhook(self, params):
+        self.webhook_url = ''
+        return True
+
+    def send_message(self, params):
+        return self.message(params, text=params.get('text', ''))
+
+    def send_photo(self, params):
+        file_id = f'fake_file_id_{next(self._file_ids)}'
+        photo = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1080, 'height': 1920}]
+        return self.message(params, photo=photo)
+
+    def send_document(self, params):
+        file_id = f'fake_file_id_{next(self._file_ids)}'
+        document = params.get('document')
+        file_size = len(document) if isinstance(document, bytes) else 0
+        return self.message(params, document={'file_id': file_id, 'file_unique_id': file_id, 'file_size': file_size})
+
+    def send_media_group(self, params):
+        media = params.get('media') or []
+        if isinstance(media, str):
+            media = json.loads(media)
+        return [self.send_photo(params) for _ in media]
+
+    def forward_message(self, params):
+        return self.message(params, text='forwarded message')
+
+    def edit_message_media(self, params):
+        file_id = f'fake_file_id_{next(self._file_ids)}'
+        photo = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1080, 'height': 1920}]
+        return self.edited_message(params, photo=photo)
+
+    def edit_message_reply_markup(self, params):
+        return self.edited_message(params, text='')
+
+    def answer_callback_query(self, params):
+        return True
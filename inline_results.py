@@ -0,0 +1,150 @@
+import logging
+import random
+import threading
+from collections import OrderedDict
+
+from telegram import InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+
+from word_catalog import normalize_word
+from word_sampler import FeistelPermutation
+
+logger = logging.getLogger(__name__)
+
+# Bot API accepts at most 50 results per answer
+MAX_PAGE_SIZE = 50
+
+
+class InlineResultCache:
+    """
+    Answers to inline queries, built on demand.
+
+    An empty query gets a page of random words: it walks page by page through one of `n_shuffles` fixed orders
+    of the photos (the order is kept in `next_offset`). An order is a keyed Feistel permutation
+    of catalog indices, so a page is computed from its position without materializing the order
+    and nothing is built at startup. Other queries get prefix matches from the word index.
+    Pages actually served are kept in an LRU cache keyed by normalized query and offset.
+    """
+
+    def __init__(self, photos_file_ids, word_index=None, page_size=20, n_shuffles=16, max_entries=10_000,
+                 seed=None):
+        """
+        :param photos_file_ids: sequence of (photo name, file_id), e.g. `PhotoCatalog`. kept, not copied
+        :param word_index: `WordIndex` for prefix matches. non-empty queries get no results without it
+        """
+        if not 0 < page_size <= MAX_PAGE_SIZE:
+            raise ValueError(f'page_size must be in [1, {MAX_PAGE_SIZE}], got {page_size}')
+        self.photos_file_ids = photos_file_ids
+        self.word_index = word_index
+        self.page_size = page_size
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._word_results = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.n_hits = 0
+        self.n_misses = 0
+
+        n_photos = len(photos_file_ids)
+        self._permutation = FeistelPermutation(n_photos) if n_photos else None
+        # key of the permutation of every random order
+        self._shuffle_keys = [self._rng.getrandbits(64) for _ in range(n_shuffles if n_photos else 0)]
+        self._n_random_pages = -(-n_photos // page_size)
+
+    @staticmethod
+    def _parse_offset(offset):
+        try:
+            return max(0, int(offset))
+        except ValueError:
+            return 0
+
+    def _word_result(self, entry_id):
+        result = self._word_results.get(entry_id)
+        if result is None:
+            entry = self.word_index.entry(entry_id)
+            if entry['file_id'] is not None:
+                result = InlineQueryResultCachedPhoto(id=f'w{entry_id}', photo_file_id=entry['file_id'],
+                                                      title=entry['headword'], caption=entry['headword'])
+            else:
+                text = f'{entry["headword"]}\n\n{entry["definition"]}'.strip()
+                result = InlineQueryResultArticle(id=f'w{entry_id}', title=entry['headword'],
+                                                  description=entry['definition'][:100],
+                                                  input_message_content=InputTextMessageContent(text))
+            self._word_results[entry_id] = result
+        return result
+
+    def _build_prefix_page(self, key, page_ix):
+        if self.word_index is None:
+            return (), ''
+        start = page_ix * self.page_size
+        # one extra match tells whether there is a next page
+        entry_ids = self.word_index.prefix(key, limit=start + self.page_size + 1)
+        page = tuple(self._word_result(entry_id) for entry_id in entry_ids[start:start + self.page_size])
+        next_offset = str(page_ix + 1) if len(entry_ids) > start + self.page_size else ''
+        return page, next_offset
+
+    def get(self, query, offset=''):
+        """
+        :param offset: `offset` of the inline query, i.e. `next_offset` of the previous answer
+        :return: (tuple of results, next_offset)
+        """
+        key = normalize_word(query)
+        if not key:
+            return self._get_random_page(offset)
+
+        page_ix = self._parse_offset(offset)
+        return self._cached_page((key, page_ix), self._build_prefix_page, key, page_ix)
+
+    def _cached_page(self, cache_key, build, *args):
+        with self._lock:
+            cached = self._pages.get(cache_key)
+            if cached is not None:
+                self._pages.move_to_end(cache_key)
+                self.n_hits += 1
+                return cached
+            self.n_misses += 1
+            cached = self._pages[cache_key] = build(*args)
+            if len(self._pages) > self.max_entries:
+                self._pages.popitem(last=False)
+            return cached
+
+    def _build_random_page(self, shuffle_ix, page_ix):
+        key = self._shuffle_keys[shuffle_ix]
+        start = page_ix * self.page_size
+        stop = min(start + self.page_size, len(self.photos_file_ids))
+        page = []
+        for position in range(start, stop):
+            ix = self._permutation(position, key)
+            file_id = self.photos_file_ids[ix][1]
+            # photos removed from the catalog have no file_id
+            if file_id:
+                page.append(InlineQueryResultCachedPhoto(id=f'p{ix}', photo_file_id=file_id))
+        next_offset = f'{shuffle_ix}.{page_ix + 1}' if page_ix + 1 < self._n_random_pages else ''
+        return tuple(page), next_offset
+
+    def _get_random_page(self, offset):
+        """
+        Offset of random pages is `shuffle_ix.page_ix`, the first page picks a random shuffle
+        """
+        if not self._shuffle_keys:
+            return (), ''
+        shuffle_ix, _, page_ix = offset.partition('.')
+        shuffle_ix, page_ix = self._parse_offset(shuffle_ix), self._parse_offset(page_ix)
+        if not offset or shuffle_ix >= len(self._shuffle_keys):
+            shuffle_ix, page_ix = self._rng.randrange(len(self._shuffle_keys)), 0
+        if page_ix >= self._n_random_pages:
+            return (), ''
+        # '' is the key of empty queries, prefix pages are keyed by (key, page_ix)
+        return self._cached_page(('', shuffle_ix, page_ix), self._build_random_page, shuffle_ix, page_ix)
+
+    def clear(self):
+        """
+        Drop cached pages, e.g. after the word index was rebuilt
+        """
+        with self._lock:
+            self._pages.clear()
+            self._word_results.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'pages': len(self._pages), 'hits': self.n_hits, 'misses': self.n_misses,
+                    'word_results': len(self._word_results)}
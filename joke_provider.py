@@ -0,0 +1,115 @@
+import logging
+import threading
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class JokeProvider:
+    """
+    Keeps a buffer of prefetched jokes, so handlers answer from memory and never wait on the jokes server.
+
+    A background thread refills the buffer through a single keep-alive `requests.Session`
+    with strict timeouts. Ids of recently buffered jokes are remembered to avoid repeats.
+    """
+
+    def __init__(self, url='https://icanhazdadjoke.com/', buffer_size=20, timeout=(2, 3),
+                 dedup_size=500, min_backoff=1, max_backoff=60):
+        """
+        :param timeout: (connect, read) timeouts in seconds
+        :param dedup_size: number of recently buffered joke ids to skip when fetched again
+        """
+        self.url = url
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self._buffer = deque(maxlen=buffer_size)
+        self._recent_ids = deque(maxlen=dedup_size)
+        self._recent_ids_set = set()
+
+        self._session = requests.Session()
+        self._session.headers.update({'Accept': 'application/json', 'User-Agent': 'LieksikaBot'})
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.n_fetched = 0
+        self.n_duplicates = 0
+        self.n_errors = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._refill_loop, name='JokeProvider', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._session.close()
+
+    def get(self):
+        """
+        :return: joke text or None if the buffer is empty
+        """
+        try:
+            joke = self._buffer.popleft()
+        except IndexError:
+            joke = None
+        self._wakeup.set()
+        return joke
+
+    def _remember(self, joke_id):
+        if joke_id in self._recent_ids_set:
+            return False
+        if len(self._recent_ids) == self._recent_ids.maxlen:
+            self._recent_ids_set.discard(self._recent_ids[0])
+        self._recent_ids.append(joke_id)
+        self._recent_ids_set.add(joke_id)
+        return True
+
+    def fetch(self):
+        """
+        Fetch a single joke and put it into the buffer unless it was seen recently
+        :return: True if a new joke was buffered
+        """
+        r = self._session.get(self.url, timeout=self.timeout)
+        r.raise_for_status()
+        data = r.json()
+        joke_id = data.get('id', data['joke'])
+        if self._remember(joke_id):
+            self._buffer.append(data['joke'])
+            self.n_fetched += 1
+            return True
+        self.n_duplicates += 1
+        return False
+
+    def _refill_loop(self):
+        backoff = 0
+        while not self._stopped.is_set():
+            if len(self._buffer) >= self._buffer.maxlen:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                if self.fetch():
+                    backoff = 0
+                else:
+                    # server keeps returning recent jokes. don't hammer it
+                    backoff = min(max(backoff * 2, self.min_backoff), self.max_backoff)
+                    self._stopped.wait(backoff)
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self.n_errors += 1
+                backoff = min(max(backoff * 2, self.min_backoff), self.max_backoff)
+                logger.error(f'JokeProvider. failed to fetch a joke: {e}. retrying in {backoff} s')
+                self._stopped.wait(backoff)
@@ -1,18 +1,39 @@
+import asyncio
 import datetime
-import json
 import logging
 import os
-import traceback
+import signal
+import struct
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
-from signal import SIGINT
+from signal import SIGINT, SIGTERM
 
-import numpy as np
-import requests
-from telegram import (Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, User,
-                      ParseMode)
-from telegram.error import BadRequest
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, User
+from telegram.error import TelegramError
 from telegram.ext import (Updater, CallbackContext, CommandHandler, ConversationHandler, MessageHandler, Filters,
-                          CallbackQueryHandler)
+                          CallbackQueryHandler, InlineQueryHandler)
+
+from admin_notifier import AdminNotifier
+from async_dispatch import AsyncDispatcher
+from bot_scheduler import BotScheduler
+from broadcast import Broadcaster, SubscriberRegistry
+from callback_pipeline import CallbackPipeline
+from conversation_store import ConversationStore
+from conversation_timeouts import ConversationTimeouts, TimedConversationHandler
+from engagement import ACCEPTED, SHOWN, SKIPPED, EngagementCounters, EngagementSampler
+from error_reporter import ErrorReporter
+from inline_results import InlineResultCache
+from joke_provider import JokeProvider
+from metrics import REGISTRY, MetricsServer, timed
+from photo_catalog import PhotoCatalog, file_signature
+from review_scheduler import ReviewScheduler
+from state_journal import JournalPersistence, StateJournal, TABLE_CONVERSATION_CONTEXT
+from update_lanes import ThreadedChatLanes
+from user_state import SharedReviewScheduler, SharedWordSampler, UserStateDb
+from word_catalog import WordIndex
+from word_sampler import WordSampler
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,7 +52,8 @@ def reject_edit_update(func):
         update = args[1] if len(args) > 1 else kwargs['update']
         chat_id = update.effective_user.id
         if update.message is None:
-            logger.info(f'{func.__name__}. ignoring edit update. chat_id: {chat_id}')
+            logger.info('%s. ignoring edit update. chat_id: %s', func.__name__, chat_id,
+                        extra={'handler': func.__name__, 'chat_id': chat_id})
             return
         return func(*args, **kwargs)
 
@@ -40,7 +62,8 @@ def reject_edit_update(func):
 
 def log_method_name_and_chat_id_from_update(_method=None, *, update_pos_arg_ix=0):
     """
-    Log method call into `info` stream.
+    Log method call with its duration into `info` stream and record its latency into `metrics.REGISTRY`.
+    Message arguments are passed lazily, so sampled out or queued records are not formatted in the handler.
     This decorator can be invoked bot without parentheses and with argument `update_pos_arg_ix` provided
     :param _method: parameter to check how the decorator is used
     :param update_pos_arg_ix: index of `update` in positional arguments
@@ -52,10 +75,15 @@ def log_method_name_and_chat_id_from_update(_method=None, *, update_pos_arg_ix=0
             effective_update_ix = update_pos_arg_ix + 1  # take `self` argument into account
             update = args[effective_update_ix] if len(args) > effective_update_ix else kwargs['update']
             chat_id = update.effective_user.id
-            logger.info(f'{func.__name__}. chat_id: {chat_id}')
-            return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration_ms = round((time.perf_counter() - start) * 1e3, 2)
+                logger.info('%s. chat_id: %s, duration: %s ms', func.__name__, chat_id, duration_ms,
+                            extra={'handler': func.__name__, 'chat_id': chat_id, 'duration_ms': duration_ms})
 
-        return wrapper
+        return timed(wrapper)
 
     if _method is None:
         # decorator is called with parameter `update_pos_arg_ix`
@@ -65,6 +93,25 @@ def log_method_name_and_chat_id_from_update(_method=None, *, update_pos_arg_ix=0
         return outer_wrapper(_method)
 
 
+def log_async_handler(func):
+    """
+    `log_method_name_and_chat_id_from_update` for coroutine handlers of the asyncio mode.
+    Handlers are called with `(self, api, chat_id, ...)`: they get raw updates, not `Update` objects
+    """
+
+    @wraps(func)
+    async def wrapper(self, api, chat_id, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(self, api, chat_id, *args, **kwargs)
+        finally:
+            duration_ms = round((time.perf_counter() - start) * 1e3, 2)
+            logger.info('%s. chat_id: %s, duration: %s ms', func.__name__, chat_id, duration_ms,
+                        extra={'handler': func.__name__, 'chat_id': chat_id, 'duration_ms': duration_ms})
+
+    return REGISTRY.histogram('handler', func.__name__).wrap_async(wrapper)
+
+
 class LieksikaBot:
 
     @staticmethod
@@ -73,27 +120,148 @@ class LieksikaBot:
             raise ValueError(f'variable must be not None')
         return var
 
-    def __init__(self, token, contact_chat_id, photos_file_ids_fp):
+    def __init__(self, token, contact_chat_id, photos_file_ids_fp, sampler_state_fp=None, context_spill_fp=None,
+                 subscribers_db_fp=':memory:', review_state_fp=None, word_index_fp=None, admin_queue_db_fp=':memory:',
+                 base_url=None, conversation_timeout=10 * 60, state_journal_fp=None, engagement_fp=None,
+                 weighted_sampling=False, user_state_db_fp=None):
+        """
+        :param photos_file_ids_fp: binary photo catalog built with `PhotoCatalog.build_from_json`
+        :param user_state_db_fp: `UserStateDb` of word permutations and review schedules shared by the workers
+        of the sharded mode. `sampler_state_fp` and `review_state_fp` are not used then
+        :param engagement_fp: file of `EngagementCounters`. counters are not saved if None
+        :param weighted_sampling: draw words proportionally to their engagement instead of walking
+        the permutation of the chat. liked words come back more often, so words may repeat
+        :param state_journal_fp: path prefix of `StateJournal` files to keep conversations across restarts.
+        conversations are lost on restart if None
+        :param base_url: Bot API url, e.g. of `fake_bot_api.FakeBotApiServer` in load tests. Telegram if None
+        :param conversation_timeout: seconds of inactivity after which /get and /feedback conversations end
+        """
         self.token = LieksikaBot.validate_variable(token)
         self.contact_chat_id = LieksikaBot.validate_variable(contact_chat_id)
 
         if not os.path.isfile(photos_file_ids_fp):
             raise FileNotFoundError(photos_file_ids_fp)
         self.photos_file_ids_fp = photos_file_ids_fp
-        with open(photos_file_ids_fp) as fin:
-            photo_file_ids = json.load(fin)
-            self.photos_file_ids = tuple(photo_file_ids.items())
+        # sequence of (photo name, file_id). replaced as a whole by `reload_photo_catalog`
+        self.photos_file_ids = PhotoCatalog(photos_file_ids_fp)
+        self.photo_catalog_check_interval = 60
+        # a replaced catalog is unmapped after handlers that took it before the reload are done with it
+        self.photo_catalog_close_delay = 5 * 60
+        self._photo_catalog_lock = threading.Lock()
+
+        # `/get N` sends N words as a single album. Telegram allows up to 10 photos in an album
+        self.max_bundle_size = 10
+        self.bundle_more_size = 5
+        # words drawn for a bundle that did not fit its orientation. chat_id -> word indices
+        self._bundle_leftovers = OrderedDict()
+        self.max_bundle_leftovers = 100_000
+        self._bundle_lock = threading.Lock()
+
+        # every user walks through own permutation of words to avoid repeats
+        self.user_state_db = None
+        if user_state_db_fp is not None:
+            self.user_state_db = UserStateDb(user_state_db_fp)
+            sampler_state_fp = review_state_fp = None
+        self.sampler_state_fp = sampler_state_fp
+        if self.user_state_db is None:
+            self.word_sampler = WordSampler.load_or_create(sampler_state_fp, len(self.photos_file_ids))
+        else:
+            self.word_sampler = SharedWordSampler(self.user_state_db, len(self.photos_file_ids))
+        self.sampler_save_interval = 5 * 60
+
+        # "Змяніць бягучае" skips the shown word, "Даслаць наступнае" accepts it
+        self.engagement_fp = engagement_fp
+        self.engagement = EngagementCounters.load_or_create(engagement_fp, len(self.photos_file_ids))
+        self.engagement_sampler = EngagementSampler(self.engagement) if weighted_sampling else None
+        self.engagement_rebuild_interval = 60
+
+        # spaced repetition schedule of words for /review
+        if self.user_state_db is None:
+            self.review_scheduler = ReviewScheduler(review_state_fp)
+        else:
+            self.review_scheduler = SharedReviewScheduler(self.user_state_db)
+        self.review_flush_interval = 60
+        self.review_remind_interval = 60 * 60
+
+        # textual search over the word catalog. built with `WordIndex.build`
+        self.word_index_fp = word_index_fp
+        self.word_index = None
+        if word_index_fp is not None and os.path.isfile(word_index_fp):
+            self.word_index = WordIndex(word_index_fp)
+
+        # answers to `@lieksika_bot <word>` inline queries
+        self.inline_results = InlineResultCache(self.photos_file_ids, self.word_index)
+        self.inline_random_cache_time = 10
+        self.inline_prefix_cache_time = 60 * 60
 
         self.mode = 'local'
         self.heroku_app_name = None
         self.heroku_port = None
+        self.worker_listen = None
+        self.worker_port = None
         self.prev_webhook_info = None
-
-        # store information about conversations, such as id of the message with InlineKeyboard to remove
-        self.conversation_context = dict()
-
-        self.updater = Updater(token, use_context=True, user_sig_handler=self.try_to_restore_webhook)
+        # asyncio execution mode, see `set_asyncio_mode`
+        self.asyncio_mode = False
+        self.async_max_in_flight = 10_000
+        self.async_dispatcher = None
+
+        self.conversation_timeout = conversation_timeout
+
+        # conversation states and context are journaled, so restarts and deploys don't break conversations
+        self.state_journal = None
+        self.persistence = None
+        restored = {}
+        if state_journal_fp is not None:
+            self.state_journal = StateJournal(state_journal_fp, max_age=self.conversation_timeout + 60)
+            restored = self.state_journal.load()
+            self.persistence = JournalPersistence(self.state_journal, ('feedback', 'get_word'), restored)
+
+        # store information about conversations, such as id of the message with InlineKeyboard to remove.
+        # keep records a bit longer than conversations, so timeout callbacks can still clean up
+        self.conversation_context = ConversationStore(ttl=self.conversation_timeout + 60, spill_fp=context_spill_fp,
+                                                      journal=self.state_journal,
+                                                      journal_table=TABLE_CONVERSATION_CONTEXT)
+        self.conversation_context.restore(restored)
+        self.conversation_context_expire_interval = 60
+
+        self.joke_provider = JokeProvider()
+
+        self.error_reports_dp = 'error_reports'
+        self.error_digest_interval = 10 * 60
+
+        self.updater = Updater(token, base_url=base_url, use_context=True, persistence=self.persistence,
+                               user_sig_handler=self.try_to_restore_webhook)
         self.dp = self.updater.dispatcher
+        # the threaded modes handle updates of different chats concurrently: a handler waiting
+        # for the turn of its chat in the scheduler doesn't hold back the other chats. installed by `launch`
+        self.update_lanes = ThreadedChatLanes()
+
+        # latency of handlers and Bot API calls, served in Prometheus format and summarized by /stats
+        REGISTRY.instrument_bot(self.updater.bot)
+        # every component sends through the scheduler: flood limits of Telegram are shared by the whole bot.
+        # installed over the metrics: `bot_api` latencies exclude the wait for a turn, it goes to `bot_queue`
+        self.bot_scheduler = BotScheduler().install(self.updater.bot)
+
+        # timeouts of /get and /feedback conversations, expired in batches by a single cleanup worker
+        self.conversation_timeouts = ConversationTimeouts(self.updater.bot)
+        self.metrics_host = '127.0.0.1'
+        self.metrics_port = 9100
+        self.metrics_server = None
+
+        # daily words broadcast. delivery time is entered by users in Minsk time (UTC+3)
+        self.utc_offset_minutes = 3 * 60
+        self.default_delivery_time = '09:00'
+        self.subscribers = SubscriberRegistry(subscribers_db_fp)
+        self.error_reporter = ErrorReporter(self.updater.bot, self.contact_chat_id, self.error_reports_dp)
+
+        # callback answers and keyboard removals are sent off the critical path of handlers
+        self.callback_pipeline = CallbackPipeline(self.updater.bot)
+
+        # #new_user and #feedback notifications are sent to the developer in batches
+        self.admin_notifier = AdminNotifier(self.updater.bot, self.contact_chat_id, admin_queue_db_fp)
+        self.admin_flush_interval = 30
+        self.broadcaster = Broadcaster(self.updater.bot, self.subscribers, self.show_word,
+                                       caption='#слова_дня')
 
         # conversation states
         self.CONV_STATE_FB_RECEIVING, self.CONV_STATE_FB_VERIFICATION = range(2)
@@ -102,11 +270,9 @@ class LieksikaBot:
         # inline keyboard callback data
         self.CB_DATA_GET_WORD_RESEND_CURRENT, self.CB_DATA_GET_WORD_SEND_NEXT = map(str, range(2))
         self.CB_DATA_FB_VERIFY, self.CB_DATA_FB_REJECT = map(str, range(2, 4))
-
-        # keys to use in conversation_context dict
-        self.K_GET_WORD_LAST_MESSAGE_ID = 'last_photo_message_id'
-        self.K_FB_MESSAGE_ID = 'feedback_message_id'
-        self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID = 'feedback_message_with_inline_keyboard'
+        self.CB_DATA_REVIEW_KNOW, self.CB_DATA_REVIEW_FORGOT = map(str, range(4, 6))
+        # followed by the bundle size, e.g. "6:5"
+        self.CB_DATA_GET_WORD_SEND_BUNDLE = '6'
 
         self.init_handlers()
 
@@ -114,9 +280,36 @@ class LieksikaBot:
         self.mode = 'heroku'
         self.heroku_app_name = LieksikaBot.validate_variable(heroku_app_name)
         self.heroku_port = int(LieksikaBot.validate_variable(heroku_port))
+        self.metrics_port = self.heroku_port + 1
+
+    def set_worker_mode(self, worker_port, shard_ix=0, listen='127.0.0.1'):
+        """
+        Receive updates forwarded by `webhook_router.WebhookRouter`. The router owns the Telegram webhook
+        and sends all updates of a chat to the same worker, so conversations of the worker only cover its chats.
+        Subscribers and review schedules are shared by the workers: only the first one sends broadcasts
+        and review reminders
+        :param shard_ix: index of the worker. workers on the same host get different metrics ports
+        """
+        self.mode = 'worker'
+        self.worker_listen = listen
+        self.worker_port = int(LieksikaBot.validate_variable(worker_port))
+        self.metrics_port = self.metrics_port + 1 + shard_ix
+        if shard_ix != 0:
+            for job in self.shared_jobs:
+                job.schedule_removal()
+
+    def set_asyncio_mode(self, max_in_flight=10_000):
+        """
+        Receive updates in an asyncio event loop with `AsyncDispatcher` instead of `Updater`.
+        /get and the buttons of its words are handled by coroutines, the other updates by the dispatcher
+        in a few threads. Polling or webhook is chosen by the mode as usual
+        :param max_in_flight: updates received and not handled yet
+        """
+        self.asyncio_mode = True
+        self.async_max_in_flight = max_in_flight
 
     def init_handlers(self):
-        conversation_feedback = ConversationHandler(
+        conversation_feedback = TimedConversationHandler(
             entry_points=[CommandHandler('feedback', self.feedback_start)],
             states={
                 self.CONV_STATE_FB_RECEIVING: [
@@ -134,16 +327,26 @@ class LieksikaBot:
                 MessageHandler(Filters.all, self.feedback_input_not_recognized)
             ],
             allow_reentry=True,
-            conversation_timeout=10 * 60
+            timeouts=self.conversation_timeouts,
+            conversation_timeout=self.conversation_timeout,
+            restored_cleanup=self.feedback_cleanup,
+            name='feedback',
+            persistent=self.persistence is not None
         )
 
-        conversation_get_word = ConversationHandler(
-            entry_points=[CommandHandler('get', self.get)],
+        conversation_get_word = TimedConversationHandler(
+            entry_points=[CommandHandler('get', self.get), CommandHandler('review', self.review)],
             states={
                 self.CONV_STATE_GET_WORD_RECEIVED: [
+                    # optionally followed by the shown word, e.g. "0:42". keyboards sent before have no word
                     CallbackQueryHandler(self.get_word_resend_current,
-                                         pattern=f'^{self.CB_DATA_GET_WORD_RESEND_CURRENT}$'),
-                    CallbackQueryHandler(self.get_word_send_next, pattern=f'^{self.CB_DATA_GET_WORD_SEND_NEXT}$')
+                                         pattern=f'^{self.CB_DATA_GET_WORD_RESEND_CURRENT}(:\\d+)?$'),
+                    CallbackQueryHandler(self.get_word_send_next,
+                                         pattern=f'^{self.CB_DATA_GET_WORD_SEND_NEXT}(:\\d+)?$'),
+                    CallbackQueryHandler(self.get_word_send_bundle,
+                                         pattern=f'^{self.CB_DATA_GET_WORD_SEND_BUNDLE}:\\d+$'),
+                    CallbackQueryHandler(self.review_graded,
+                                         pattern=f'^({self.CB_DATA_REVIEW_KNOW}|{self.CB_DATA_REVIEW_FORGOT})$')
                 ],
                 ConversationHandler.TIMEOUT: [
                     MessageHandler(Filters.all, self.get_word_timeout),
@@ -152,44 +355,240 @@ class LieksikaBot:
             },
             fallbacks=[MessageHandler(Filters.command, self.get_word_canceled)],
             allow_reentry=True,
-            conversation_timeout=10 * 60
+            timeouts=self.conversation_timeouts,
+            conversation_timeout=self.conversation_timeout,
+            restored_cleanup=self.get_word_cleanup,
+            name='get_word',
+            persistent=self.persistence is not None
         )
 
         self.dp.add_handler(CommandHandler('start', self.start), group=1)
         self.dp.add_handler(CommandHandler('about', self.about), group=1)
         self.dp.add_handler(CommandHandler('help', self.help), group=1)
         self.dp.add_handler(CommandHandler('joke', self.dad_joke), group=1)
+        self.dp.add_handler(CommandHandler('find', self.find), group=1)
+        self.dp.add_handler(CommandHandler('subscribe', self.subscribe), group=1)
+        self.dp.add_handler(CommandHandler('unsubscribe', self.unsubscribe), group=1)
+        self.dp.add_handler(InlineQueryHandler(self.inline_query), group=1)
+        self.dp.add_handler(CommandHandler('stats', self.stats), group=1)
         # ignore commands to avoid handling updates multiple times in different groups
         self.dp.add_handler(CommandHandler('get', self.ignore_update), group=1)
+        self.dp.add_handler(CommandHandler('review', self.ignore_update), group=1)
         self.dp.add_handler(CommandHandler('feedback', self.ignore_update), group=1)
         self.dp.add_handler(MessageHandler(Filters.command, self.unknown_command), group=1)
 
         self.dp.add_handler(conversation_feedback, group=2)
 
         self.dp.add_handler(conversation_get_word, group=3)
+        # states of the conversations are checked and updated by the handlers of the asyncio mode
+        self.conversation_feedback = conversation_feedback
+        self.conversation_get_word = conversation_get_word
+        if self.persistence is not None:
+            # restored conversations are loaded by `add_handler`: they time out with the time they had left
+            for handler in (conversation_feedback, conversation_get_word):
+                handler.arm_restored(self.persistence.restored_conversations(handler.name))
 
         self.dp.add_error_handler(self.error_handler)
 
+        # jobs over all users: a single worker of the sharded mode runs them
+        self.shared_jobs = [
+            self.updater.job_queue.run_repeating(self.broadcaster.start_due_runs,
+                                                 interval=self.broadcaster.bucket_minutes * 60, first=60),
+            self.updater.job_queue.run_repeating(self.remind_due_reviews, interval=self.review_remind_interval,
+                                                 first=self.review_remind_interval)
+        ]
+        self.updater.job_queue.run_repeating(self.expire_conversation_context,
+                                             interval=self.conversation_context_expire_interval)
+        self.updater.job_queue.run_repeating(self.review_scheduler.flush, interval=self.review_flush_interval)
+        self.updater.job_queue.run_repeating(self.reload_photo_catalog, interval=self.photo_catalog_check_interval,
+                                             first=self.photo_catalog_check_interval)
+        self.updater.job_queue.run_repeating(self.admin_notifier.start_flush, interval=self.admin_flush_interval)
+        self.updater.job_queue.run_repeating(self.error_reporter.digest, interval=self.error_digest_interval,
+                                             first=self.error_digest_interval)
+        if self.sampler_state_fp is not None:
+            self.updater.job_queue.run_repeating(self.save_sampler_state, interval=self.sampler_save_interval,
+                                                 first=self.sampler_save_interval)
+        if self.engagement_fp is not None:
+            self.updater.job_queue.run_repeating(self.save_engagement, interval=self.sampler_save_interval,
+                                                 first=self.sampler_save_interval)
+        if self.engagement_sampler is not None:
+            # alias tables are rebuilt in the job thread, draws of handlers keep using the old ones meanwhile
+            self.updater.job_queue.run_repeating(self.rebuild_word_weights, interval=self.engagement_rebuild_interval,
+                                                 first=self.engagement_rebuild_interval)
+
     def run(self):
+        self.launch()
+        if self.async_dispatcher is None:
+            self.updater.idle()
+        else:
+            stopped = threading.Event()
+
+            def on_signal(signum, frame):
+                self.try_to_restore_webhook(signum, frame)
+                stopped.set()
+
+            for signum in (SIGINT, SIGTERM):
+                signal.signal(signum, on_signal)
+            stopped.wait()
+            # stops the job queue
+            self.updater.stop()
+        self.shutdown()
+
+    def launch(self):
+        """
+        Start receiving updates and background jobs without blocking
+        """
         logger.info(f'\n*****************************************\n'
                     f'running LieksikaBot with next parameters:\n\n'
                     f'photos_file_ids_fp: "{self.photos_file_ids_fp}"\n'
+                    f'sampler_state_fp: "{self.sampler_state_fp}"\n'
+                    f'context_spill_fp: "{self.conversation_context.spill_fp}"\n'
+                    f'subscribers_db_fp: "{self.subscribers.db_fp}"\n'
+                    f'review_state_fp: "{self.review_scheduler.state_fp}"\n'
+                    f'user_state_db_fp: "{self.user_state_db and self.user_state_db.db_fp}"\n'
+                    f'word_index_fp: "{self.word_index_fp}"\n'
+                    f'admin_queue_db_fp: "{self.admin_notifier.db_fp}"\n'
+                    f'state_journal_fp: "{self.state_journal and self.state_journal.journal_fp}"\n'
+                    f'engagement_fp: "{self.engagement_fp}", weighted: {self.engagement_sampler is not None}\n'
                     f'mode: "{self.mode}"\n'
                     f'heroku_app_name: "{self.heroku_app_name}"\n'
                     f'heroku_port: "{self.heroku_port}"\n'
+                    f'worker: "{self.worker_listen}:{self.worker_port}"\n'
+                    f'asyncio: {self.asyncio_mode}\n'
+                    f'metrics: "{self.metrics_host}:{self.metrics_port}"\n'
                     f'*****************************************\n')
 
-        if self.mode == 'heroku':
+        self.bot_scheduler.start()
+        if not self.asyncio_mode:
+            self.update_lanes.install(self.dp).start()
+        if self.asyncio_mode:
+            self.launch_asyncio()
+        elif self.mode == 'heroku':
             self.updater.start_webhook(listen="0.0.0.0", port=self.heroku_port, url_path=self.token)
             self.updater.bot.setWebhook(f'https://{self.heroku_app_name}.herokuapp.com/{self.token}')
+        elif self.mode == 'worker':
+            # no certificate: the webhook of the bot is left to the router
+            self.updater.start_webhook(listen=self.worker_listen, port=self.worker_port, url_path=self.token)
         elif self.mode == 'local':
             self.prev_webhook_info = self.dp.bot.get_webhook_info()
             self.dp.bot.delete_webhook()
             self.updater.start_polling()
-        self.updater.idle()
+        # `kill -HUP` reloads the photo catalog right away instead of waiting for the periodic check
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_photo_catalog())
+        if self.state_journal is not None:
+            self.state_journal.start()
+        self.callback_pipeline.start()
+        self.conversation_timeouts.start()
+        self.joke_provider.start()
+        self.error_reporter.start()
+        try:
+            self.metrics_server = MetricsServer(REGISTRY, self.metrics_host, self.metrics_port).start()
+        except OSError as e:
+            logger.error(f'failed to start metrics server: {e}')
+
+    def launch_asyncio(self):
+        # `Updater.start_*` start the job queue in the threaded mode
+        self.updater.job_queue.start()
+        self.async_dispatcher = AsyncDispatcher(self.updater.bot.base_url, self.handle_update_async,
+                                                self.process_update_dict, scheduler=self.bot_scheduler,
+                                                max_in_flight=self.async_max_in_flight)
+        if self.mode == 'heroku':
+            self.async_dispatcher.start_webhook('0.0.0.0', self.heroku_port, self.token)
+            self.updater.bot.setWebhook(f'https://{self.heroku_app_name}.herokuapp.com/{self.token}')
+        elif self.mode == 'worker':
+            self.async_dispatcher.start_webhook(self.worker_listen, self.worker_port, self.token)
+        elif self.mode == 'local':
+            self.prev_webhook_info = self.dp.bot.get_webhook_info()
+            self.dp.bot.delete_webhook()
+            self.async_dispatcher.start_polling()
+
+    def shutdown(self):
+        """
+        Stop background jobs and save the state. Updater must be stopped already
+        """
+        if self.async_dispatcher is not None:
+            # received updates are handled before the components they use are stopped
+            self.async_dispatcher.stop()
+        self.update_lanes.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.joke_provider.stop()
+        # before the pipeline: keyboards of the last expired conversations are still stripped
+        self.conversation_timeouts.stop()
+        self.callback_pipeline.stop()
+        self.error_reporter.digest()
+        self.error_reporter.stop()
+        self.bot_scheduler.stop()
+        self.save_sampler_state()
+        self.save_engagement()
+        self.review_scheduler.flush()
+        if self.state_journal is not None:
+            self.state_journal.close()
+        self.conversation_context.close()
+        self.subscribers.close()
+        if self.user_state_db is not None:
+            self.user_state_db.close()
+        self.admin_notifier.close()
+
+    def expire_conversation_context(self, context: CallbackContext):
+        n_expired = self.conversation_context.expire()
+        if n_expired:
+            logger.info(f'expire_conversation_context. expired: {n_expired}, '
+                        f'stats: {self.conversation_context.stats()}')
+
+    def save_sampler_state(self, context: CallbackContext = None):
+        if self.sampler_state_fp is None:
+            return
+        try:
+            self.word_sampler.save(self.sampler_state_fp)
+        except OSError as e:
+            logger.exception(e)
+
+    def save_engagement(self, context: CallbackContext = None):
+        if self.engagement_fp is None:
+            return
+        try:
+            self.engagement.save(self.engagement_fp)
+        except OSError as e:
+            logger.exception(e)
+
+    def rebuild_word_weights(self, context: CallbackContext = None):
+        if self.engagement_sampler is not None:
+            self.engagement_sampler.rebuild_if_drifted()
+
+    def reload_photo_catalog(self, context: CallbackContext = None):
+        """
+        Map the photo catalog again if its file was replaced.
+        The new catalog is opened completely before it replaces the old one, handlers that already took
+        the old catalog finish with it: it is closed `photo_catalog_close_delay` seconds later
+        :return: True if the catalog was reloaded
+        """
+        with self._photo_catalog_lock:
+            try:
+                if file_signature(self.photos_file_ids_fp) == self.photos_file_ids.signature:
+                    return False
+                start = time.perf_counter()
+                catalog = PhotoCatalog(self.photos_file_ids_fp)
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f'reload_photo_catalog. failed to load "{self.photos_file_ids_fp}": {e}')
+                return False
+            inline_results = InlineResultCache(catalog, self.word_index)
+            previous = self.photos_file_ids
+            n_previous = len(previous)
+            self.photos_file_ids = catalog
+            self.inline_results = inline_results
+            self.word_sampler.resize(len(catalog))
+            self.engagement.resize(len(catalog))
+        self.updater.job_queue.run_once(lambda context: previous.close(), self.photo_catalog_close_delay)
+        # the size changed: drift is 1, tables are rebuilt
+        self.rebuild_word_weights()
+        logger.info(f'reload_photo_catalog. photos: {n_previous} -> {len(catalog)}, '
+                    f'elapsed: {time.perf_counter() - start:.3f} s')
+        return True
 
     def try_to_restore_webhook(self, signal, frame):
-        if signal == SIGINT:
+        # workers of the sharded mode don't own the webhook
+        if signal == SIGINT and self.prev_webhook_info is not None:
             to_try = bool(self.prev_webhook_info.url)
             logger.info(f'handling SIGINT signal. previous webhook url string is not empty: {to_try}')
             if to_try:
@@ -197,27 +596,16 @@ class LieksikaBot:
                 logger.info(f'have reset webhook url to previous value')
 
     def error_handler(self, update: Update, context: CallbackContext):
-        logger.error(f'Update:\n{update}')
-        logger.exception(context.error)
-
-        # send detailed report to developer
-        traceback_str = ''.join(traceback.format_tb(context.error.__traceback__))
-        user_info_str = self.get_user_info_str(update.effective_user)
-        # convert TelegramObject to json, load it to dict
-        # and then dump back to json with pretty indents
-        update_json = json.dumps(json.loads(update.to_json()), indent=2)
-        message = (f'#error\n\n'
-                   f'user:\n{user_info_str}\n\n'
-                   f'error:\n`{context.error}`\n\n')
-        error_fn = f'error_{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")}.txt'
-        with open(error_fn, 'w') as fout:
-            fout.write(f'user:\n{user_info_str}\n\n')
-            fout.write(f'error:\n{context.error}\n\n')
-            fout.write(f'traceback:\n{traceback_str}\n\n')
-            fout.write(f'update:\n{update_json}')
-        with open(error_fn, 'rb') as fin:
-            context.bot.send_document(self.contact_chat_id, document=fin, caption=message,
-                                      parse_mode=ParseMode.MARKDOWN)
+        # report is sent to developer by a background thread: an error storm must not block the dispatcher
+        user = update.effective_user if isinstance(update, Update) else None
+        user_info_str = self.get_user_info_str(user) if user is not None else None
+        is_new = self.error_reporter.report(update if isinstance(update, Update) else None, context.error,
+                                            user_info_str)
+        if is_new:
+            logger.error(f'Update:\n{update}')
+            logger.exception(context.error)
+        else:
+            logger.error(f'error_handler. repeated error: {type(context.error).__name__}: {context.error}')
 
     @staticmethod
     def get_user_info_str(user: User):
@@ -240,9 +628,7 @@ class LieksikaBot:
         self.help(update, context)
 
         # store id of the new user to send scheduled messages
-        user_info_str = self.get_user_info_str(update.effective_user)
-        description = f'#new_user\n\n{user_info_str}'
-        context.bot.send_message(self.contact_chat_id, description)
+        self.admin_notifier.notify_new_user(self.get_user_info_str(update.effective_user))
 
     @reject_edit_update
     @log_method_name_and_chat_id_from_update
@@ -253,9 +639,8 @@ class LieksikaBot:
             'Вялікі дзякуй іх распрацоўшчыкам за праведзеную працу, але, на жаль, '
             'рэсурсы маюць абмежаванні ў выкарыстанні.\n'
             'З мэтай скласці базу адметных словаў і аўтаматызаваць працэс іх паўтарэння быў створаны гэты бот.\n'
-            'У будучыні плануецца дадаць магчымасць рэгулярнай рассылкі словаў: '
-            'штодня вы зможаце атрымліваць падборку адметнай лексікі. Аднак нават зараз вы можаце '
-            'ў некалькі клікаў даведацца на новае слова!\n\n'
+            'Падпішыцеся на рассылку камандай /subscribe, і штодня вы будзеце атрымліваць новае адметнае слова. '
+            'А ў любы іншы момант вы можаце ў некалькі клікаў даведацца пра новае слова з дапамогай /get!\n\n'
             'Каб даслаць распрацоўшчыкам боту інфармацыю пра памылку альбо сваю параду, '
             'карыстайце каманду /feedback.\n'
             'Калі вы хочаце дапамагчы ў распрацоўцы гэтага боту, slounik.org, skarnik.by ці іншых беларускіх '
@@ -271,6 +656,12 @@ class LieksikaBot:
                f'альбо націснуць на вылучаны тэкст з камандай у любым паведамленні.\n\n'
                f'Спіс даступных камандаў:\n'
                f'/get: атрымаць выпадковае слова\n'
+               f'/get 5: атрымаць некалькі слоў адразу (да {self.max_bundle_size})\n'
+               f'/review: паўтарыць вывучаныя словы\n'
+               f'/find: знайсці слова (напрыклад, /find слова)\n'
+               f'@lieksika_bot слова: даслаць слова ў любы чат\n'
+               f'/subscribe: штодня атрымліваць новае слова (напрыклад, /subscribe 09:00)\n'
+               f'/unsubscribe: адпісацца ад штодзённай рассылкі\n'
                f'/about: апісанне боту\n'
                f'/feedback: напісаць распрацоўшчыкам\n'
                f'/help: паказаць спіс даступных камандаў\n'
@@ -281,17 +672,106 @@ class LieksikaBot:
     @reject_edit_update
     @log_method_name_and_chat_id_from_update
     def dad_joke(self, update, context):
-        url = "https://icanhazdadjoke.com/"
-        headers = {'Accept': 'application/json'}
+        joke = self.joke_provider.get()
+        if joke is None:
+            logger.info(f'dad_joke. jokes buffer is empty')
+            joke = 'Выбачайце! Праблемы з падлучэннем да серверу з жартамі)'
+        update.message.reply_text(joke)
+
+    @reject_edit_update
+    @log_method_name_and_chat_id_from_update
+    def find(self, update: Update, context: CallbackContext):
+        query = ' '.join(context.args)
+        if not query:
+            update.message.reply_text('Пазначце слова для пошуку, напрыклад: /find слова')
+            return
+        if self.word_index is None:
+            update.message.reply_text('Выбачайце, пошук словаў пакуль недаступны')
+            return
+
+        entries, is_exact = self.word_index.find(query)
+        logger.info(f'find. query: "{query}", found: {len(entries)}, exact: {is_exact}')
+        if not entries:
+            update.message.reply_text(f'Выбачайце, слова "{query}" не знойдзенае')
+            return
+
+        best, others = entries[0], [x['headword'] for x in entries[1:]]
+        if not is_exact:
+            update.message.reply_text(f'Слова "{query}" не знойдзенае. Магчыма, вы мелі на ўвазе '
+                                      f'"{best["headword"]}"?')
+        if best['file_id'] is not None:
+            update.message.reply_photo(best['file_id'], caption=best['headword'])
+        else:
+            update.message.reply_text(f'{best["headword"]}\n\n{best["definition"]}')
+        if others:
+            update.message.reply_text(f'{"Таксама знойдзеныя" if is_exact else "Падобныя словы"}: '
+                                      f'{", ".join(others)}')
+
+    @timed
+    def inline_query(self, update: Update, context: CallbackContext):
+        query = update.inline_query
+        results, next_offset = self.inline_results.get(query.query, query.offset)
+        # random words must differ between users, prefix matches can be cached by Telegram for longer
+        cache_time = self.inline_prefix_cache_time if query.query.strip() else self.inline_random_cache_time
+        query.answer(results, cache_time=cache_time, next_offset=next_offset)
+
+    @staticmethod
+    def parse_time_of_day(text):
+        """
+        :return: minute of the day for "HH:MM" string or None if the string is not a valid time
+        """
         try:
-            r = requests.request("GET", url, headers=headers)
-            joke = r.json()['joke']
-            update.message.reply_text(joke)
-        except Exception as e:
-            update.message.reply_text('Выбачайце! Праблемы з падлучэннем да серверу з жартамі)')
-            logger.exception(e)
+            time_of_day = datetime.datetime.strptime(text.strip(), '%H:%M')
+        except ValueError:
+            return None
+        return time_of_day.hour * 60 + time_of_day.minute
 
     @reject_edit_update
+    @log_method_name_and_chat_id_from_update
+    def subscribe(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_user.id
+        time_str = context.args[0] if context.args else self.default_delivery_time
+        minute = self.parse_time_of_day(time_str)
+        if minute is None:
+            update.message.reply_text(f'Выбачайце, не атрымалася распазнаць час "{time_str}". '
+                                      f'Пазначце яго ў фармаце ГГ:ХХ, напрыклад: /subscribe 09:00')
+            return
+        self.subscribers.subscribe(chat_id, minute - self.utc_offset_minutes)
+        update.message.reply_text(f'Вы падпісаліся на рассылку! Штодня а {time_str} (па мінскім часе) '
+                                  f'вы будзеце атрымліваць новае слова.\n'
+                                  f'Каб змяніць час, зноў скарыстайце /subscribe ГГ:ХХ, '
+                                  f'каб адпісацца - /unsubscribe')
+
+    @reject_edit_update
+    @log_method_name_and_chat_id_from_update
+    def stats(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_user.id
+        if str(chat_id) != str(self.contact_chat_id):
+            self.unknown_command(update, context)
+            return
+        msg = (f'latency:\n{REGISTRY.summary()}\n\n'
+               f'bot api queue: {self.bot_scheduler.stats()}\n'
+               f'conversation timeouts: {self.conversation_timeouts.stats()}\n'
+               f'chat lanes: {self.update_lanes.stats()}\n'
+               f'asyncio: {self.async_dispatcher and self.async_dispatcher.stats()}\n'
+               f'admin notifications: {self.admin_notifier.stats()}\n'
+               f'errors: {self.error_reporter.stats()}\n'
+               f'conversation context: {self.conversation_context.stats()}\n'
+               f'inline results: {self.inline_results.stats()}\n'
+               f'subscribers: {self.subscribers.count()}')
+        update.message.reply_text(msg[:4096])
+
+    @reject_edit_update
+    @log_method_name_and_chat_id_from_update
+    def unsubscribe(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_user.id
+        if self.subscribers.unsubscribe(chat_id):
+            update.message.reply_text('Вы адпісаліся ад штодзённай рассылкі. Вярнуцца можна з дапамогай /subscribe')
+        else:
+            update.message.reply_text('Вы не падпісаныя на рассылку. Падпісацца можна з дапамогай /subscribe')
+
+    @reject_edit_update
+    @timed
     def unknown_command(self, update: Update, context: CallbackContext):
         chat_id = update.effective_user.id
         text = update.effective_message.text
@@ -306,8 +786,7 @@ class LieksikaBot:
     def feedback_start(self, update, context):
         chat_id = update.effective_user.id
 
-        if chat_id not in self.conversation_context:
-            self.conversation_context[chat_id] = dict()
+        self.conversation_context.get_or_create(chat_id)
         self.feedback_cleanup(chat_id, context.bot)
 
         update.message.reply_text(
@@ -322,8 +801,9 @@ class LieksikaBot:
     @log_method_name_and_chat_id_from_update
     def feedback_received(self, update, context: CallbackContext):
         chat_id = update.effective_user.id
+        conv_context = self.conversation_context.get_or_create(chat_id)
 
-        self.conversation_context[chat_id][self.K_FB_MESSAGE_ID] = update.message.message_id
+        conv_context.fb_message_id = update.message.message_id
         reply_markup = InlineKeyboardMarkup([[
             InlineKeyboardButton('Так', callback_data=self.CB_DATA_FB_VERIFY),
             InlineKeyboardButton('Не', callback_data=self.CB_DATA_FB_REJECT)
@@ -331,48 +811,40 @@ class LieksikaBot:
         res = update.message.reply_text(
             f'Вы хочаце даслаць гэтае паведамленне? (тэкст у паведамленні на гэтым кроку ўсё яшчэ можна рэдагаваць)',
             reply_markup=reply_markup,
-            reply_to_message_id=self.conversation_context[chat_id][self.K_FB_MESSAGE_ID]
+            reply_to_message_id=conv_context.fb_message_id
         )
-        self.conversation_context[chat_id][self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID] = res.message_id
+        conv_context.fb_message_with_inline_keyboard_id = res.message_id
 
         return self.CONV_STATE_FB_VERIFICATION
 
     def feedback_cleanup(self, chat_id, bot):
-        logger.info(f'feedback_cleanup. chat_id: {chat_id}')
-        if self.K_FB_MESSAGE_ID in self.conversation_context[chat_id]:
-            del self.conversation_context[chat_id][self.K_FB_MESSAGE_ID]
-        if self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID in self.conversation_context[chat_id]:
-            try:
-                bot.edit_message_reply_markup(
-                    chat_id,
-                    self.conversation_context[chat_id][self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID],
-                    reply_markup=None
-                )
-            except BadRequest as e:
-                logger.error(e)
-            finally:
-                del self.conversation_context[chat_id][self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID]
+        logger.info('feedback_cleanup. chat_id: %s', chat_id, extra={'chat_id': chat_id})
+        conv_context = self.conversation_context.get(chat_id)
+        if conv_context is None:
+            return
+        conv_context.fb_message_id = None
+        self.callback_pipeline.strip_keyboard(chat_id, conv_context.fb_message_with_inline_keyboard_id)
+        conv_context.fb_message_with_inline_keyboard_id = None
 
     @log_method_name_and_chat_id_from_update
     def feedback_verified(self, update: Update, context: CallbackContext):
         query = update.callback_query
         chat_id = update.effective_user.id
+        fb_message_id = self.conversation_context.get_or_create(chat_id).fb_message_id
 
+        self.callback_pipeline.answer_callback(query.id)
         user_info_str = self.get_user_info_str(update.effective_user)
-        context.bot.send_message(self.contact_chat_id, f'#feedback\n\nuser:\n{user_info_str}')
-        context.bot.forward_message(
-            chat_id=self.contact_chat_id,
-            from_chat_id=chat_id,
-            message_id=self.conversation_context[chat_id][self.K_FB_MESSAGE_ID])
-
-        context.bot.send_message(chat_id, 'Вашае паведамленне (яно прыведзенае ніжэй) дасланае распрацоўшчыку.\n'
-                                          'Вялікі дзякуй!')
-        context.bot.forward_message(
-            chat_id=chat_id,
-            from_chat_id=chat_id,
-            message_id=self.conversation_context[chat_id][self.K_FB_MESSAGE_ID])
+        if self.admin_notifier.notify_feedback(user_info_str, chat_id, fb_message_id):
+            context.bot.send_message(chat_id, 'Вашае паведамленне (яно прыведзенае ніжэй) дасланае распрацоўшчыку.\n'
+                                              'Вялікі дзякуй!')
+            context.bot.forward_message(
+                chat_id=chat_id,
+                from_chat_id=chat_id,
+                message_id=fb_message_id)
+        else:
+            context.bot.send_message(chat_id, 'Выбачайце, зараз распрацоўшчыкі атрымліваюць зашмат паведамленняў. '
+                                              'Паспрабуйце, калі ласка, пазней з дапамогай /feedback')
 
-        context.bot.answer_callback_query(callback_query_id=query.id)
         self.feedback_cleanup(chat_id, context.bot)
 
         return ConversationHandler.END
@@ -382,7 +854,7 @@ class LieksikaBot:
         chat_id = update.effective_user.id
         # some calls are from inline keyboard
         if update.callback_query is not None:
-            context.bot.answer_callback_query(callback_query_id=update.callback_query.id)
+            self.callback_pipeline.answer_callback(update.callback_query.id)
         self.feedback_cleanup(chat_id, context.bot)
         context.bot.send_message(chat_id, 'Размова перарваная')
 
@@ -401,11 +873,8 @@ class LieksikaBot:
     @log_method_name_and_chat_id_from_update
     def feedback_input_not_recognized(self, update, context):
         chat_id = update.effective_user.id
-        context.bot.edit_message_reply_markup(
-            chat_id,
-            self.conversation_context[chat_id][self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID],
-            reply_markup=None
-        )
+        conv_context = self.conversation_context.get_or_create(chat_id)
+        self.callback_pipeline.strip_keyboard(chat_id, conv_context.fb_message_with_inline_keyboard_id)
         reply_markup = InlineKeyboardMarkup([[
             InlineKeyboardButton('Так', callback_data=self.CB_DATA_FB_VERIFY),
             InlineKeyboardButton('Не', callback_data=self.CB_DATA_FB_REJECT)
@@ -413,9 +882,9 @@ class LieksikaBot:
         res = update.message.reply_text(
             f'Вы хочаце даслаць гэтае паведамленне? (тэкст у паведамленні на гэтым кроку ўсё яшчэ можна рэдагаваць)',
             reply_markup=reply_markup,
-            reply_to_message_id=self.conversation_context[chat_id][self.K_FB_MESSAGE_ID]
+            reply_to_message_id=conv_context.fb_message_id
         )
-        self.conversation_context[chat_id][self.K_FB_MESSAGE_WITH_INLINE_KEYBOARD_ID] = res.message_id
+        conv_context.fb_message_with_inline_keyboard_id = res.message_id
 
     # -------------- end of feedback conversation methods --------------
 
@@ -424,36 +893,158 @@ class LieksikaBot:
 
     # -------------- get word conversation methods --------------
 
-    def get_random_photo_object(self, chat_id):
-        ix = np.random.randint(0, len(self.photos_file_ids))
-        photo = self.photos_file_ids[ix][1]
-        logger.info(f'get_random_photo_object. chat_id: {chat_id}, file_id: "{photo}"')
-        return photo
-
-    def _send_photo(self, bot, chat_id, photo):
+    def draw_word(self, chat_id):
+        """
+        :return: index of the next word for the chat: weighted by engagement or from the permutation of the chat.
+        Photos removed from the catalog are skipped
+        """
+        catalog = self.photos_file_ids
+        # at most a whole permutation: the catalog may consist of removed photos only
+        for _ in range(len(catalog)):
+            if self.engagement_sampler is not None:
+                ix = self.engagement_sampler.draw()
+            else:
+                ix = self.word_sampler.draw(chat_id)
+            # samplers are resized right after a reload, a draw in between may be out of the new catalog
+            ix %= len(catalog)
+            if not catalog.is_removed(ix):
+                break
+        return ix
+
+    def word_keyboard(self, word_ix=None):
+        """
+        :param word_ix: the shown word. it is put into the callback data, so reactions to it are counted
+        without keeping the shown word of every chat
+        """
+        suffix = '' if word_ix is None else f':{word_ix}'
         buttons = [
-            [InlineKeyboardButton(text='Змяніць бягучае', callback_data=self.CB_DATA_GET_WORD_RESEND_CURRENT)],
-            [InlineKeyboardButton(text='Даслаць наступнае', callback_data=self.CB_DATA_GET_WORD_SEND_NEXT)]
+            [InlineKeyboardButton(text='Змяніць бягучае',
+                                  callback_data=f'{self.CB_DATA_GET_WORD_RESEND_CURRENT}{suffix}')],
+            [InlineKeyboardButton(text='Даслаць наступнае', callback_data=f'{self.CB_DATA_GET_WORD_SEND_NEXT}{suffix}')]
         ]
-        keyboard = InlineKeyboardMarkup(buttons)
+        return InlineKeyboardMarkup(buttons)
+
+    @staticmethod
+    def parse_word_ix(callback_data):
+        """
+        :return: word index of `word_keyboard` callback data, None if it has none
+        """
+        _, _, word_ix = callback_data.partition(':')
+        return int(word_ix) if word_ix.isdigit() else None
+
+    def show_word(self, chat_id):
+        """
+        Draw the next word for the chat and count it as shown
+        :return: (word index, file_id of its photo)
+        """
+        catalog = self.photos_file_ids
+        ix = self.draw_word(chat_id)
+        self.engagement.record(SHOWN, ix)
+        return ix, catalog[ix][1]
+
+    def send_word(self, bot, chat_id):
+        """
+        Draw the next word and send it with `word_keyboard`
+        """
+        ix, photo = self.show_word(chat_id)
+        logger.info('send_word. chat_id: %s, word_ix: %s', chat_id, ix, extra={'chat_id': chat_id})
+        self._send_photo(bot, chat_id, photo, keyboard=self.word_keyboard(ix))
+
+    def _send_photo(self, bot, chat_id, photo, keyboard=None):
+        if keyboard is None:
+            keyboard = self.word_keyboard()
         res = bot.send_photo(
             chat_id=chat_id,
             photo=photo,
             reply_markup=keyboard
         )
-        self.conversation_context[chat_id][self.K_GET_WORD_LAST_MESSAGE_ID] = res.message_id
+        self.conversation_context.get_or_create(chat_id).last_photo_message_id = res.message_id
+
+    def parse_bundle_size(self, args):
+        """
+        :param args: arguments of /get command
+        :return: number of words to send, 1 if not specified or invalid
+        """
+        if not args or not args[0].isdigit():
+            return 1
+        return max(1, min(int(args[0]), self.max_bundle_size))
+
+    def draw_bundle(self, chat_id, n_words):
+        """
+        Draw up to `n_words` distinct words of the same orientation, so the album has a uniform layout.
+        Words are drawn with `draw_word`: from the permutation of the chat, which keeps the no-repeat guarantee,
+        or weighted by engagement. Drawn words of another orientation are kept for the next bundles of the chat
+        instead of being skipped
+        :return: list of word indices
+        """
+        catalog = self.photos_file_ids
+        with self._bundle_lock:
+            drawn = [ix for ix in self._bundle_leftovers.pop(chat_id, ()) if ix < len(catalog)]
+        groups = {}
+        for ix in drawn:
+            groups.setdefault(catalog.orientation(ix), []).append(ix)
+        # at most a whole permutation: the catalog may have less than `n_words` photos of every orientation
+        for _ in range(len(catalog)):
+            if any(len(group) >= n_words for group in groups.values()):
+                break
+            ix = self.draw_word(chat_id)
+            if ix in drawn:
+                # the permutation of the chat started over or a weighted draw repeated the word
+                continue
+            drawn.append(ix)
+            groups.setdefault(catalog.orientation(ix), []).append(ix)
+        bundle = max(groups.values(), key=len)[:n_words] if groups else []
+
+        in_bundle = set(bundle)
+        leftovers = [ix for ix in drawn if ix not in in_bundle][:4 * self.max_bundle_size]
+        if leftovers:
+            with self._bundle_lock:
+                self._bundle_leftovers[chat_id] = leftovers
+                if len(self._bundle_leftovers) > self.max_bundle_leftovers:
+                    self._bundle_leftovers.popitem(last=False)
+        return bundle
+
+    def show_bundle(self, chat_id, n_words):
+        """
+        Draw a bundle with `draw_bundle` and count its words as shown
+        :return: list of file_ids of the photos
+        """
+        catalog = self.photos_file_ids
+        word_ixs = self.draw_bundle(chat_id, n_words)
+        for ix in word_ixs:
+            self.engagement.record(SHOWN, ix)
+        logger.info('show_bundle. chat_id: %s, words: %s', chat_id, len(word_ixs), extra={'chat_id': chat_id})
+        return [catalog[ix][1] for ix in word_ixs]
+
+    def bundle_keyboard(self):
+        # albums can't have inline keyboards: the button goes with the message after the album
+        return InlineKeyboardMarkup([[InlineKeyboardButton(
+            text=f'Даслаць яшчэ {self.bundle_more_size}',
+            callback_data=f'{self.CB_DATA_GET_WORD_SEND_BUNDLE}:{self.bundle_more_size}')]])
+
+    def _send_bundle(self, bot, chat_id, n_words):
+        """
+        :return: number of words sent
+        """
+        photos = self.show_bundle(chat_id, n_words)
+        bot.send_media_group(chat_id, [InputMediaPhoto(media=photo) for photo in photos])
+        res = bot.send_message(chat_id, f'Словаў у падборцы: {len(photos)}', reply_markup=self.bundle_keyboard())
+        self.conversation_context.get_or_create(chat_id).last_photo_message_id = res.message_id
+        return len(photos)
 
     @reject_edit_update
     @log_method_name_and_chat_id_from_update
     def get(self, update: Update, context: CallbackContext):
         chat_id = update.effective_user.id
 
-        if chat_id not in self.conversation_context:
-            self.conversation_context[chat_id] = dict()
+        self.conversation_context.get_or_create(chat_id)
         self.get_word_cleanup(chat_id, context.bot)
 
-        photo = self.get_random_photo_object(chat_id)
-        self._send_photo(context.bot, chat_id, photo)
+        n_words = self.parse_bundle_size(context.args)
+        if n_words > 1:
+            self._send_bundle(context.bot, chat_id, n_words)
+        else:
+            self.send_word(context.bot, chat_id)
 
         return self.CONV_STATE_GET_WORD_RECEIVED
 
@@ -462,45 +1053,48 @@ class LieksikaBot:
         query = update.callback_query
         chat_id = query.from_user.id
 
-        photo = self.get_random_photo_object(chat_id)
-
-        buttons = [
-            [InlineKeyboardButton(text='Змяніць бягучае', callback_data=self.CB_DATA_GET_WORD_RESEND_CURRENT)],
-            [InlineKeyboardButton(text='Даслаць наступнае', callback_data=self.CB_DATA_GET_WORD_SEND_NEXT)]
-        ]
-        keyboard = InlineKeyboardMarkup(buttons)
+        self.callback_pipeline.answer_callback(query.id)
+        skipped_ix = self.parse_word_ix(query.data)
+        if skipped_ix is not None:
+            self.engagement.record(SKIPPED, skipped_ix)
+        ix, photo = self.show_word(chat_id)
 
         context.bot.edit_message_media(
             chat_id=chat_id,
             message_id=query.message.message_id,
             media=InputMediaPhoto(media=photo),
-            reply_markup=keyboard
+            reply_markup=self.word_keyboard(ix)
         )
-        context.bot.answer_callback_query(callback_query_id=query.id)
 
     def get_word_cleanup(self, chat_id, bot):
-        logger.info(f'get_word_cleanup. chat_id: {chat_id}')
-        if self.K_GET_WORD_LAST_MESSAGE_ID in self.conversation_context[chat_id]:
-            try:
-                bot.edit_message_reply_markup(
-                    chat_id,
-                    self.conversation_context[chat_id][self.K_GET_WORD_LAST_MESSAGE_ID],
-                    reply_markup=None
-                )
-            except BadRequest as e:
-                logger.error(e)
-            finally:
-                del self.conversation_context[chat_id][self.K_GET_WORD_LAST_MESSAGE_ID]
+        logger.info('get_word_cleanup. chat_id: %s', chat_id, extra={'chat_id': chat_id})
+        conv_context = self.conversation_context.get(chat_id)
+        if conv_context is not None and conv_context.last_photo_message_id is not None:
+            self.callback_pipeline.strip_keyboard(chat_id, conv_context.last_photo_message_id)
+            conv_context.last_photo_message_id = None
+            conv_context.review_word_ix = None
 
     @log_method_name_and_chat_id_from_update
     def get_word_send_next(self, update, context):
         query = update.callback_query
         chat_id = query.from_user.id
 
-        photo = self.get_random_photo_object(chat_id)
+        self.callback_pipeline.answer_callback(query.id)
+        accepted_ix = self.parse_word_ix(query.data)
+        if accepted_ix is not None:
+            self.engagement.record(ACCEPTED, accepted_ix)
+        self.get_word_cleanup(chat_id, context.bot)
+        self.send_word(context.bot, chat_id)
+
+    @log_method_name_and_chat_id_from_update
+    def get_word_send_bundle(self, update, context):
+        query = update.callback_query
+        chat_id = query.from_user.id
+
+        self.callback_pipeline.answer_callback(query.id)
+        n_words = self.parse_bundle_size(query.data.split(':')[1:])
         self.get_word_cleanup(chat_id, context.bot)
-        self._send_photo(context.bot, query.from_user.id, photo)
-        context.bot.answer_callback_query(callback_query_id=query.id)
+        self._send_bundle(context.bot, chat_id, n_words)
 
     @log_method_name_and_chat_id_from_update(update_pos_arg_ix=1)
     def get_word_timeout(self, bot, update):
@@ -514,4 +1108,189 @@ class LieksikaBot:
 
         return ConversationHandler.END
 
+    def _send_review_word(self, bot, chat_id):
+        catalog = self.photos_file_ids
+        # words out of the catalog are skipped, words of removed photos are not reviewed anymore
+        word_ix = self.review_scheduler.next_due_word(chat_id, len(catalog))
+        while word_ix is not None and catalog.is_removed(word_ix):
+            self.review_scheduler.drop(chat_id, word_ix)
+            word_ix = self.review_scheduler.next_due_word(chat_id, len(catalog))
+        if word_ix is None:
+            # nothing to repeat yet: start learning a new word
+            word_ix = self.draw_word(chat_id)
+            self.review_scheduler.add(chat_id, word_ix)
+        logger.info('_send_review_word. chat_id: %s, word_ix: %s', chat_id, word_ix, extra={'chat_id': chat_id})
+
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton(text='Ведаю', callback_data=self.CB_DATA_REVIEW_KNOW),
+            InlineKeyboardButton(text='Не ведаю', callback_data=self.CB_DATA_REVIEW_FORGOT)
+        ]])
+        self._send_photo(bot, chat_id, catalog[word_ix][1], keyboard=keyboard)
+        self.conversation_context.get_or_create(chat_id).review_word_ix = word_ix
+
+    @reject_edit_update
+    @log_method_name_and_chat_id_from_update
+    def review(self, update: Update, context: CallbackContext):
+        chat_id = update.effective_user.id
+
+        self.conversation_context.get_or_create(chat_id)
+        self.get_word_cleanup(chat_id, context.bot)
+
+        n_learning, n_learned = self.review_scheduler.progress(chat_id)
+        if n_learning:
+            update.message.reply_text(f'Словаў у вывучэнні: {n_learning}, з іх добра запомненых: {n_learned}')
+        self._send_review_word(context.bot, chat_id)
+
+        return self.CONV_STATE_GET_WORD_RECEIVED
+
+    @log_method_name_and_chat_id_from_update
+    def review_graded(self, update: Update, context: CallbackContext):
+        query = update.callback_query
+        chat_id = query.from_user.id
+
+        conv_context = self.conversation_context.get_or_create(chat_id)
+        if conv_context.review_word_ix is not None:
+            self.review_scheduler.grade(chat_id, conv_context.review_word_ix,
+                                        knew=query.data == self.CB_DATA_REVIEW_KNOW)
+        self.callback_pipeline.answer_callback(query.id)
+        self.get_word_cleanup(chat_id, context.bot)
+        self._send_review_word(context.bot, chat_id)
+
+    def remind_due_reviews(self, context: CallbackContext):
+        chat_ids = self.review_scheduler.pop_due_chats()
+        logger.info(f'remind_due_reviews. chats with due words: {len(chat_ids)}')
+        for chat_id in chat_ids:
+            try:
+                context.bot.send_message(chat_id, 'Час паўтарыць словы! Націсніце /review')
+            except TelegramError as e:
+                logger.error(f'remind_due_reviews. chat_id: {chat_id}: {e}')
+
     # -------------- end of get word conversation methods --------------
+
+    # -------------- asyncio mode --------------
+
+    def process_update_dict(self, update):
+        """
+        Handle an update of the asyncio mode by the dispatcher. Runs in a fallback thread of `AsyncDispatcher`
+        """
+        self.dp.process_update(Update.de_json(update, self.dp.bot))
+
+    async def handle_update_async(self, api, update):
+        """
+        Handle the hot updates of the /get conversation with coroutines: /get, /get N and the buttons under
+        words and bundles. Everything else is left to the dispatcher, as are /get commands that end
+        a feedback conversation and buttons of chats not in the /get conversation
+        :param update: update as a dict
+        :return: False if the update is left to the dispatcher
+        """
+        try:
+            if 'message' in update:
+                return await self._handle_message_async(api, update['message'])
+            if 'callback_query' in update:
+                return await self._handle_callback_query_async(api, update['callback_query'])
+        except Exception as e:
+            update_obj = Update.de_json(update, self.dp.bot)
+            self.error_handler(update_obj, CallbackContext.from_error(update_obj, e, self.dp))
+            return True
+        return False
+
+    async def _handle_message_async(self, api, message):
+        entities = message.get('entities') or ()
+        if not entities or entities[0].get('type') != 'bot_command' or entities[0].get('offset') != 0:
+            return False
+        text = message.get('text') or ''
+        # "/get@lieksika_bot" is left to `CommandHandler`, it checks the mention
+        if text[1:entities[0]['length']].lower() != 'get':
+            return False
+        chat_id = message['from']['id']
+        # conversation key of `ConversationHandler`: (chat id, user id)
+        key = (message['chat']['id'], chat_id)
+        if key in self.conversation_feedback.conversations:
+            return False
+        await self.get_async(api, chat_id, text.split()[1:])
+        self.conversation_get_word.update_state_and_arm(key, self.CONV_STATE_GET_WORD_RECEIVED)
+        return True
+
+    async def _handle_callback_query_async(self, api, query):
+        data = query.get('data') or ''
+        kind, sep, arg = data.partition(':')
+        # patterns of the /get conversation handlers
+        if kind not in (self.CB_DATA_GET_WORD_RESEND_CURRENT, self.CB_DATA_GET_WORD_SEND_NEXT,
+                        self.CB_DATA_GET_WORD_SEND_BUNDLE):
+            return False
+        if (sep and not arg.isdigit()) or (kind == self.CB_DATA_GET_WORD_SEND_BUNDLE and not sep):
+            return False
+        if 'message' not in query:
+            return False
+        chat_id = query['from']['id']
+        key = (query['message']['chat']['id'], chat_id)
+        if self.conversation_get_word.conversations.get(key) != self.CONV_STATE_GET_WORD_RECEIVED:
+            return False
+        await self.get_word_button_async(api, chat_id, query, kind)
+        self.conversation_get_word.update_state_and_arm(key)
+        return True
+
+    async def _answer_callback_async(self, api, callback_query_id):
+        try:
+            await api.call('answerCallbackQuery', {'callback_query_id': callback_query_id})
+        except TelegramError as e:
+            logger.error(f'_answer_callback_async. failed to answer callback query: {e}')
+
+    async def _send_photo_async(self, api, chat_id, photo, keyboard):
+        message = await api.call('sendPhoto', {'chat_id': chat_id, 'photo': photo,
+                                               'reply_markup': keyboard.to_dict()})
+        self.conversation_context.get_or_create(chat_id).last_photo_message_id = message['message_id']
+
+    async def send_word_async(self, api, chat_id):
+        ix, photo = self.show_word(chat_id)
+        logger.info('send_word_async. chat_id: %s, word_ix: %s', chat_id, ix, extra={'chat_id': chat_id})
+        await self._send_photo_async(api, chat_id, photo, self.word_keyboard(ix))
+
+    async def _send_bundle_async(self, api, chat_id, n_words):
+        photos = self.show_bundle(chat_id, n_words)
+        await api.call('sendMediaGroup', {'chat_id': chat_id,
+                                          'media': [{'type': 'photo', 'media': photo} for photo in photos]})
+        message = await api.call('sendMessage', {'chat_id': chat_id, 'text': f'Словаў у падборцы: {len(photos)}',
+                                                 'reply_markup': self.bundle_keyboard().to_dict()})
+        self.conversation_context.get_or_create(chat_id).last_photo_message_id = message['message_id']
+
+    @log_async_handler
+    async def get_async(self, api, chat_id, args):
+        self.conversation_context.get_or_create(chat_id)
+        self.get_word_cleanup(chat_id, None)
+
+        n_words = self.parse_bundle_size(args)
+        if n_words > 1:
+            await self._send_bundle_async(api, chat_id, n_words)
+        else:
+            await self.send_word_async(api, chat_id)
+
+    @log_async_handler
+    async def get_word_button_async(self, api, chat_id, query, kind):
+        """
+        `get_word_resend_current`, `get_word_send_next` and `get_word_send_bundle` of the asyncio mode
+        """
+        # the spinner clears while the word is being sent, as with `callback_pipeline`
+        answering = asyncio.ensure_future(self._answer_callback_async(api, query['id']))
+        try:
+            if kind == self.CB_DATA_GET_WORD_RESEND_CURRENT:
+                skipped_ix = self.parse_word_ix(query['data'])
+                if skipped_ix is not None:
+                    self.engagement.record(SKIPPED, skipped_ix)
+                ix, photo = self.show_word(chat_id)
+                await api.call('editMessageMedia', {'chat_id': chat_id, 'message_id': query['message']['message_id'],
+                                                    'media': {'type': 'photo', 'media': photo},
+                                                    'reply_markup': self.word_keyboard(ix).to_dict()})
+            elif kind == self.CB_DATA_GET_WORD_SEND_NEXT:
+                accepted_ix = self.parse_word_ix(query['data'])
+                if accepted_ix is not None:
+                    self.engagement.record(ACCEPTED, accepted_ix)
+                self.get_word_cleanup(chat_id, None)
+                await self.send_word_async(api, chat_id)
+            else:
+                self.get_word_cleanup(chat_id, None)
+                await self._send_bundle_async(api, chat_id, self.parse_bundle_size(query['data'].split(':')[1:]))
+        finally:
+            await answering
+
+    # -------------- end of asyncio mode --------------
@@ -0,0 +1,428 @@
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from fake_bot_api import FakeBotApiServer
+from lieksika_bot import LieksikaBot
+from photo_catalog import ORIENTATION_HORIZONTAL, ORIENTATION_VERTICAL, PhotoCatalog
+from webhook_router import WebhookRouter
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FAKE_TOKEN = '123456:fake'
+FIRST_CHAT_ID = 1000
+
+# share of user actions in generated streams
+DEFAULT_MIX = {'get': 0.3, 'next': 0.35, 'change': 0.2, 'feedback': 0.05, 'idle': 0.1}
+
+# callback data of the bot's inline keyboards
+CB_DATA = {'change': '0', 'next': '1', 'feedback_verify': '2'}
+
+
+# -------------- update streams --------------
+
+def generate_events(n_updates, n_users, mix=None, idle_seconds=(1.0, 5.0), seed=None):
+    """
+    Generate a synthetic stream of user actions.
+
+    A user presses "next" and "change current" only while the photo with buttons is shown: otherwise /get is sent.
+    /feedback is followed by a text message and the verification. "idle" pauses the user, so conversations
+    longer idle than the bot's `conversation_timeout` time out.
+    :param mix: dict: action -> share. actions are keys of `DEFAULT_MIX`
+    :return: list of events: dicts with `chat_id`, `kind` ('command', 'message', 'callback', 'idle')
+    and `text`, `data` or `seconds`
+    """
+    mix = mix or DEFAULT_MIX
+    unknown = set(mix) - set(DEFAULT_MIX)
+    if unknown:
+        raise ValueError(f'unknown actions: {sorted(unknown)}')
+    rng = random.Random(seed)
+    actions, weights = zip(*mix.items())
+    has_photo = [False] * n_users
+
+    events = []
+    n_generated = 0
+    while n_generated < n_updates:
+        user_ix = rng.randrange(n_users)
+        chat_id = FIRST_CHAT_ID + user_ix
+        action = rng.choices(actions, weights)[0]
+        if action in ('next', 'change') and not has_photo[user_ix]:
+            action = 'get'
+
+        if action == 'get':
+            steps = [{'kind': 'command', 'text': '/get'}]
+            has_photo[user_ix] = True
+        elif action in ('next', 'change'):
+            steps = [{'kind': 'callback', 'data': CB_DATA[action]}]
+        elif action == 'feedback':
+            steps = [{'kind': 'command', 'text': '/feedback'},
+                     {'kind': 'message', 'text': f'feedback #{n_generated}'},
+                     {'kind': 'callback', 'data': CB_DATA['feedback_verify']}]
+            has_photo[user_ix] = False
+        else:
+            steps = [{'kind': 'idle', 'seconds': round(rng.uniform(*idle_seconds), 3)}]
+            has_photo[user_ix] = False
+
+        for step in steps:
+            events.append({'chat_id': chat_id, **step})
+        n_generated += sum(step['kind'] != 'idle' for step in steps)
+    return events
+
+
+def write_events(fp, events):
+    with open(fp, 'w') as fout:
+        for event in events:
+            fout.write(json.dumps(event) + '\n')
+
+
+def read_events(fp):
+    with open(fp) as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+
+# -------------- replay --------------
+
+def rss_bytes():
+    """
+    :return: resident set size of the process. peak value where the current one is not available
+    """
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class UpdateReplayer:
+    """
+    Replays a stream of events against the bot as a crowd of users.
+
+    Every chat of the stream is a user sending its events in order: the next update of the chat is sent once
+    the bot answered the previous one (see `FakeBotApiServer.ANSWER_METHODS`), or after `answer_timeout`
+    if it never does, e.g. because a Bot API call failed. Updates are put into `getUpdates` of the server
+    in polling mode and posted to `webhook_url` in webhook mode.
+    """
+
+    def __init__(self, server, events, webhook_url=None, answer_timeout=5.0):
+        self.server = server
+        self.webhook_url = webhook_url
+        self.answer_timeout = answer_timeout
+
+        self._chats = {}
+        for event in events:
+            self._chats.setdefault(event['chat_id'], []).append(event)
+        self._positions = dict.fromkeys(self._chats, 0)
+        self._ready = queue.Queue()
+        # chat_id -> deadline of the answer to the update in flight
+        self._in_flight = {}
+        self._message_ids = itertools.count(1)
+        self._session = requests.Session() if webhook_url else None
+
+        self.latencies = []
+        self.n_sent = 0
+        self.n_lost = 0
+
+    def _on_answer(self, chat_id, update_id, latency):
+        self.latencies.append(latency)
+        self._ready.put(chat_id)
+
+    def _build_update(self, event):
+        chat_id = event['chat_id']
+        user = {'id': chat_id, 'is_bot': False, 'first_name': f'user_{chat_id}'}
+        chat = {'id': chat_id, 'type': 'private', 'first_name': user['first_name']}
+        if event['kind'] == 'callback':
+            # buttons are attached to the last message the bot sent to the chat
+            message = {'message_id': self.server.last_message_ids.get(chat_id, 0), 'date': int(time.time()),
+                       'chat': chat}
+            return {'callback_query': {'id': str(next(self._message_ids)), 'from': user, 'message': message,
+                                       'chat_instance': str(chat_id), 'data': event['data']}}
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': chat, 'from': user,
+                   'text': event['text']}
+        if event['kind'] == 'command':
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(event['text'])}]
+        return {'message': message}
+
+    def _send(self, chat_id, event):
+        update = self._build_update(event)
+        self._in_flight[chat_id] = time.monotonic() + self.answer_timeout
+        if self.webhook_url is None:
+            self.server.push_update(update)
+        else:
+            update['update_id'] = self.server.next_update_id()
+            self.server.track(chat_id, update['update_id'])
+            self._session.post(self.webhook_url, json=update, timeout=self.answer_timeout).raise_for_status()
+        self.n_sent += 1
+
+    def _advance(self, chat_id, now, sleeping):
+        """
+        Send the next update of the chat or put the chat to sleep on "idle" events
+        """
+        events = self._chats[chat_id]
+        position = self._positions[chat_id]
+        if position >= len(events):
+            return
+        self._positions[chat_id] = position + 1
+        event = events[position]
+        if event['kind'] == 'idle':
+            heapq.heappush(sleeping, (now + event['seconds'], chat_id))
+        else:
+            self._send(chat_id, event)
+
+    def run(self):
+        """
+        :return: dict with throughput, end-to-end latency percentiles and memory growth
+        """
+        self.server.on_answer = self._on_answer
+        sleeping = []
+        rss_start = rss_bytes()
+        start = time.perf_counter()
+        for chat_id in self._chats:
+            self._advance(chat_id, time.monotonic(), sleeping)
+
+        while self._in_flight or sleeping:
+            try:
+                chat_id = self._ready.get(timeout=0.01)
+                if self._in_flight.pop(chat_id, None) is not None:
+                    self._advance(chat_id, time.monotonic(), sleeping)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            while sleeping and sleeping[0][0] <= now:
+                self._advance(heapq.heappop(sleeping)[1], now, sleeping)
+            for chat_id, deadline in list(self._in_flight.items()):
+                if deadline <= now:
+                    del self._in_flight[chat_id]
+                    self.n_lost += 1
+                    self._advance(chat_id, now, sleeping)
+        elapsed = time.perf_counter() - start
+        self.server.on_answer = None
+
+        latencies = sorted(self.latencies)
+        n_answered = len(latencies)
+        return {
+            'updates': self.n_sent,
+            'answered': n_answered,
+            'lost': self.n_lost,
+            'elapsed': round(elapsed, 2),
+            'updates_per_second': round(n_answered / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(latencies[n_answered // 2] * 1e3, 2) if latencies else None,
+            'p99_ms': round(latencies[min(n_answered - 1, int(n_answered * 0.99))] * 1e3, 2) if latencies else None,
+            'rss_growth_mb': round((rss_bytes() - rss_start) / 2 ** 20, 1),
+        }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'nothing listens on port {port} after {timeout} s')
+            time.sleep(0.1)
+
+
+def write_photo_catalog(fp, n_photos):
+    # 2 of 3 photos are vertical, as in the real catalog
+    orientations = {f'word_{ix}': ORIENTATION_HORIZONTAL if ix % 3 == 2 else ORIENTATION_VERTICAL
+                    for ix in range(n_photos)}
+    PhotoCatalog.build(((f'word_{ix}', f'fake_photo_{ix}') for ix in range(n_photos)), fp, orientations)
+
+
+def make_bot(base_url, photos_file_ids_fp, conversation_timeout, global_rate=None, chat_rate=None, **kwargs):
+    """
+    :param global_rate: messages per second `BotScheduler` lets out, Telegram's limit if None.
+    the fake Bot API has no flood limits: a higher rate loads the bot instead of the scheduler
+    :param chat_rate: messages per second `BotScheduler` lets out to a chat, Telegram's limit if None
+    """
+    bot = LieksikaBot(FAKE_TOKEN, -1, photos_file_ids_fp, base_url=base_url,
+                      conversation_timeout=conversation_timeout, **kwargs)
+    bot.error_reporter.reports_dp = None
+    bot.joke_provider.url = f'{base_url}/joke'
+    if global_rate is not None:
+        bot.bot_scheduler.global_interval = 1 / global_rate
+        # bursts of 0.1 s
+        bot.bot_scheduler.global_tolerance = 0.1
+    if chat_rate is not None:
+        bot.bot_scheduler.chat_interval = 1 / chat_rate
+    return bot
+
+
+def run_load_test(events, mode='polling', latency=0.0, error_rate=0.0, n_photos=300, conversation_timeout=3,
+                  answer_timeout=5.0, quiet=True, use_asyncio=False, global_rate=None):
+    """
+    Run `LieksikaBot` against a local `FakeBotApiServer` and replay the events.
+    :param mode: 'polling' or 'webhook'
+    :param use_asyncio: run the bot in the asyncio mode, see `LieksikaBot.set_asyncio_mode`
+    :param global_rate: messages per second `BotScheduler` lets out, see `make_bot`
+    :param latency: latency of the fake Bot API, seconds
+    :param error_rate: share of Bot API calls answered with 429
+    :param conversation_timeout: short timeout, so "idle" events make conversations time out during the run
+    :param quiet: don't log every handled update. logging is not what is measured here
+    :return: report of `UpdateReplayer.run` with the number of Bot API calls by method
+    """
+    if mode not in ('polling', 'webhook'):
+        raise ValueError(f'unknown mode: "{mode}"')
+    with tempfile.TemporaryDirectory() as tmp_dp, \
+            FakeBotApiServer(latency=latency, error_rate=error_rate, retry_after=1) as server:
+        photos_file_ids_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        write_photo_catalog(photos_file_ids_fp, n_photos)
+
+        bot = make_bot(server.base_url, photos_file_ids_fp, conversation_timeout, global_rate)
+        if use_asyncio:
+            bot.set_asyncio_mode()
+        webhook_url = None
+        if mode == 'webhook':
+            port = free_port()
+            bot.set_heroku_mode('loadtest', port)
+            webhook_url = f'http://127.0.0.1:{port}/{FAKE_TOKEN}'
+        bot.metrics_port = 0
+
+        if quiet:
+            logging.disable(logging.INFO)
+        try:
+            bot.launch()
+            report = UpdateReplayer(server, events, webhook_url, answer_timeout).run()
+            # let conversations of users that went idle at the end time out
+            time.sleep(conversation_timeout + 1)
+            if bot.async_dispatcher is not None:
+                report['asyncio'] = bot.async_dispatcher.stats()
+        finally:
+            bot.updater.stop()
+            bot.shutdown()
+            logging.disable(logging.NOTSET)
+        report['calls'] = dict(sorted(server.calls.items()))
+        report['peak_bot_api_calls'] = server.peak_active
+    return report
+
+
+def run_worker(base_url, photos_file_ids_fp, port, shard_ix, conversation_timeout=3, global_rate=None,
+               chat_rate=None, quiet=True):
+    """
+    Worker process of `run_sharded_load_test`. Runs until SIGTERM.
+    State of users is shared with the other workers in the working directory, as by `main.py`
+    """
+    bot = make_bot(base_url, photos_file_ids_fp, conversation_timeout, global_rate, chat_rate,
+                   subscribers_db_fp='subscribers.sqlite', user_state_db_fp='user_state.sqlite')
+    bot.set_worker_mode(port, shard_ix)
+    bot.metrics_port = 0
+    if quiet:
+        logging.disable(logging.INFO)
+    bot.run()
+
+
+def run_sharded_load_test(events, n_workers, latency=0.0, error_rate=0.0, n_photos=300, conversation_timeout=3,
+                          answer_timeout=5.0, quiet=True, global_rate=None, chat_rate=None):
+    """
+    Run `n_workers` bot processes behind a `WebhookRouter` against a local `FakeBotApiServer`
+    and replay the events into the router. Parameters are the same as of `run_load_test`,
+    rates are the rates of every worker, see `make_bot`
+    :return: report of `UpdateReplayer.run` with stats of the router
+    """
+    with tempfile.TemporaryDirectory() as tmp_dp, \
+            FakeBotApiServer(latency=latency, error_rate=error_rate, retry_after=1) as server:
+        photos_file_ids_fp = os.path.join(tmp_dp, 'photo_catalog.bin')
+        write_photo_catalog(photos_file_ids_fp, n_photos)
+
+        ports = [free_port() for _ in range(n_workers)]
+        processes = []
+        for shard_ix, port in enumerate(ports):
+            args = [sys.executable, os.path.abspath(__file__), 'worker', '--base-url', server.base_url,
+                    '--photos', photos_file_ids_fp, '--port', str(port), '--shard', str(shard_ix),
+                    '--conversation-timeout', str(conversation_timeout)]
+            if global_rate is not None:
+                args.extend(['--global-rate', str(global_rate)])
+            if chat_rate is not None:
+                args.extend(['--chat-rate', str(chat_rate)])
+            if not quiet:
+                args.append('--verbose')
+            processes.append(subprocess.Popen(args, cwd=tmp_dp))
+        try:
+            for port in ports:
+                wait_for_port(port)
+            router = WebhookRouter([f'http://127.0.0.1:{port}/{FAKE_TOKEN}' for port in ports], host='127.0.0.1',
+                                   port=0, url_path=FAKE_TOKEN).start()
+            try:
+                report = UpdateReplayer(server, events, router.url, answer_timeout).run()
+                time.sleep(conversation_timeout + 1)
+            finally:
+                router.stop()
+            report['router'] = router.stats()
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+        report['calls'] = dict(sorted(server.calls.items()))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate and replay synthetic update streams against the bot '
+                                                 'and a local fake Bot API server')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='write a stream of events to a JSONL file')
+    generate_parser.add_argument('events_fp')
+    generate_parser.add_argument('--updates', type=int, default=10_000)
+    generate_parser.add_argument('--users', type=int, default=500)
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    replay_parser = subparsers.add_parser('replay', help='replay a JSONL stream of events and print a report')
+    replay_parser.add_argument('events_fp')
+    replay_parser.add_argument('--mode', choices=('polling', 'webhook', 'sharded'), default='polling')
+    replay_parser.add_argument('--workers', type=int, default=2, help='worker processes in sharded mode')
+    replay_parser.add_argument('--latency', type=float, default=0.0, help='Bot API latency, seconds')
+    replay_parser.add_argument('--error-rate', type=float, default=0.0, help='share of Bot API calls answered 429')
+    replay_parser.add_argument('--asyncio', action='store_true', help='run the bot in the asyncio mode')
+
+    worker_parser = subparsers.add_parser('worker', help='worker process of sharded mode')
+    worker_parser.add_argument('--base-url', required=True)
+    worker_parser.add_argument('--photos', required=True)
+    worker_parser.add_argument('--port', type=int, required=True)
+    worker_parser.add_argument('--shard', type=int, default=0)
+    worker_parser.add_argument('--conversation-timeout', type=float, default=3)
+    worker_parser.add_argument('--global-rate', type=float, help='messages per second of the bot scheduler')
+    worker_parser.add_argument('--chat-rate', type=float, help='messages per second to a chat')
+    worker_parser.add_argument('--verbose', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        events = generate_events(args.updates, args.users, seed=args.seed)
+        write_events(args.events_fp, events)
+        logger.info(f'wrote {len(events)} events of {args.users} users to "{args.events_fp}"')
+    elif args.command == 'worker':
+        run_worker(args.base_url, args.photos, args.port, args.shard, args.conversation_timeout, args.global_rate,
+                   args.chat_rate, not args.verbose)
+    elif args.mode == 'sharded':
+        report = run_sharded_load_test(read_events(args.events_fp), args.workers, args.latency, args.error_rate)
+        logger.info(f'load test report: {report}')
+    else:
+        report = run_load_test(read_events(args.events_fp), args.mode, args.latency, args.error_rate,
+                               use_asyncio=args.asyncio)
+        logger.info(f'load test report: {report}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+PLAIN_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# attributes set with `extra=` that go into JSON lines as separate fields
+EXTRA_FIELDS = ('handler', 'chat_id', 'duration_ms')
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as compact JSON lines
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        sample = getattr(record, 'sample', 1)
+        if sample > 1:
+            # every record stands for `sample` events
+            entry['sample'] = sample
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes every n-th record of high-volume events. Records are grouped by the `handler` extra field
+    or by the name of the function that logged them. Warnings and errors are never dropped
+    """
+
+    def __init__(self, sample_rates):
+        """
+        :param sample_rates: dict: handler or function name -> share of records to keep, e.g. 0.1
+        """
+        super().__init__()
+        self.every = {key: max(1, round(1 / rate)) for key, rate in sample_rates.items() if rate > 0}
+        self.dropped = {key for key, rate in sample_rates.items() if rate <= 0}
+        self._counters = {key: 0 for key in self.every}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, 'handler', None) or record.funcName
+        if key in self.dropped:
+            return False
+        every = self.every.get(key)
+        if every is None or every == 1:
+            return True
+        with self._lock:
+            counter = self._counters[key]
+            self._counters[key] = counter + 1
+        record.sample = every
+        return counter % every == 0
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler for a bounded queue within the process. Formatting of the message is left to the writer thread:
+    the base class formats every record in the calling thread to make it picklable.
+    Records are dropped when the writer falls behind, so logging never blocks handlers
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.n_dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.n_dropped += 1
+
+
+def parse_sample_rates(text):
+    """
+    :param text: comma separated `name=rate` pairs, e.g. "send_word=0.1,inline_query=0.01"
+    """
+    sample_rates = {}
+    for pair in filter(None, (x.strip() for x in (text or '').split(','))):
+        name, _, rate = pair.partition('=')
+        sample_rates[name.strip()] = float(rate)
+    return sample_rates
+
+
+def stop_listener():
+    """
+    Write out queued records and stop the writer thread of 'json' mode
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_listener)
+
+
+def setup_logging(mode='plain', level=logging.INFO, sample_rates=None, stream=None, max_queue=100_000):
+    """
+    Configure the root logger, replacing its handlers.
+
+    'plain' mode writes text lines synchronously, as the bot always did.
+    'json' mode puts records into a queue and a background thread formats them as JSON lines and writes them,
+    so handlers only pay for creating the record
+    :param sample_rates: see `SamplingFilter`
+    :param max_queue: records waiting to be written in 'json' mode
+    """
+    global _listener
+    if mode not in ('plain', 'json'):
+        raise ValueError(f'unknown logging mode: "{mode}"')
+    stop_listener()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+    root.setLevel(level)
+
+    stream_handler = logging.StreamHandler(stream or sys.stderr)
+    if mode == 'plain':
+        stream_handler.setFormatter(logging.Formatter(PLAIN_FORMAT))
+        handler = stream_handler
+    else:
+        stream_handler.setFormatter(JsonFormatter())
+        log_queue = queue.Queue(maxsize=max_queue)
+        handler = LocalQueueHandler(log_queue)
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _listener.start()
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+    root.addHandler(handler)
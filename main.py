@@ -1,22 +1,134 @@
 import os
+import signal
+import subprocess
+import sys
+import threading
+
+import telegram
 
 from lieksika_bot import LieksikaBot
+from log_config import parse_sample_rates, setup_logging
+from photo_catalog import PhotoCatalog
+from webhook_router import WebhookRouter
+
+
+def shard_fp(fp, shard_ix):
+    """
+    Every worker of the sharded mode keeps conversations of its own chats in separate files.
+    Durable state of users is shared by the workers: the router moves chats when workers are added or removed
+    """
+    if shard_ix is None:
+        return fp
+    root, ext = os.path.splitext(fp)
+    return f'{root}.shard{shard_ix}{ext}'
+
+
+def update_photo_catalog(json_fp, catalog_fp, orientations_fp):
+    """
+    Rebuild the binary catalog if the JSON files are newer, e.g. after deploy with new photos.
+    A running bot picks up the new file on SIGHUP or with the periodic check
+    """
+    sources = [fp for fp in (json_fp, orientations_fp) if os.path.isfile(fp)]
+    if not os.path.isfile(catalog_fp) or max(map(os.path.getmtime, sources)) > os.path.getmtime(catalog_fp):
+        PhotoCatalog.build_from_json(json_fp, catalog_fp, orientations_fp)
+
+
+def spawn_local_workers(token, n_workers, first_port):
+    """
+    Start workers as child processes of the router, e.g. to use all cores of a single dyno
+    :return: (processes, webhook urls of the workers)
+    """
+    processes, urls = [], []
+    for shard_ix in range(n_workers):
+        port = first_port + shard_ix
+        env = {**os.environ, 'MODE': 'worker', 'WORKER_PORT': str(port), 'SHARD': str(shard_ix)}
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+        urls.append(f'http://127.0.0.1:{port}/{token}')
+    return processes, urls
+
+
+def run_router(token, heroku_app_name, port, worker_urls, n_local_workers, first_worker_port):
+    processes = []
+    if n_local_workers:
+        processes, local_urls = spawn_local_workers(token, n_local_workers, first_worker_port)
+        worker_urls = worker_urls + local_urls
+    router = WebhookRouter(worker_urls, port=int(port), url_path=token).start()
+    telegram.Bot(token).set_webhook(f'https://{heroku_app_name}.herokuapp.com/{token}')
+
+    stopped = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *args: stopped.set())
+    stopped.wait()
+    router.stop()
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
 
 
 def main():
     # token = os.environ.get('BOT_TOKEN_TEST')
     token = os.environ.get('BOT_TOKEN')
     contact_chat_id = os.environ.get('CONTACT_CHAT_ID')
+    # "local", "heroku" or the sharded mode: "router" in front of "worker" processes
     mode = os.environ.get('MODE')
     heroku_app_name = os.environ.get('APP_NAME')
     port = os.environ.get('PORT')
+    # "plain" or "json". json lines are written by a background thread
+    log_format = os.environ.get('LOG_FORMAT', 'plain')
+    # e.g. "send_word=0.1,inline_query=0.01"
+    log_sample_rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES'))
+
+    setup_logging(log_format, sample_rates=log_sample_rates)
+
+    photos_file_ids_json_fp = 'photo_file_ids.json'
+    # photos_file_ids_json_fp = 'photo_file_ids_test.json'
+    photo_orientations_fp = 'photo_orientations.json'
+    photo_catalog_fp = 'photo_catalog.bin'
+    # workers are started by the router after it has updated the catalog
+    if mode != 'worker':
+        update_photo_catalog(photos_file_ids_json_fp, photo_catalog_fp, photo_orientations_fp)
+
+    if mode == 'router':
+        # comma separated webhook urls of workers on other nodes
+        worker_urls = [x.strip() for x in os.environ.get('WORKER_URLS', '').split(',') if x.strip()]
+        # workers to start on this node
+        n_local_workers = int(os.environ.get('N_WORKERS', 0 if worker_urls else os.cpu_count()))
+        first_worker_port = int(os.environ.get('WORKER_FIRST_PORT', 5001))
+        run_router(token, heroku_app_name, port, worker_urls, n_local_workers, first_worker_port)
+        return
+
+    shard_ix = int(os.environ['SHARD']) if mode == 'worker' else None
 
-    photos_file_ids_fp = 'photo_file_ids.json'
-    # photos_file_ids_fp = 'photo_file_ids_test.json'
+    # conversations are short-lived and stay with the worker of the chat
+    context_spill_fp = shard_fp('conversation_context.sqlite', shard_ix)
+    admin_queue_db_fp = shard_fp('admin_notifications.sqlite', shard_ix)
+    # prefix of the snapshot and journal segments of conversation states
+    state_journal_fp = shard_fp('conversation_state', shard_ix)
+    word_index_fp = 'word_index.bin'
+    # state of users shared by all workers. workers on other nodes need it on storage shared with this one
+    shared_state_dp = os.environ.get('SHARED_STATE_DP', '')
+    subscribers_db_fp = os.path.join(shared_state_dp, 'subscribers.sqlite')
+    engagement_fp = os.path.join(shared_state_dp, 'engagement.bin')
+    sampler_state_fp = 'sampler_state.bin'
+    review_state_fp = 'review_state.bin'
+    # word permutations and review schedules of workers. a single process keeps them in memory
+    user_state_db_fp = os.path.join(shared_state_dp, 'user_state.sqlite') if mode == 'worker' else None
+    # "1": draw words weighted by how users react to them instead of the no-repeat permutation
+    weighted_sampling = os.environ.get('WEIGHTED_SAMPLING') == '1'
 
-    bot = LieksikaBot(token, contact_chat_id, photos_file_ids_fp)
+    bot = LieksikaBot(token, contact_chat_id, photo_catalog_fp, sampler_state_fp, context_spill_fp,
+                      subscribers_db_fp, review_state_fp, word_index_fp, admin_queue_db_fp,
+                      state_journal_fp=state_journal_fp, engagement_fp=engagement_fp,
+                      weighted_sampling=weighted_sampling, user_state_db_fp=user_state_db_fp)
+    # "1": receive and handle updates in an asyncio event loop, see `LieksikaBot.set_asyncio_mode`
+    if os.environ.get('ASYNC') == '1':
+        bot.set_asyncio_mode(int(os.environ.get('ASYNC_MAX_IN_FLIGHT', 10_000)))
     if mode == 'heroku':
         bot.set_heroku_mode(heroku_app_name, port)
+    elif mode == 'worker':
+        # workers on other nodes listen on "0.0.0.0"
+        bot.set_worker_mode(os.environ.get('WORKER_PORT'), shard_ix, os.environ.get('WORKER_LISTEN', '127.0.0.1'))
     bot.run()
 
 
@@ -0,0 +1,318 @@
+import logging
+import threading
+import time
+import weakref
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# log-bucketed latencies in microseconds: 8 linear buckets, then 4 buckets per power of 2 (<= 19% error)
+N_BUCKETS = 124
+MAX_MICROSECONDS = (1 << 32) - 1
+COUNT, SUM, ERRORS, IN_FLIGHT = range(N_BUCKETS, N_BUCKETS + 4)
+PROMETHEUS_BOUNDS_US = [1 << k for k in range(3, 33, 2)]
+
+
+def bucket_index(seconds):
+    us = int(seconds * 1e6)
+    if us < 8:
+        return max(us, 0)
+    if us > MAX_MICROSECONDS:
+        us = MAX_MICROSECONDS
+    n_bits = us.bit_length()
+    return (n_bits - 2) * 4 + ((us >> (n_bits - 3)) & 3)
+
+
+def bucket_upper_bound(ix):
+    """
+    :return: exclusive upper bound of the bucket in seconds
+    """
+    if ix < 8:
+        return (ix + 1) / 1e6
+    n_bits, sub = ix // 4 + 2, ix % 4
+    return ((5 + sub) << (n_bits - 3)) / 1e6
+
+
+class _ShardOwner:
+    """
+    Lives in the thread-local storage of a thread next to its shard, so it is released when the thread exits
+    """
+
+    __slots__ = ('__weakref__',)
+
+
+class Histogram:
+    """
+    Latency histogram with per-thread shards: a thread only writes to its own shard, so recording
+    takes no locks. Shards are summed up when the histogram is read.
+    Shards of exited threads, e.g. of short-lived thread pools, are folded into a single retired shard
+    """
+
+    def __init__(self, family, label):
+        self.family = family
+        self.label = label
+        self._local = threading.local()
+        # id of the shard -> shard of a live thread
+        self._shards = {}
+        self._retired = [0] * (N_BUCKETS + 4)
+        # reentrant: a shard may be retired by garbage collection in a thread that holds the lock
+        self._lock = threading.RLock()
+
+    def shard(self):
+        """
+        :return: list of counters of the current thread: buckets, count, sum, errors and in-flight calls.
+        lists are updated ~3 times faster than arrays
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = [0] * (N_BUCKETS + 4)
+            owner = self._local.owner = _ShardOwner()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(owner, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            del self._shards[id(shard)]
+            retired = self._retired
+            for ix, value in enumerate(shard):
+                retired[ix] += value
+
+    def observe(self, seconds, error=False):
+        shard = self.shard()
+        shard[bucket_index(seconds)] += 1
+        shard[COUNT] += 1
+        shard[SUM] += seconds
+        if error:
+            shard[ERRORS] += 1
+
+    def wrap(self, func):
+        """
+        :return: wrapper of the function recording its latency, errors and in-flight calls
+        """
+        shard_of_thread = self.shard
+        perf_counter = time.perf_counter
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            shard = shard_of_thread()
+            shard[IN_FLIGHT] += 1
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                shard[ERRORS] += 1
+                raise
+            finally:
+                elapsed = perf_counter() - start
+                # inlined `bucket_index`: a function call would double the overhead
+                us = int(elapsed * 1e6)
+                if us >= 8:
+                    n_bits = us.bit_length()
+                    us = (n_bits - 2) * 4 + ((us >> (n_bits - 3)) & 3) if n_bits <= 32 else N_BUCKETS - 1
+                shard[us] += 1
+                shard[COUNT] += 1
+                shard[SUM] += elapsed
+                shard[IN_FLIGHT] -= 1
+            return result
+
+        return wrapper
+
+    def wrap_async(self, func):
+        """
+        `wrap` for coroutine functions. Calls of the asyncio mode overlap in the event loop thread,
+        so in-flight calls are the ones awaited at the moment
+        """
+        shard_of_thread = self.shard
+        perf_counter = time.perf_counter
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            shard = shard_of_thread()
+            shard[IN_FLIGHT] += 1
+            start = perf_counter()
+            error = False
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                shard[IN_FLIGHT] -= 1
+                self.observe(perf_counter() - start, error)
+
+        return wrapper
+
+    def snapshot(self):
+        """
+        :return: list of summed up shards: buckets, count, sum, errors and in-flight calls
+        """
+        with self._lock:
+            shards = [list(self._retired), *self._shards.values()]
+        return [sum(values) for values in zip(*shards)]
+
+    @staticmethod
+    def quantile(snapshot, q):
+        target = snapshot[COUNT] * q
+        seen = 0
+        for ix in range(N_BUCKETS):
+            seen += snapshot[ix]
+            if seen >= target and seen > 0:
+                return bucket_upper_bound(ix)
+        return 0.0
+
+
+class MetricsRegistry:
+    """
+    Histograms of handler latencies and Bot API calls keyed by (family, label),
+    e.g. ('handler', 'get') or ('bot_api', 'sendPhoto')
+    """
+
+    # Prometheus label of every family, 'method' for the rest
+    LABEL_NAMES = {'handler': 'handler', 'bot_queue': 'priority'}
+
+    def __init__(self, prefix='lieksika'):
+        self.prefix = prefix
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, family, label):
+        key = (family, label)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(family, label))
+        return histogram
+
+    def timed(self, family, label):
+        """
+        Decorator recording latency, errors and in-flight calls of the function
+        """
+
+        def outer_wrapper(func):
+            return self.histogram(family, label or func.__name__).wrap(func)
+
+        return outer_wrapper
+
+    def instrument_bot(self, bot):
+        """
+        Record every Bot API call made through `bot`, labeled with the API method name
+        """
+        request = bot.request
+        post = request.post
+        wrappers = {}
+
+        @wraps(post)
+        def instrumented_post(url, *args, **kwargs):
+            method = url.rsplit('/', 1)[-1]
+            wrapper = wrappers.get(method)
+            if wrapper is None:
+                wrapper = wrappers[method] = self.histogram('bot_api', method).wrap(post)
+            return wrapper(url, *args, **kwargs)
+
+        request.post = instrumented_post
+        return bot
+
+    def snapshots(self):
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        return [(family, label, histogram.snapshot()) for (family, label), histogram in histograms]
+
+    def render_prometheus(self):
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        lines = []
+        families = {}
+        for family, label, snapshot in self.snapshots():
+            families.setdefault(family, []).append((label, snapshot))
+        for family, rows in families.items():
+            name = f'{self.prefix}_{family}'
+            label_name = self.LABEL_NAMES.get(family, 'method')
+            lines.append(f'# TYPE {name}_seconds histogram')
+            for label, snapshot in rows:
+                cumulative = 0
+                ix = 0
+                for bound_us in PROMETHEUS_BOUNDS_US:
+                    while ix < N_BUCKETS and bucket_upper_bound(ix) * 1e6 <= bound_us + 1e-6:
+                        cumulative += snapshot[ix]
+                        ix += 1
+                    lines.append(f'{name}_seconds_bucket{{{label_name}="{label}",le="{bound_us / 1e6:g}"}} '
+                                 f'{int(cumulative)}')
+                lines.append(f'{name}_seconds_bucket{{{label_name}="{label}",le="+Inf"}} {int(snapshot[COUNT])}')
+                lines.append(f'{name}_seconds_sum{{{label_name}="{label}"}} {snapshot[SUM]:.6f}')
+                lines.append(f'{name}_seconds_count{{{label_name}="{label}"}} {int(snapshot[COUNT])}')
+            lines.append(f'# TYPE {name}_errors_total counter')
+            for label, snapshot in rows:
+                lines.append(f'{name}_errors_total{{{label_name}="{label}"}} {int(snapshot[ERRORS])}')
+            lines.append(f'# TYPE {name}_in_flight gauge')
+            for label, snapshot in rows:
+                lines.append(f'{name}_in_flight{{{label_name}="{label}"}} {int(snapshot[IN_FLIGHT])}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: human readable table for /stats
+        """
+        lines = []
+        for family, label, snapshot in self.snapshots():
+            if not snapshot[COUNT]:
+                continue
+            lines.append(f'{family}/{label}: n={int(snapshot[COUNT])}, err={int(snapshot[ERRORS])}, '
+                         f'p50={Histogram.quantile(snapshot, 0.5) * 1e3:.2f}ms, '
+                         f'p99={Histogram.quantile(snapshot, 0.99) * 1e3:.2f}ms')
+        return '\n'.join(lines)
+
+
+# handlers are decorated at class definition time, so they record into the module level registry
+REGISTRY = MetricsRegistry()
+
+
+def timed(_func=None, *, family='handler', label=None):
+    """
+    Record latency of the function into `REGISTRY`.
+    Can be used with or without parentheses
+    """
+    decorator = REGISTRY.timed(family, label)
+    return decorator if _func is None else decorator(_func)
+
+
+class MetricsServer:
+    """
+    Serves `registry.render_prometheus()` over HTTP at /metrics
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='MetricsServer', daemon=True)
+        self._thread.start()
+        host, port = self.httpd.server_address[:2]
+        logger.info(f'MetricsServer. serving metrics at http://{host}:{port}/metrics')
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,333 @@
+import argparse
+import concurrent.futures
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tarfile
+import time
+import zipfile
+from html.parser import HTMLParser
+
+from word_catalog import normalize_word, read_catalog, write_catalog
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HTML_EXTENSIONS = ('.html', '.htm')
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+# how articles are laid out on saved pages of every site. a matcher is (tag, attribute, value),
+# `article` is None when the whole page is a single article.
+# check these against freshly saved pages if a site changes its markup
+SITES = {
+    'skarnik': {
+        'detect': re.compile(rb'skarnik\.by', re.IGNORECASE),
+        'article': None,
+        'headword': ('h1', None, None),
+        'definition': ('p', 'id', 'trn'),
+    },
+    'slounik': {
+        'detect': re.compile(rb'slounik\.org', re.IGNORECASE),
+        'article': ('li', None, None),
+        'headword': ('b', None, None),
+        'definition': None,  # the article text without the headword
+    },
+}
+
+
+def _matches(matcher, tag, attrs):
+    if matcher is None:
+        return False
+    m_tag, m_attr, m_value = matcher
+    if tag != m_tag:
+        return False
+    if m_attr is None:
+        return True
+    return any(name == m_attr and m_value in (value or '').split() for name, value in attrs)
+
+
+class ArticleParser(HTMLParser):
+    """
+    Extracts (headword, definition) pairs from a page using matchers from `SITES`
+    """
+
+    def __init__(self, site):
+        super().__init__(convert_charrefs=True)
+        self.site = site
+        self.articles = []
+        self._stack = []  # open tags with the role of the element: 'article', 'headword', 'definition' or None
+        self._headword = []
+        self._definition = []
+        self._in_article = site['article'] is None
+
+    def _roles(self):
+        return {role for _, role in self._stack}
+
+    def handle_starttag(self, tag, attrs):
+        role = None
+        if _matches(self.site['article'], tag, attrs) and 'article' not in self._roles():
+            role = 'article'
+            self._in_article = True
+        elif self._in_article and _matches(self.site['headword'], tag, attrs) and not self._headword:
+            role = 'headword'
+        elif self._in_article and _matches(self.site['definition'], tag, attrs):
+            role = 'definition'
+        if tag in VOID_TAGS:
+            if tag == 'br':
+                self.handle_data('\n')
+            return
+        self._stack.append((tag, role))
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS:
+            return
+        # tolerate unclosed tags: pop up to the matching one
+        for ix in range(len(self._stack) - 1, -1, -1):
+            if self._stack[ix][0] == tag:
+                closed = self._stack[ix:]
+                del self._stack[ix:]
+                if any(role == 'article' for _, role in closed):
+                    self._finish_article()
+                return
+
+    def handle_data(self, data):
+        roles = self._roles()
+        if 'headword' in roles:
+            self._headword.append(data)
+        elif 'definition' in roles or (self._in_article and self.site['definition'] is None and self._headword):
+            self._definition.append(data)
+
+    def _finish_article(self):
+        headword = ' '.join(''.join(self._headword).split())
+        definition = '\n'.join(' '.join(line.split()) for line in ''.join(self._definition).splitlines())
+        definition = re.sub(r'\n{2,}', '\n', definition).strip()
+        if headword:
+            self.articles.append((headword, definition))
+        self._headword, self._definition = [], []
+        self._in_article = self.site['article'] is None
+
+    def close(self):
+        super().close()
+        if self.site['article'] is None:
+            self._finish_article()
+
+
+def detect_site(name, data):
+    for site_name, site in SITES.items():
+        if site_name in name.lower() or site['detect'].search(data[:4096]):
+            return site_name
+    return None
+
+
+def parse_page(name, data):
+    """
+    :return: list of (headword, definition, site name) found on the page
+    """
+    site_name = detect_site(name, data)
+    if site_name is None:
+        return []
+    parser = ArticleParser(SITES[site_name])
+    parser.feed(data.decode('utf-8', errors='replace'))
+    parser.close()
+    return [(headword, definition, site_name) for headword, definition in parser.articles]
+
+
+def _parse_pages_task(batch):
+    return [(name, sha, parse_page(name, data)) for name, sha, data in batch]
+
+
+def iter_pages(source):
+    """
+    Stream (name, bytes) of html pages from a directory, a zip archive or a (compressed) tar archive
+    """
+    if os.path.isdir(source):
+        for dp, _, fns in os.walk(source):
+            for fn in sorted(fns):
+                if fn.lower().endswith(HTML_EXTENSIONS):
+                    fp = os.path.join(dp, fn)
+                    with open(fp, 'rb') as fin:
+                        yield os.path.relpath(fp, source), fin.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if info.filename.lower().endswith(HTML_EXTENSIONS):
+                    yield info.filename, archive.read(info)
+    else:
+        # stream mode: members are read one by one without building an index of the archive
+        with tarfile.open(source, 'r|*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(HTML_EXTENSIONS):
+                    yield member.name, archive.extractfile(member).read()
+
+
+class IngestState:
+    """
+    sqlite manifest of ingested pages and entries parsed from them, so only changed pages are re-parsed.
+    Pages are keyed by (source, name): sources are ingested one at a time and don't remove pages of each other
+    """
+
+    def __init__(self, db_fp):
+        self._conn = sqlite3.connect(db_fp)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pages (source TEXT NOT NULL, name TEXT NOT NULL, '
+                           'sha256 TEXT NOT NULL, PRIMARY KEY (source, name))')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS entries (source TEXT NOT NULL, page TEXT NOT NULL, '
+                           'key TEXT NOT NULL, headword TEXT NOT NULL, definition TEXT NOT NULL, site TEXT NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_source_page ON entries (source, page)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS entries_key ON entries (key, site)')
+        self._conn.commit()
+        # normalized headwords of entries deleted with their pages since the state was opened
+        self.dropped_keys = set()
+
+    def page_hashes(self, source):
+        return dict(self._conn.execute('SELECT name, sha256 FROM pages WHERE source = ?', (source,)))
+
+    def _delete_entries(self, source, name):
+        self.dropped_keys.update(key for key, in self._conn.execute(
+            'SELECT key FROM entries WHERE source = ? AND page = ?', (source, name)))
+        self._conn.execute('DELETE FROM entries WHERE source = ? AND page = ?', (source, name))
+
+    def replace_page(self, source, name, sha, articles):
+        self._delete_entries(source, name)
+        self._conn.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                               ((source, name, normalize_word(headword), headword, definition, site)
+                                for headword, definition, site in articles))
+        self._conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (source, name, sha))
+
+    def remove_pages(self, source, names):
+        for name in names:
+            self._delete_entries(source, name)
+            self._conn.execute('DELETE FROM pages WHERE source = ? AND name = ?', (source, name))
+
+    def commit(self):
+        self._conn.commit()
+
+    def iter_merged_entries(self, file_ids):
+        """
+        Yield catalog entries deduplicated by normalized headword.
+        Distinct definitions of the same word are joined
+        :param file_ids: normalized headword -> file_id of the screenshot, kept from the previous catalog
+        """
+        rows = self._conn.execute('SELECT key, headword, definition FROM entries ORDER BY key, site, source, page')
+        current_key, headword, definitions = None, None, []
+        for key, row_headword, definition in rows:
+            if key != current_key:
+                if current_key is not None:
+                    yield {'headword': headword, 'definition': '\n\n'.join(definitions),
+                           'file_id': file_ids.get(current_key)}
+                current_key, headword, definitions = key, row_headword, []
+            if definition and definition not in definitions:
+                definitions.append(definition)
+        if current_key is not None:
+            yield {'headword': headword, 'definition': '\n\n'.join(definitions), 'file_id': file_ids.get(current_key)}
+
+    def close(self):
+        self._conn.close()
+
+
+def ingest_pages(source, catalog_fp='words.jsonl', state_fp='ingest_state.sqlite', n_processes=None,
+                 batch_size=64, max_in_flight=None, source_name=None):
+    """
+    Parse saved skarnik.by / slounik.org pages and write deduplicated entries to the word catalog.
+    Pages are streamed from `source` and parsed on a process pool in batches of `batch_size` pages,
+    at most `max_in_flight` batches are held in memory.
+    Pages with unchanged sha256 are not parsed again. file_ids of words already in the catalog are kept.
+    Pages ingested from the same source before and missing from it now are removed with their words.
+    Catalog entries no page has ever produced, e.g. added by hand, are kept
+    :param source_name: key of the source in the state, absolute path of `source` if None
+    :return: dict with ingestion stats
+    """
+    n_processes = n_processes or os.cpu_count()
+    max_in_flight = max_in_flight or 2 * n_processes
+    source_name = source_name or os.path.abspath(source)
+    state = IngestState(state_fp)
+    known_hashes = state.page_hashes(source_name)
+    seen = set()
+    stats = {'pages': 0, 'parsed': 0, 'unchanged': 0, 'removed': 0, 'entries': 0, 'kept': 0}
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        in_flight = set()
+        batch = []
+
+        def drain(return_when):
+            nonlocal in_flight
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=return_when)
+            for future in done:
+                for name, sha, articles in future.result():
+                    state.replace_page(source_name, name, sha, articles)
+                    stats['parsed'] += 1
+                    stats['entries'] += len(articles)
+
+        def submit():
+            if len(in_flight) >= max_in_flight:
+                drain(concurrent.futures.FIRST_COMPLETED)
+            in_flight.add(executor.submit(_parse_pages_task, batch))
+
+        for name, data in iter_pages(source):
+            stats['pages'] += 1
+            seen.add(name)
+            sha = hashlib.sha256(data).hexdigest()
+            if known_hashes.get(name) == sha:
+                stats['unchanged'] += 1
+                continue
+            batch.append((name, sha, data))
+            if len(batch) == batch_size:
+                submit()
+                batch = []
+        if batch:
+            submit()
+        drain(concurrent.futures.ALL_COMPLETED)
+
+    removed = set(known_hashes) - seen
+    state.remove_pages(source_name, removed)
+    stats['removed'] = len(removed)
+    state.commit()
+    elapsed = time.perf_counter() - start
+
+    previous = list(read_catalog(catalog_fp)) if os.path.isfile(catalog_fp) else []
+    file_ids = {normalize_word(entry['headword']): entry['file_id'] for entry in previous if entry.get('file_id')}
+    written_keys = set()
+
+    def merged_and_kept_entries():
+        for entry in state.iter_merged_entries(file_ids):
+            written_keys.add(normalize_word(entry['headword']))
+            yield entry
+        # words of deleted pages go away with them, words that never came from a page stay
+        for entry in previous:
+            key = normalize_word(entry['headword'])
+            if key not in written_keys and key not in state.dropped_keys:
+                written_keys.add(key)
+                stats['kept'] += 1
+                yield entry
+
+    write_catalog(catalog_fp, merged_and_kept_entries())
+    state.close()
+    n_words = len(written_keys)
+
+    stats['words'] = n_words
+    stats['elapsed'] = elapsed
+    stats['pages_per_s'] = stats['pages'] / elapsed if elapsed else 0.0
+    logger.info(f'ingested {source}: {stats["pages"]} pages in {elapsed:.1f} s ({stats["pages_per_s"]:.1f} pages/s). '
+                f'parsed: {stats["parsed"]}, unchanged: {stats["unchanged"]}, removed: {stats["removed"]}, '
+                f'words in catalog: {n_words}, kept without a page: {stats["kept"]}')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='build word catalog from saved skarnik.by / slounik.org pages')
+    parser.add_argument('source', help='directory, zip or tar archive with saved html pages')
+    parser.add_argument('--catalog', default='words.jsonl')
+    parser.add_argument('--state', default='ingest_state.sqlite')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--source-name', default=None,
+                        help='key of the source in the state, e.g. to ingest a moved directory as the same source')
+    args = parser.parse_args()
+    ingest_pages(args.source, args.catalog, args.state, args.processes, source_name=args.source_name)
+
+
+if __name__ == '__main__':
+    main()
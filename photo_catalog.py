@@ -0,0 +1,181 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ORIENTATION_UNKNOWN, ORIENTATION_VERTICAL, ORIENTATION_HORIZONTAL = range(3)
+ORIENTATIONS = {'vertical': ORIENTATION_VERTICAL, 'horizontal': ORIENTATION_HORIZONTAL}
+
+
+def file_signature(fp):
+    """
+    :return: tuple that changes when the file is replaced or modified
+    """
+    st = os.stat(fp)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class PhotoCatalog:
+    """
+    Memory-mapped catalog of word photos: a read-only sequence of (photo name, file_id) pairs.
+
+    Replaces loading `photo_file_ids.json` at startup: nothing is parsed when the catalog is opened,
+    a pair is decoded from the mapped file on access. Positions in the catalog are word indices of
+    `WordSampler` and `ReviewScheduler`, so `build_from_json` keeps the positions of photos that are
+    already in the catalog and appends new ones. A removed photo stays in the catalog as a tombstone:
+    its name with an empty file_id, see `is_removed`, so the positions never shift.
+
+    File layout (little endian):
+        header
+        entry offsets:  uint32[n_entries + 1], offsets into the entries blob
+        entries blob:   `name \\0 file_id` utf-8 records
+        orientations:   uint8[n_entries], `ORIENTATION_*` of the photos
+    """
+
+    MAGIC = b'LKPC'
+    VERSION = 2
+    HEADER = struct.Struct('<4sIQQQ')  # magic, version, n_entries, entries blob offset, orientations offset
+
+    def __init__(self, catalog_fp):
+        self.catalog_fp = catalog_fp
+        self.signature = file_signature(catalog_fp)
+        with open(catalog_fp, 'rb') as fin:
+            # the mapping stays valid after the file is closed or replaced
+            self._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_entries, self._entries_at, orientations_at = self.HEADER.unpack_from(self._mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            self._mm.close()
+            raise ValueError(f'"{catalog_fp}" is not a photo catalog')
+        self._view = memoryview(self._mm)
+        self._offsets = self._view[self.HEADER.size:self._entries_at].cast('I')
+        self._orientations = self._view[orientations_at:orientations_at + self.n_entries]
+
+    def __len__(self):
+        return self.n_entries
+
+    def __getitem__(self, ix):
+        """
+        :return: (photo name, file_id)
+        """
+        if ix < 0:
+            ix += self.n_entries
+        if not 0 <= ix < self.n_entries:
+            raise IndexError('photo catalog index out of range')
+        start = self._entries_at + self._offsets[ix]
+        end = self._entries_at + self._offsets[ix + 1]
+        name, file_id = self._mm[start:end].decode('utf-8').split('\0', 1)
+        return name, file_id
+
+    def __iter__(self):
+        for ix in range(self.n_entries):
+            yield self[ix]
+
+    def is_removed(self, ix):
+        """
+        :return: True if the photo was removed from the catalog: its file_id is empty
+        """
+        if ix < 0:
+            ix += self.n_entries
+        # records end with the file_id: a removed one ends with the separator
+        return self._mm[self._entries_at + self._offsets[ix + 1] - 1] == 0
+
+    def orientation(self, ix):
+        """
+        :return: `ORIENTATION_*` of the photo
+        """
+        return self._orientations[ix]
+
+    def close(self):
+        self._orientations.release()
+        self._offsets.release()
+        self._view.release()
+        self._mm.close()
+
+    # -------------- building --------------
+
+    @classmethod
+    def build(cls, items, catalog_fp, orientations=None):
+        """
+        :param items: iterable of (photo name, file_id)
+        :param orientations: dict: photo name -> `ORIENTATION_*`. missing photos get `ORIENTATION_UNKNOWN`
+        :return: number of entries
+        """
+        orientations = orientations or {}
+        offsets = [0]
+        blob = bytearray()
+        photo_orientations = bytearray()
+        for name, file_id in items:
+            blob += f'{name}\0{file_id}'.encode('utf-8')
+            offsets.append(len(blob))
+            photo_orientations.append(orientations.get(name, ORIENTATION_UNKNOWN))
+        n_entries = len(offsets) - 1
+        entries_at = cls.HEADER.size + 4 * len(offsets)
+
+        tmp_fp = f'{catalog_fp}.tmp'
+        with open(tmp_fp, 'wb') as fout:
+            fout.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, n_entries, entries_at, entries_at + len(blob)))
+            fout.write(struct.pack(f'<{len(offsets)}I', *offsets))
+            fout.write(blob)
+            fout.write(photo_orientations)
+        # readers that mapped the previous file keep it until they drop the catalog
+        os.replace(tmp_fp, catalog_fp)
+        logger.info(f'PhotoCatalog. wrote {n_entries} photos to "{catalog_fp}"')
+        return n_entries
+
+    @classmethod
+    def build_from_json(cls, json_fp, catalog_fp, orientations_fp=None):
+        """
+        Convert `photo_file_ids.json` (photo name -> file_id) produced by `utils.upload_photos_and_store_file_ids`.
+        Photos of the existing catalog keep their positions and orientations, new photos are appended.
+        Photos missing from the JSON become tombstones, a tombstone gets its file_id back if the photo returns
+        :param orientations_fp: JSON: photo name -> "vertical" or "horizontal", see `utils.store_photo_orientations`
+        :return: number of entries
+        """
+        with open(json_fp) as fin:
+            photo_file_ids = json.load(fin)
+        names = []
+        orientations = {}
+        previous = None
+        if os.path.isfile(catalog_fp):
+            try:
+                previous = cls(catalog_fp)
+            except ValueError as e:
+                logger.warning(f'PhotoCatalog. building from scratch: {e}')
+        if previous is not None:
+            names = [name for name, _ in previous]
+            orientations = {name: previous.orientation(ix) for ix, name in enumerate(names)}
+            n_removed = sum(1 for ix, name in enumerate(names)
+                            if name not in photo_file_ids and not previous.is_removed(ix))
+            previous.close()
+            if n_removed:
+                logger.warning(f'PhotoCatalog. {n_removed} photos were removed: their positions are kept as tombstones')
+        if orientations_fp is not None and os.path.isfile(orientations_fp):
+            with open(orientations_fp) as fin:
+                orientations.update((name, ORIENTATIONS[x]) for name, x in json.load(fin).items())
+        known = set(names)
+        names.extend(name for name in photo_file_ids if name not in known)
+        n_unknown = sum(1 for name in photo_file_ids
+                        if orientations.get(name, ORIENTATION_UNKNOWN) == ORIENTATION_UNKNOWN)
+        if n_unknown:
+            logger.warning(f'PhotoCatalog. {n_unknown} photos have no orientation in "{orientations_fp}": '
+                           f'albums of /get N mix their layouts. commit the file stored with the upload')
+        return cls.build(((name, photo_file_ids.get(name, '')) for name in names), catalog_fp, orientations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='build the binary photo catalog from photo_file_ids.json')
+    parser.add_argument('json_fp', nargs='?', default='photo_file_ids.json')
+    parser.add_argument('catalog_fp', nargs='?', default='photo_catalog.bin')
+    parser.add_argument('--orientations', default='photo_orientations.json')
+    args = parser.parse_args()
+    PhotoCatalog.build_from_json(args.json_fp, args.catalog_fp, args.orientations)
+
+
+if __name__ == '__main__':
+    main()
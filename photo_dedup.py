@@ -0,0 +1,222 @@
+import concurrent.futures
+import logging
+import os
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+HASH_KINDS = ('dhash', 'phash')
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n):
+    """
+    :return: orthonormal DCT-II matrix: `m @ x` is DCT of the columns of `x`
+    """
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m.astype(np.float32)
+
+
+def hash_input_size(kind, hash_size):
+    """
+    :return: (width, height) photos are reduced to before hashing
+    """
+    if kind == 'dhash':
+        return hash_size + 1, hash_size
+    if kind == 'phash':
+        return 4 * hash_size, 4 * hash_size
+    raise ValueError(f'unknown hash kind "{kind}". expected one of {HASH_KINDS}')
+
+
+def hash_pixels(pixels, kind='dhash', hash_size=16):
+    """
+    Perceptual hashes of a batch of grayscale photos reduced to `hash_input_size`.
+    dhash: signs of horizontal gradients. phash: low DCT frequencies compared to their median
+    :param pixels: uint8 array (n_photos, height, width)
+    :return: uint8 array (n_photos, hash_size ** 2 / 8) of packed hash bits
+    """
+    pixels = pixels.astype(np.float32)
+    if kind == 'dhash':
+        bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    elif kind == 'phash':
+        m = _dct_matrix(pixels.shape[1])
+        # 2D DCT of every photo as two batched matrix products
+        low = (m @ pixels @ m.T)[:, :hash_size, :hash_size]
+        bits = low > np.median(low.reshape(len(low), -1), axis=1)[:, None, None]
+    else:
+        raise ValueError(f'unknown hash kind "{kind}". expected one of {HASH_KINDS}')
+    return np.packbits(bits.reshape(len(bits), -1), axis=1)
+
+
+def hamming(a, b):
+    """
+    :param a, b: packed hashes, broadcastable to each other
+    :return: number of differing bits along the last axis
+    """
+    return POPCOUNT[np.bitwise_xor(a, b)].sum(axis=-1, dtype=np.int32)
+
+
+def _load_reduced(fp, size):
+    with Image.open(fp) as img:
+        if img.format == 'JPEG':
+            # skip DCT scales that are well above `size`. decoding right at `size` blurs
+            # the 8x8 blocks differently from a full decode, and hashes of the same photo in PNG drift apart
+            img.draft('L', (8 * size[0], 8 * size[1]))
+        # BOX averages all source pixels: fast and does not alias on text
+        return np.asarray(img.convert('L').resize(size, Image.BOX), dtype=np.uint8)
+
+
+def _hash_photo_chunk(task):
+    """
+    Hash a chunk of photos. Runs in a worker process
+    :return: (fps of hashed photos, hashes, fps of unreadable photos)
+    """
+    fps, kind, hash_size = task
+    size = hash_input_size(kind, hash_size)
+    pixels, hashed, failed = [], [], []
+    for fp in fps:
+        try:
+            pixels.append(_load_reduced(fp, size))
+            hashed.append(fp)
+        except OSError:
+            failed.append(fp)
+    if not pixels:
+        return hashed, np.zeros((0, hash_size ** 2 // 8), dtype=np.uint8), failed
+    return hashed, hash_pixels(np.stack(pixels), kind, hash_size), failed
+
+
+def compute_photo_hashes(fps, kind='dhash', hash_size=16, n_processes=None, chunk_size=256):
+    """
+    Perceptual hashes of photos on a process pool. Every worker decodes a chunk of photos and hashes it
+    as a single numpy batch. Unreadable photos are logged and skipped
+    :return: (fps of hashed photos, uint8 array (len(fps), hash_size ** 2 / 8))
+    """
+    hash_input_size(kind, hash_size)
+    tasks = [(fps[ix:ix + chunk_size], kind, hash_size) for ix in range(0, len(fps), chunk_size)]
+    hashed_fps, hashes = [], []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes or os.cpu_count()) as executor:
+        for chunk_fps, chunk_hashes, failed in executor.map(_hash_photo_chunk, tasks):
+            hashed_fps.extend(chunk_fps)
+            hashes.append(chunk_hashes)
+            for fp in failed:
+                logger.warning(f'failed to read "{fp}". skipping it')
+    if not hashes:
+        return [], np.zeros((0, hash_size ** 2 // 8), dtype=np.uint8)
+    return hashed_fps, np.concatenate(hashes)
+
+
+class MultiIndexHash:
+    """
+    Hamming-radius search over packed binary hashes.
+
+    Hash bits are split into `radius + 1` bands. Two hashes within `radius` bits differ in at most
+    `radius` bands, so they are equal in at least one: candidates are the hashes sharing a band with
+    the query, they are verified with the exact distance. Bits are shuffled before the split: neighbouring
+    bits come from the same rows of the photo, and screenshots share rows, e.g. the app header,
+    which would put all of them to a single bucket. Every band is kept as sorted keys,
+    so building the index and finding all near-duplicate pairs are a few numpy sorts.
+    """
+
+    def __init__(self, hashes, radius, seed=0):
+        """
+        :param hashes: uint8 array (n_hashes, n_bytes) of packed hashes, see `hash_pixels`
+        :param radius: max number of differing bits, less than the number of hash bits
+        """
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint8)
+        self.radius = radius
+        n_bits = self.hashes.shape[1] * 8
+        if not 0 <= radius < n_bits:
+            raise ValueError(f'radius must be in [0, {n_bits}) for {n_bits} bit hashes, got {radius}')
+        permutation = np.random.RandomState(seed).permutation(n_bits)
+        self.bands = np.array_split(permutation, radius + 1)
+        # band -> (sorted keys, hash indices in the key order)
+        self._sorted = []
+        for band in self.bands:
+            keys = self._band_keys(self.hashes, band)
+            order = np.argsort(keys, kind='stable')
+            self._sorted.append((keys[order], order))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @staticmethod
+    def _band_keys(hashes, band):
+        """
+        :param band: bit positions of the band
+        :return: uint64 key of the band of every hash. bands of up to 64 bits are packed exactly,
+        wider ones are folded: collisions only add candidates
+        """
+        bits = np.unpackbits(hashes, axis=1)[:, band]
+        keys = np.zeros(len(hashes), dtype=np.uint64)
+        for ix in range(0, bits.shape[1], 64):
+            chunk = np.packbits(bits[:, ix:ix + 64], axis=1)
+            chunk = np.ascontiguousarray(np.pad(chunk, ((0, 0), (0, 8 - chunk.shape[1])), 'constant'))
+            keys = keys * np.uint64(0x9E3779B97F4A7C15) ^ chunk.view('>u8').ravel()
+        return keys
+
+    def query(self, h):
+        """
+        :param h: packed hash, uint8 array (n_bytes,)
+        :return: (indices of hashes within `radius`, their distances), sorted by distance
+        """
+        h = np.asarray(h, dtype=np.uint8)[None, :]
+        candidates = []
+        for band, (keys, order) in zip(self.bands, self._sorted):
+            key = self._band_keys(h, band)[0]
+            candidates.append(order[np.searchsorted(keys, key, 'left'):np.searchsorted(keys, key, 'right')])
+        candidates = np.unique(np.concatenate(candidates))
+        distances = hamming(self.hashes[candidates], h)
+        keep = distances <= self.radius
+        candidates, distances = candidates[keep], distances[keep]
+        by_distance = np.argsort(distances, kind='stable')
+        return candidates[by_distance], distances[by_distance]
+
+    def pairs(self):
+        """
+        All pairs of hashes within `radius`
+        :return: (i, j, distances) arrays with i < j
+        """
+        n = len(self.hashes)
+        found = [np.zeros(0, dtype=np.int64)]
+        for keys, order in self._sorted:
+            # hashes with the same band key are adjacent: pair every hash with the next ones of its run
+            for step in range(1, n):
+                same = keys[step:] == keys[:-step]
+                if not same.any():
+                    break
+                a, b = order[:-step][same], order[step:][same]
+                # most candidates are far apart: verify them before deduplicating pairs found by several bands
+                near = hamming(self.hashes[a], self.hashes[b]) <= self.radius
+                a, b = a[near], b[near]
+                found.append(np.minimum(a, b).astype(np.int64) * n + np.maximum(a, b))
+        found = np.unique(np.concatenate(found))
+        i, j = found // n, found % n
+        return i, j, hamming(self.hashes[i], self.hashes[j])
+
+
+def group_pairs(i, j, n):
+    """
+    Connected components of the near-duplicate graph
+    :return: groups of indices, only groups of 2 and more
+    """
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    groups = {}
+    for x in sorted(set(i.tolist()) | set(j.tolist())):
+        groups.setdefault(find(x), []).append(x)
+    return list(groups.values())
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter.
+    `acquire` blocks until a token is available, `try_acquire` never blocks. `pause` blocks all callers,
+    e.g. for `retry_after` seconds requested by Telegram
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: tokens per second
+        :param capacity: max burst size. defaults to `rate`
+        """
+        self.rate = rate
+        self.capacity = max(capacity or rate, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self):
+        now = self.clock()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._wait_time()
+            if wait <= 0:
+                return
+            self.sleep(wait)
+
+    def try_acquire(self):
+        """
+        :return: True if a token was taken, False if the caller has to skip the event
+        """
+        with self._lock:
+            return self._wait_time() <= 0
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self._tokens = 0
+
+
+class PerKeyThrottle:
+    """
+    Enforces minimal interval between events with the same key, e.g. messages to the same chat.
+    Only the `max_keys` most recently used keys are remembered
+    """
+
+    def __init__(self, min_interval, max_keys=100_000, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self._next_allowed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key):
+        """
+        Reserve the next slot for `key`
+        :return: seconds to wait before the event is allowed
+        """
+        with self._lock:
+            now = self.clock()
+            allowed_at = max(now, self._next_allowed.pop(key, now))
+            self._next_allowed[key] = allowed_at + self.min_interval
+            if len(self._next_allowed) > self.max_keys:
+                self._next_allowed.popitem(last=False)
+            return allowed_at - now
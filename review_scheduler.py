@@ -0,0 +1,347 @@
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class IndexedMinHeap:
+    """
+    Binary min-heap of item ids ordered by `keys[item_id]`, built on top of `array.array`.
+    Keeps position of every item in the heap, so an item can be removed or re-prioritized in O(log n)
+    """
+
+    NOT_IN_HEAP = -1
+
+    def __init__(self, keys):
+        """
+        :param keys: array indexed by item id. the heap must be notified with `update` when a key changes
+        """
+        self.keys = keys
+        self._heap = array('I')
+        self._pos = array('i')
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, item_id):
+        return item_id < len(self._pos) and self._pos[item_id] != self.NOT_IN_HEAP
+
+    def _swap(self, i, j):
+        heap, pos = self._heap, self._pos
+        heap[i], heap[j] = heap[j], heap[i]
+        pos[heap[i]] = i
+        pos[heap[j]] = j
+
+    def _sift_up(self, i):
+        heap, keys = self._heap, self.keys
+        while i > 0:
+            parent = (i - 1) >> 1
+            if keys[heap[i]] >= keys[heap[parent]]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        heap, keys = self._heap, self.keys
+        n = len(heap)
+        while True:
+            smallest = i
+            left = 2 * i + 1
+            if left < n and keys[heap[left]] < keys[heap[smallest]]:
+                smallest = left
+            if left + 1 < n and keys[heap[left + 1]] < keys[heap[smallest]]:
+                smallest = left + 1
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+    def heapify(self, item_ids):
+        """
+        Build the heap from scratch in O(n)
+        """
+        self._heap = array('I', item_ids)
+        self._pos = array('i', [self.NOT_IN_HEAP]) * (max(self._heap) + 1 if self._heap else 0)
+        for i, item_id in enumerate(self._heap):
+            self._pos[item_id] = i
+        for i in range(len(self._heap) // 2 - 1, -1, -1):
+            self._sift_down(i)
+
+    def push(self, item_id):
+        if item_id in self:
+            self.update(item_id)
+            return
+        while len(self._pos) <= item_id:
+            self._pos.append(self.NOT_IN_HEAP)
+        self._heap.append(item_id)
+        self._pos[item_id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def update(self, item_id):
+        i = self._pos[item_id]
+        self._sift_up(i)
+        self._sift_down(self._pos[item_id])
+
+    def remove(self, item_id):
+        if item_id not in self:
+            return
+        i = self._pos[item_id]
+        last = len(self._heap) - 1
+        if i != last:
+            self._swap(i, last)
+        self._heap.pop()
+        self._pos[item_id] = self.NOT_IN_HEAP
+        if i != last:
+            self._sift_up(i)
+            self._sift_down(self._pos[self._heap[i]])
+
+    def peek(self):
+        return self._heap[0] if self._heap else None
+
+    def pop(self):
+        item_id = self._heap[0]
+        self.remove(item_id)
+        return item_id
+
+
+class ReviewScheduler:
+    """
+    Spaced repetition (SM-2) schedule of words for every user.
+
+    Every (chat_id, word_ix) pair is an item stored in parallel arrays (~30 bytes per item with the heap).
+    Items are indexed by a global min-heap on due time, so finding chats with due reviews is O(log n) per item.
+    Items taken from the heap by `pop_due_chats` return to it after the next grade.
+
+    Changes are persisted with batched in-place writes of fixed-size records, see `flush`.
+    """
+
+    RECORD = struct.Struct('<qIIHHH')  # chat_id, word_ix, due, interval (days), ease * 1000, repetitions
+    # due time of an item that is not reviewed anymore, see `drop`
+    DROPPED = 0xFFFFFFFF
+    INITIAL_EASE = 2500
+    MIN_EASE = 1300
+    RELEARN_DELAY = 10 * 60
+    QUALITY_KNOW = 4
+    QUALITY_FORGOT = 1
+
+    def __init__(self, state_fp=None):
+        self.state_fp = state_fp
+        self._chat_ids = array('q')
+        self._word_ixs = array('I')
+        self._due = array('I')
+        self._intervals = array('H')
+        self._eases = array('H')
+        self._repetitions = array('H')
+        # chat_id -> ids of its items. users have at most a few hundred words, so scans are cheap
+        self._items_by_chat = {}
+        self.due_heap = IndexedMinHeap(self._due)
+
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+        if state_fp is not None and os.path.isfile(state_fp):
+            self._load()
+
+    def __len__(self):
+        return len(self._chat_ids)
+
+    def _add_item(self, chat_id, word_ix, due, interval=0, ease=INITIAL_EASE, repetitions=0, push=True):
+        item_id = len(self._chat_ids)
+        self._chat_ids.append(chat_id)
+        self._word_ixs.append(word_ix)
+        self._due.append(due)
+        self._intervals.append(interval)
+        self._eases.append(ease)
+        self._repetitions.append(repetitions)
+        items = self._items_by_chat.get(chat_id)
+        if items is None:
+            items = self._items_by_chat[chat_id] = array('I')
+        items.append(item_id)
+        if push:
+            self.due_heap.push(item_id)
+        return item_id
+
+    def _find_item(self, chat_id, word_ix):
+        for item_id in self._items_by_chat.get(chat_id, ()):
+            if self._word_ixs[item_id] == word_ix:
+                return item_id
+        return None
+
+    def add(self, chat_id, word_ix, now=None):
+        """
+        Start learning a new word. It is due immediately
+        """
+        now = int(now or time.time())
+        with self._lock:
+            item_id = self._find_item(chat_id, word_ix)
+            if item_id is None:
+                item_id = self._add_item(chat_id, word_ix, now)
+                self._dirty.add(item_id)
+            return item_id
+
+    def next_due_word(self, chat_id, n_words=None, now=None):
+        """
+        :param n_words: size of the catalog. words out of it, e.g. after the catalog shrank, are skipped
+        :return: index of the most overdue word of the chat or None if nothing is due
+        """
+        now = int(now or time.time())
+        with self._lock:
+            best = None
+            for item_id in self._items_by_chat.get(chat_id, ()):
+                due = self._due[item_id]
+                if n_words is not None and self._word_ixs[item_id] >= n_words:
+                    continue
+                if due <= now and (best is None or due < self._due[best]):
+                    best = item_id
+            return None if best is None else self._word_ixs[best]
+
+    def drop(self, chat_id, word_ix):
+        """
+        Stop reviewing the word, e.g. its photo was removed from the catalog.
+        The record of the item stays in the state file, marked with `DROPPED` due time
+        """
+        with self._lock:
+            item_id = self._find_item(chat_id, word_ix)
+            if item_id is None:
+                return
+            self.due_heap.remove(item_id)
+            self._due[item_id] = self.DROPPED
+            self._items_by_chat[chat_id].remove(item_id)
+            self._dirty.add(item_id)
+
+    def grade(self, chat_id, word_ix, knew, now=None):
+        """
+        Update the schedule of the word with SM-2 rules.
+        :param knew: True if the user remembered the word
+        :return: seconds until the next review
+        """
+        now = int(now or time.time())
+        with self._lock:
+            item_id = self._find_item(chat_id, word_ix)
+            if item_id is None:
+                item_id = self._add_item(chat_id, word_ix, now)
+
+            interval, ease, repetitions, delay = self.sm2_step(self._intervals[item_id], self._eases[item_id],
+                                                               self._repetitions[item_id], knew)
+            self._repetitions[item_id] = repetitions
+            self._eases[item_id] = ease
+            self._intervals[item_id] = interval
+            self._due[item_id] = now + delay
+            self.due_heap.push(item_id)
+            self._dirty.add(item_id)
+            return delay
+
+    @classmethod
+    def sm2_step(cls, interval, ease, repetitions, knew):
+        """
+        SM-2 rules for a graded word
+        :param ease: ease factor * 1000
+        :return: (interval in days, ease, repetitions, seconds until the next review)
+        """
+        quality = cls.QUALITY_KNOW if knew else cls.QUALITY_FORGOT
+        if quality >= 3:
+            if repetitions == 0:
+                new_interval = 1
+            elif repetitions == 1:
+                new_interval = 6
+            else:
+                new_interval = round(interval * ease / 1000)
+            new_interval = min(new_interval, 0xFFFF)
+            delay = new_interval * SECONDS_PER_DAY
+            repetitions = min(repetitions + 1, 0xFFFF)
+        else:
+            new_interval = 0
+            delay = cls.RELEARN_DELAY
+            repetitions = 0
+        ease = max(cls.MIN_EASE, ease + round(1000 * (0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))))
+        return new_interval, ease, repetitions, delay
+
+    def pop_due_chats(self, now=None, limit=None):
+        """
+        Take due items out of the heap
+        :return: set of chat_ids that have words to review
+        """
+        now = int(now or time.time())
+        chats = set()
+        with self._lock:
+            while len(self.due_heap) and self._due[self.due_heap.peek()] <= now:
+                if limit is not None and len(chats) >= limit:
+                    break
+                chats.add(self._chat_ids[self.due_heap.pop()])
+        return chats
+
+    def progress(self, chat_id):
+        """
+        :return: (words in learning, words remembered at least twice in a row)
+        """
+        with self._lock:
+            items = self._items_by_chat.get(chat_id, ())
+            return len(items), sum(1 for item_id in items if self._repetitions[item_id] >= 2)
+
+    def nbytes(self):
+        arrays = (self._chat_ids, self._word_ixs, self._due, self._intervals, self._eases, self._repetitions,
+                  self.due_heap._heap, self.due_heap._pos)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    # -------------- persistence --------------
+
+    def _record(self, item_id):
+        return self.RECORD.pack(self._chat_ids[item_id], self._word_ixs[item_id], self._due[item_id],
+                                self._intervals[item_id], self._eases[item_id], self._repetitions[item_id])
+
+    def flush(self, context=None):
+        """
+        Write changed items to `state_fp`. Every item has a fixed-size record at `item_id * RECORD.size`,
+        so changed records are overwritten in place and new ones are appended.
+        Items stay changed until the write succeeds, so a failed flush is repeated by the next one.
+        Can be used as a JobQueue callback
+        """
+        if self.state_fp is None:
+            return 0
+        with self._lock:
+            records = [(item_id, self._record(item_id)) for item_id in sorted(self._dirty)]
+        if not records:
+            return 0
+
+        mode = 'r+b' if os.path.isfile(self.state_fp) else 'wb'
+        with open(self.state_fp, mode) as fout:
+            # consecutive records are merged into a single write
+            ix = 0
+            while ix < len(records):
+                start_item_id = records[ix][0]
+                chunk = [records[ix][1]]
+                ix += 1
+                while ix < len(records) and records[ix][0] == start_item_id + len(chunk):
+                    chunk.append(records[ix][1])
+                    ix += 1
+                fout.seek(start_item_id * self.RECORD.size)
+                fout.write(b''.join(chunk))
+            fout.flush()
+            os.fsync(fout.fileno())
+        with self._lock:
+            for item_id, record in records:
+                # an item changed during the write stays changed
+                if self._record(item_id) == record:
+                    self._dirty.discard(item_id)
+        logger.info(f'ReviewScheduler. flushed {len(records)} items to "{self.state_fp}"')
+        return len(records)
+
+    def _load(self):
+        with open(self.state_fp, 'rb') as fin:
+            data = fin.read()
+        n_records = len(data) // self.RECORD.size
+        dropped = []
+        for item_id, record in enumerate(self.RECORD.iter_unpack(data[:n_records * self.RECORD.size])):
+            self._add_item(*record, push=False)
+            if record[2] == self.DROPPED:
+                dropped.append(item_id)
+        for item_id in dropped:
+            self._items_by_chat[self._chat_ids[item_id]].remove(item_id)
+        self.due_heap.heapify(item_id for item_id in range(n_records) if self._due[item_id] != self.DROPPED)
+        logger.info(f'ReviewScheduler. loaded {n_records} items from "{self.state_fp}"')
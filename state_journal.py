@@ -0,0 +1,410 @@
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+import numpy as np
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+OP_PUT, OP_DELETE = 1, 2
+N_VALUES = 4
+# stored instead of None values
+NULL = -2 ** 63
+# table of `ConversationStore` records. `JournalPersistence` numbers conversations after it
+TABLE_CONVERSATION_CONTEXT = 0
+
+
+class StateJournal:
+    """
+    Crash-safe store of small per-chat records: an append-only journal of changes and compacted snapshots.
+
+    A record is keyed by (table, chat_id, user_id) and holds up to `N_VALUES` integers (or None) and
+    the time it was touched. Changes are buffered in memory and written by a background thread every
+    `commit_interval` seconds with a single fsync for all of them (group commit): a crash loses at most
+    the last interval. `add_commit_hook` lets owners of mutable state journal it lazily at commit time.
+
+    The journal is a sequence of segment files. When the current segment exceeds `segment_bytes`,
+    a new one is started and a background thread merges the closed segments into the snapshot.
+    Records older than `max_age` are dropped on the way, so files are bounded by the number of live chats.
+    Snapshot records are sorted by touch time: `load` maps the snapshot and bisects it to the first live
+    record, then replays the segments written after the snapshot. A torn or corrupted tail of a segment,
+    e.g. after a crash in the middle of a write, is detected by the record checksum and cut off.
+
+    File layout (little endian):
+        snapshot:  header, `ENTRY` records sorted by touched_at
+        segment:   `ENTRY` records, each followed by crc32 of the record
+    """
+
+    MAGIC = b'LKSJ'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIQQd')  # magic, version, n_records, first segment not in the snapshot, written_at
+    ENTRY = struct.Struct(f'<BBqqd{N_VALUES}q')  # op, table, chat_id, user_id, touched_at, values
+    CRC = struct.Struct('<I')
+    FRAME_SIZE = ENTRY.size + CRC.size
+    # `ENTRY` as numpy dtype to read the snapshot in bulk
+    ENTRY_DTYPE = np.dtype([('op', 'u1'), ('table', 'u1'), ('chat_id', '<i8'), ('user_id', '<i8'),
+                            ('touched_at', '<f8'), ('values', '<i8', (N_VALUES,))])
+
+    def __init__(self, journal_fp, max_age=None, commit_interval=0.05, segment_bytes=16 * 2 ** 20, clock=time.time):
+        """
+        :param journal_fp: path prefix of the files, e.g. "conversation_state": "conversation_state.snapshot",
+        "conversation_state.00000001.journal", ...
+        :param max_age: records not touched for `max_age` seconds are not restored. None to keep all records
+        """
+        self.journal_fp = journal_fp
+        self.snapshot_fp = f'{journal_fp}.snapshot'
+        self.max_age = max_age
+        self.commit_interval = commit_interval
+        self.segment_bytes = segment_bytes
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._commit_lock = threading.RLock()
+        self._buffer = []
+        self._hooks = []
+        self._fd = None
+        self._seq = None
+        self._segment_size = 0
+
+        self._stopped = threading.Event()
+        self._commit_thread = None
+        self._compact_needed = threading.Event()
+        self._compact_thread = None
+
+        self.n_records = 0
+        self.n_commits = 0
+        self.n_bytes = 0
+        self.n_compactions = 0
+        self.last_compaction_seconds = None
+
+    def segment_fp(self, seq):
+        return f'{self.journal_fp}.{seq:08d}.journal'
+
+    def _segment_seqs(self):
+        seqs = []
+        for fp in glob.glob(glob.escape(self.journal_fp) + '.*.journal'):
+            seq = fp[len(self.journal_fp) + 1:-len('.journal')]
+            if seq.isdigit():
+                seqs.append(int(seq))
+        return sorted(seqs)
+
+    def _min_touched_at(self):
+        return float('-inf') if self.max_age is None else self.clock() - self.max_age
+
+    # -------------- encoding --------------
+
+    @classmethod
+    def _encode(cls, op, table, chat_id, user_id, values, touched_at):
+        values = [NULL if x is None else x for x in values]
+        values += [NULL] * (N_VALUES - len(values))
+        entry = cls.ENTRY.pack(op, table, chat_id, user_id, touched_at, *values)
+        return entry + cls.CRC.pack(zlib.crc32(entry))
+
+    @staticmethod
+    def _decode_values(values):
+        return tuple([None if x == NULL else x for x in values])
+
+    @staticmethod
+    def _apply(state, op, table, chat_id, user_id, touched_at, values):
+        # re-inserted, so `state` stays in the order of touches
+        state.pop((table, chat_id, user_id), None)
+        if op == OP_PUT:
+            state[(table, chat_id, user_id)] = (StateJournal._decode_values(values), touched_at)
+
+    # -------------- restore --------------
+
+    def _read_snapshot(self, state, min_touched_at):
+        """
+        Add live records of the snapshot to `state`
+        :return: first segment that is not in the snapshot
+        """
+        if not os.path.isfile(self.snapshot_fp):
+            return 0
+        with open(self.snapshot_fp, 'rb') as fin:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, n_records, journal_seq, _ = self.HEADER.unpack_from(mm)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f'"{self.snapshot_fp}" is not a state journal snapshot')
+            entries = np.frombuffer(mm, self.ENTRY_DTYPE, count=n_records, offset=self.HEADER.size)
+            entries = entries[np.searchsorted(entries['touched_at'], min_touched_at):]
+            values = entries['values'].astype(object)
+            values[entries['values'] == NULL] = None
+            keys = zip(entries['table'].tolist(), entries['chat_id'].tolist(), entries['user_id'].tolist())
+            state.update(zip(keys, zip(map(tuple, values.tolist()), entries['touched_at'].tolist())))
+            # views of the mapping must be released before it is closed
+            del entries, values
+            return journal_seq
+        finally:
+            mm.close()
+
+    def _replay_segment(self, state, seq, truncate):
+        """
+        Apply records of the segment to `state`. A corrupted tail is cut off if `truncate`
+        :return: number of applied records
+        """
+        fp = self.segment_fp(seq)
+        with open(fp, 'rb') as fin:
+            data = fin.read()
+        entry_size = self.ENTRY.size
+        n_valid = 0
+        for pos in range(0, len(data) - self.FRAME_SIZE + 1, self.FRAME_SIZE):
+            entry = data[pos:pos + entry_size]
+            if self.CRC.unpack_from(data, pos + entry_size)[0] != zlib.crc32(entry):
+                break
+            op, table, chat_id, user_id, touched_at, *values = self.ENTRY.unpack(entry)
+            self._apply(state, op, table, chat_id, user_id, touched_at, values)
+            n_valid += 1
+        valid_size = n_valid * self.FRAME_SIZE
+        if valid_size != len(data):
+            logger.warning(f'StateJournal. {len(data) - valid_size} bytes of a torn write at the end of "{fp}"')
+            if truncate:
+                with open(fp, 'r+b') as fout:
+                    fout.truncate(valid_size)
+        return n_valid
+
+    def load(self):
+        """
+        Restore records and open a new segment for changes. Must be called before any change
+        :return: dict: (table, chat_id, user_id) -> (values, touched_at) of records touched within `max_age`
+        """
+        start = time.perf_counter()
+        min_touched_at = self._min_touched_at()
+        state = {}
+        journal_seq = self._read_snapshot(state, min_touched_at)
+        n_replayed = 0
+        seqs = self._segment_seqs()
+        for seq in seqs:
+            if seq < journal_seq:
+                # merged into the snapshot by a compaction that crashed before removing the segment
+                os.remove(self.segment_fp(seq))
+                continue
+            n_replayed += self._replay_segment(state, seq, truncate=True)
+        if n_replayed and self.max_age is not None:
+            state = {key: x for key, x in state.items() if x[1] >= min_touched_at}
+
+        self._open_segment(max(seqs + [journal_seq - 1]) + 1)
+        logger.info(f'StateJournal. restored {len(state)} records from "{self.journal_fp}" '
+                    f'in {time.perf_counter() - start:.2f} s. replayed journal records: {n_replayed}')
+        return state
+
+    # -------------- changes --------------
+
+    def put(self, table, chat_id, user_id, values, touched_at=None):
+        """
+        :param values: up to `N_VALUES` integers or None
+        """
+        if touched_at is None:
+            touched_at = self.clock()
+        frame = self._encode(OP_PUT, table, chat_id, user_id, values, touched_at)
+        with self._lock:
+            self._buffer.append(frame)
+
+    def delete(self, table, chat_id, user_id):
+        frame = self._encode(OP_DELETE, table, chat_id, user_id, (), self.clock())
+        with self._lock:
+            self._buffer.append(frame)
+
+    def add_commit_hook(self, hook):
+        """
+        :param hook: called without arguments at the start of every commit, e.g. to `put` dirty records
+        """
+        self._hooks.append(hook)
+
+    def _open_segment(self, seq):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._seq = seq
+        self._fd = os.open(self.segment_fp(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._segment_size = os.fstat(self._fd).st_size
+
+    def commit(self):
+        """
+        Write buffered changes and wait until they are on disk
+        """
+        with self._commit_lock:
+            if self._fd is None:
+                raise RuntimeError('StateJournal.load must be called before commit')
+            for hook in self._hooks:
+                hook()
+            with self._lock:
+                buffer, self._buffer = self._buffer, []
+            if not buffer:
+                return
+            data = b''.join(buffer)
+            os.write(self._fd, data)
+            os.fsync(self._fd)
+            self._segment_size += len(data)
+            self.n_records += len(buffer)
+            self.n_bytes += len(data)
+            self.n_commits += 1
+            if self._segment_size >= self.segment_bytes:
+                self.rotate()
+                self._compact_needed.set()
+
+    def flush(self):
+        self.commit()
+
+    def rotate(self):
+        """
+        Start a new segment. Closed segments are merged into the snapshot by `compact`
+        """
+        with self._commit_lock:
+            self._open_segment(self._seq + 1)
+
+    # -------------- compaction --------------
+
+    def compact(self):
+        """
+        Merge the snapshot and closed segments into a new snapshot and remove the segments
+        """
+        start = time.perf_counter()
+        with self._commit_lock:
+            last_seq = self._seq
+        closed = [seq for seq in self._segment_seqs() if seq < last_seq]
+        min_touched_at = self._min_touched_at()
+        state = {}
+        self._read_snapshot(state, min_touched_at)
+        for seq in closed:
+            self._replay_segment(state, seq, truncate=False)
+        records = sorted(((touched_at, key, values) for key, (values, touched_at) in state.items()
+                          if touched_at >= min_touched_at), key=lambda x: x[0])
+
+        tmp_fp = f'{self.snapshot_fp}.tmp'
+        with open(tmp_fp, 'wb') as fout:
+            fout.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(records), last_seq, self.clock()))
+            for touched_at, (table, chat_id, user_id), values in records:
+                fout.write(self._encode(OP_PUT, table, chat_id, user_id, values, touched_at)[:self.ENTRY.size])
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmp_fp, self.snapshot_fp)
+        self._fsync_dir()
+        for seq in closed:
+            os.remove(self.segment_fp(seq))
+        self.n_compactions += 1
+        self.last_compaction_seconds = time.perf_counter() - start
+        logger.info(f'StateJournal. compacted {len(closed)} segments into a snapshot of {len(records)} records '
+                    f'in {self.last_compaction_seconds:.2f} s')
+
+    def _fsync_dir(self):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.snapshot_fp)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    # -------------- background threads --------------
+
+    def start(self):
+        if self._commit_thread is not None:
+            return
+        self._stopped.clear()
+        self._commit_thread = threading.Thread(target=self._commit_loop, name='StateJournal', daemon=True)
+        self._commit_thread.start()
+        self._compact_thread = threading.Thread(target=self._compact_loop, name='StateJournalCompaction',
+                                                daemon=True)
+        self._compact_thread.start()
+        if len(self._segment_seqs()) > 1:
+            # merge segments of the previous runs
+            self._compact_needed.set()
+
+    def _commit_loop(self):
+        while not self._stopped.wait(self.commit_interval):
+            try:
+                self.commit()
+            except OSError as e:
+                logger.error(f'StateJournal. commit failed: {e}')
+
+    def _compact_loop(self):
+        while True:
+            self._compact_needed.wait()
+            if self._stopped.is_set():
+                return
+            self._compact_needed.clear()
+            try:
+                self.compact()
+            except OSError as e:
+                logger.error(f'StateJournal. compaction failed: {e}')
+
+    def stats(self):
+        return {'records': self.n_records, 'commits': self.n_commits, 'bytes': self.n_bytes,
+                'segment': self._seq, 'compactions': self.n_compactions}
+
+    def close(self):
+        """
+        Commit buffered changes and stop the threads
+        """
+        if self._commit_thread is not None:
+            self._stopped.set()
+            self._commit_thread.join()
+            self._compact_needed.set()
+            self._compact_thread.join()
+            self._commit_thread = self._compact_thread = None
+        if self._fd is not None:
+            self.commit()
+            os.close(self._fd)
+            self._fd = None
+
+
+class JournalPersistence(BasePersistence):
+    """
+    Persistence of `ConversationHandler` states in a `StateJournal`, so conversations survive restarts
+    and deploys. Only conversations are stored: the bot keeps no user_data or chat_data.
+
+    Unlike the stock PicklePersistence, every state change is a single journal record instead of
+    a rewrite of the whole state. Timeouts of conversations are not stored: restored
+    conversations are listed by `restored_conversations` for the bot to end them in time.
+    """
+
+    def __init__(self, journal, conversation_names, restored=None):
+        """
+        :param conversation_names: names of persistent ConversationHandlers. the order must be kept between runs
+        :param restored: records returned by `StateJournal.load`
+        """
+        super().__init__(store_user_data=False, store_chat_data=False)
+        self.journal = journal
+        self.tables = {name: table for table, name in enumerate(conversation_names, TABLE_CONVERSATION_CONTEXT + 1)}
+        self._restored = {name: {} for name in conversation_names}
+        for (table, chat_id, user_id), (values, touched_at) in (restored or {}).items():
+            for name, name_table in self.tables.items():
+                if table == name_table:
+                    self._restored[name][(chat_id, user_id)] = (values[0], touched_at)
+
+    def restored_conversations(self, name):
+        """
+        :return: dict: conversation key -> (state, touched_at) of conversations restored on start,
+        for the bot to arm their timeouts with the time they have left
+        """
+        return self._restored[name]
+
+    def get_conversations(self, name):
+        return {key: state for key, (state, _) in self._restored[name].items()}
+
+    def update_conversation(self, name, key, new_state):
+        chat_id, user_id = key
+        if new_state is None:
+            self.journal.delete(self.tables[name], chat_id, user_id)
+        elif isinstance(new_state, int):
+            self.journal.put(self.tables[name], chat_id, user_id, (new_state,))
+
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def flush(self):
+        self.journal.flush()
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update):
+    """
+    :return: id of the user the update comes from, id of the chat for channel posts.
+    0 for updates without both and for errors put into the update queue by the polling thread
+    """
+    if not isinstance(update, Update):
+        return 0
+    obj = update.effective_user or update.effective_chat
+    return 0 if obj is None else obj.id
+
+
+class ThreadedChatLanes:
+    """
+    Per-chat FIFO lanes of updates of the threaded mode, as `async_dispatch.ChatLanes` of the asyncio mode:
+    updates of a chat are handled one at a time in arrival order, updates of different chats concurrently
+    by a pool of `n_threads` threads. The dispatcher thread only queues updates, so a handler waiting
+    in `BotScheduler.admit` for the turn of its chat, e.g. sending `/get 10` to a paced chat,
+    holds back only the updates of this chat.
+
+    At most `max_in_flight` updates are queued or handled at once: `submit` waits for a free slot,
+    which holds back the update queue of the dispatcher instead of buffering without bound
+    """
+
+    def __init__(self, n_threads=64, max_in_flight=10_000):
+        self.n_threads = n_threads
+        self.max_in_flight = max_in_flight
+        self.handle = None
+        # chat key -> updates of the chat. the first one is being handled or waits in `_ready`
+        self._lanes = {}
+        # keys of lanes waiting for a thread
+        self._ready = deque()
+        self._lock = threading.Lock()
+        # `_work` waits on `_cond` for a ready lane, `join` on `_idle` for all updates to be handled
+        self._cond = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        self._slots = threading.Semaphore(max_in_flight)
+        self._stopped = False
+        self._threads = []
+        self.n_in_flight = 0
+        self.peak_in_flight = 0
+        self.n_handled = 0
+        self.n_failed = 0
+
+    def __len__(self):
+        return self.n_in_flight
+
+    def install(self, dispatcher):
+        """
+        Handle the updates of the dispatcher in the lanes: its thread keeps taking updates from the update queue,
+        `process_update` is called by the threads of the lanes
+        """
+        self.handle = dispatcher.process_update
+        dispatcher.process_update = self.submit
+        return self
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._work, name=f'ChatLanes_{i}', daemon=True)
+                         for i in range(self.n_threads)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """
+        Wait up to `timeout` seconds for the queued updates to be handled and stop the threads
+        """
+        if not self._threads:
+            return
+        deadline = time.monotonic() + timeout
+        if not self.join(timeout):
+            logger.warning(f'ThreadedChatLanes. {self.n_in_flight} updates were not handled before the stop')
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+    def join(self, timeout=None):
+        """
+        Wait for the queued updates to be handled
+        :return: True if all of them were handled in time
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.n_in_flight, timeout)
+
+    def submit(self, update):
+        self._slots.acquire()
+        key = update_key(update)
+        with self._cond:
+            self.n_in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.n_in_flight)
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append(update)
+                return
+            self._lanes[key] = deque([update])
+            self._ready.append(key)
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                lane = self._lanes[key]
+                update = lane[0]
+            failed = False
+            try:
+                self.handle(update)
+            except Exception as e:
+                failed = True
+                logger.exception(f'ThreadedChatLanes. failed to handle an update of chat {key}: {e}')
+            with self._lock:
+                lane.popleft()
+                self.n_in_flight -= 1
+                self.n_failed += failed
+                self.n_handled += not failed
+                # to the back of the queue: a chat with many queued updates doesn't starve the others
+                if lane:
+                    self._ready.append(key)
+                    self._cond.notify()
+                else:
+                    del self._lanes[key]
+                if not self.n_in_flight:
+                    self._idle.notify_all()
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self.n_in_flight, 'peak_in_flight': self.peak_in_flight, 'chats': len(self._lanes),
+                    'handled': self.n_handled, 'failed': self.n_failed}
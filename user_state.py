@@ -0,0 +1,263 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from review_scheduler import ReviewScheduler
+from word_sampler import FeistelPermutation, permutation_key
+
+logger = logging.getLogger(__name__)
+
+
+class UserStateDb:
+    """
+    Durable state of users shared by the workers of the sharded mode: word permutations of `SharedWordSampler`
+    and review schedules of `SharedReviewScheduler` in a single sqlite database.
+
+    The router may move a chat to another worker when workers are added or removed, so nothing a chat
+    needs later is kept only in the memory or in the files of a worker. Every change is a short write
+    transaction: WAL lets the workers read concurrently, writers wait for each other up to `busy_timeout`
+    """
+
+    def __init__(self, db_fp, busy_timeout=30):
+        self.db_fp = db_fp
+        self._conn = sqlite3.connect(db_fp, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sampler_meta ('
+                               'name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            # `n_words`: size of the catalog the current epoch of the chat covers
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sampler_positions ('
+                               'chat_id INTEGER PRIMARY KEY, position INTEGER NOT NULL, epoch INTEGER NOT NULL, '
+                               'n_words INTEGER NOT NULL)')
+            # `queued`: the item waits for `pop_due_chats`, as an item in the heap of `ReviewScheduler`
+            self._conn.execute('CREATE TABLE IF NOT EXISTS review_items ('
+                               'chat_id INTEGER NOT NULL, word_ix INTEGER NOT NULL, due INTEGER NOT NULL, '
+                               'interval INTEGER NOT NULL, ease INTEGER NOT NULL, repetitions INTEGER NOT NULL, '
+                               'queued INTEGER NOT NULL, PRIMARY KEY (chat_id, word_ix)) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS review_items_due ON review_items (queued, due)')
+
+    @contextmanager
+    def read(self):
+        with self._lock:
+            yield self._conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Write transaction. The write lock of the database is taken at the start,
+        so values read inside can't be changed by another worker before the commit
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SharedWordSampler:
+    """
+    `WordSampler` on top of `UserStateDb`: (position, epoch, size of the epoch) of every chat is a row,
+    the seed is shared by the workers. Permutations are the same as of `WordSampler`: words added
+    to the catalog join the next epoch of the chat.
+
+    A draw that needs the database reserves the next `block_size` positions of the chat in a single write
+    transaction, the following draws of the chat are served from memory. Positions a worker reserved
+    and did not draw, e.g. when the router moved the chat to another worker or the worker restarted,
+    are skipped: their words are not shown until the next epoch, none is shown twice within it.
+    Blocks unused for `block_ttl` seconds are dropped, so a chat that comes back doesn't continue
+    a permutation the other workers have moved on from
+    """
+
+    def __init__(self, db, n_words, block_size=16, max_blocks=100_000, block_ttl=10 * 60):
+        """
+        :param db: `UserStateDb`
+        :param max_blocks: chats to keep reserved positions of. least recently used ones are dropped
+        """
+        self.db = db
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.block_ttl = block_ttl
+        # chat_id -> [next position, end of the block, epoch, time of the reservation, size of the epoch]
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.n_words = None
+        # catalog size -> permutation
+        self._permutations = {}
+        with db.transaction() as conn:
+            # 63 bits: sqlite integers are signed
+            conn.execute('INSERT OR IGNORE INTO sampler_meta VALUES (?, ?)',
+                         ('seed', int.from_bytes(os.urandom(8), 'little') >> 1))
+            self.seed = conn.execute('SELECT value FROM sampler_meta WHERE name = ?', ('seed',)).fetchone()[0]
+        self.resize(n_words)
+
+    def __len__(self):
+        with self.db.read() as conn:
+            return conn.execute('SELECT COUNT(*) FROM sampler_positions').fetchone()[0]
+
+    def draw(self, chat_id):
+        """
+        :return: index of the next word for the chat
+        """
+        now = time.monotonic()
+        with self._lock:
+            n_words = self.n_words
+            block = self._blocks.get(chat_id)
+            if block is not None and block[0] < block[1] and now - block[3] < self.block_ttl:
+                position, epoch, epoch_size = block[0], block[2], block[4]
+                block[0] += 1
+                self._blocks.move_to_end(chat_id)
+                return self._permutation(epoch_size)(position, permutation_key(self.seed, chat_id, epoch))
+
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT position, epoch, n_words FROM sampler_positions WHERE chat_id = ?',
+                               (chat_id,)).fetchone()
+            position, epoch, epoch_size = row or (0, 0, n_words)
+            if epoch_size > n_words:
+                # the epoch covers a catalog this worker doesn't have: another worker reloaded a bigger one
+                # or hasn't reloaded a smaller one yet
+                position, epoch, epoch_size = 0, (epoch + 1) & 0xFFFFFFFF, n_words
+            # a block doesn't cross the end of the epoch
+            end = min(position + self.block_size, epoch_size)
+            if end >= epoch_size:
+                next_position, next_epoch, next_size = 0, (epoch + 1) & 0xFFFFFFFF, n_words
+            else:
+                next_position, next_epoch, next_size = end, epoch, epoch_size
+            conn.execute('INSERT OR REPLACE INTO sampler_positions VALUES (?, ?, ?, ?)',
+                         (chat_id, next_position, next_epoch, next_size))
+
+        with self._lock:
+            # not if the catalog shrank meanwhile: the rest of the block belongs to the old permutations
+            if epoch_size <= self.n_words:
+                self._blocks[chat_id] = [position + 1, end, epoch, now, epoch_size]
+                self._blocks.move_to_end(chat_id)
+                if len(self._blocks) > self.max_blocks:
+                    self._blocks.popitem(last=False)
+            permutation = self._permutation(epoch_size)
+        return permutation(position, permutation_key(self.seed, chat_id, epoch))
+
+    def _permutation(self, n_words):
+        permutation = self._permutations.get(n_words)
+        if permutation is None:
+            permutation = self._permutations[n_words] = FeistelPermutation(n_words)
+        return permutation
+
+    def resize(self, n_words):
+        """
+        Switch to a catalog of another size. When it grows, users keep their permutations
+        and see the new words from their next epoch. When it shrinks, users whose epochs cover a bigger catalog
+        start a new permutation once, whichever worker reloads the catalog first
+        """
+        if n_words == self.n_words:
+            return
+        with self.db.transaction() as conn:
+            n_restarted = conn.execute('UPDATE sampler_positions SET position = 0, epoch = (epoch + 1) & 4294967295, '
+                                       'n_words = ? WHERE n_words > ?', (n_words, n_words)).rowcount
+        if n_restarted:
+            logger.info(f'SharedWordSampler. catalog shrank to {n_words} words. '
+                        f'restarted permutations of {n_restarted} users')
+        with self._lock:
+            if self.n_words is not None and n_words < self.n_words:
+                # reserved positions belong to the permutations of the bigger catalog
+                self._blocks.clear()
+            self._permutation(n_words)
+            self.n_words = n_words
+
+
+class SharedReviewScheduler:
+    """
+    `ReviewScheduler` on top of `UserStateDb`: an item is a row, due items are found with an index on due time.
+    Changes are committed right away, `flush` is kept for the interface
+    """
+
+    def __init__(self, db):
+        """
+        :param db: `UserStateDb`
+        """
+        self.db = db
+        self.state_fp = db.db_fp
+
+    def __len__(self):
+        with self.db.read() as conn:
+            return conn.execute('SELECT COUNT(*) FROM review_items').fetchone()[0]
+
+    def add(self, chat_id, word_ix, now=None):
+        """
+        Start learning a new word. It is due immediately
+        """
+        now = int(now or time.time())
+        with self.db.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO review_items VALUES (?, ?, ?, 0, ?, 0, 1)',
+                         (chat_id, word_ix, now, ReviewScheduler.INITIAL_EASE))
+
+    def next_due_word(self, chat_id, n_words=None, now=None):
+        """
+        :param n_words: size of the catalog. words out of it, e.g. after the catalog shrank, are skipped
+        :return: index of the most overdue word of the chat or None if nothing is due
+        """
+        now = int(now or time.time())
+        with self.db.read() as conn:
+            row = conn.execute('SELECT word_ix FROM review_items WHERE chat_id = ? AND due <= ? AND word_ix < ? '
+                               'ORDER BY due LIMIT 1',
+                               (chat_id, now, (1 << 63) - 1 if n_words is None else n_words)).fetchone()
+        return None if row is None else row[0]
+
+    def drop(self, chat_id, word_ix):
+        """
+        Stop reviewing the word, e.g. its photo was removed from the catalog
+        """
+        with self.db.transaction() as conn:
+            conn.execute('DELETE FROM review_items WHERE chat_id = ? AND word_ix = ?', (chat_id, word_ix))
+
+    def grade(self, chat_id, word_ix, knew, now=None):
+        """
+        Update the schedule of the word with SM-2 rules, see `ReviewScheduler.sm2_step`
+        :return: seconds until the next review
+        """
+        now = int(now or time.time())
+        with self.db.transaction() as conn:
+            row = conn.execute('SELECT interval, ease, repetitions FROM review_items '
+                               'WHERE chat_id = ? AND word_ix = ?', (chat_id, word_ix)).fetchone()
+            interval, ease, repetitions, delay = ReviewScheduler.sm2_step(
+                *(row or (0, ReviewScheduler.INITIAL_EASE, 0)), knew)
+            conn.execute('INSERT OR REPLACE INTO review_items VALUES (?, ?, ?, ?, ?, ?, 1)',
+                         (chat_id, word_ix, now + delay, interval, ease, repetitions))
+        return delay
+
+    def pop_due_chats(self, now=None, limit=None):
+        """
+        Take due items out of the queue until their next grade
+        :return: set of chat_ids that have words to review
+        """
+        now = int(now or time.time())
+        with self.db.transaction() as conn:
+            chats = {chat_id for chat_id, in conn.execute(
+                'SELECT chat_id FROM review_items WHERE queued = 1 AND due <= ? GROUP BY chat_id '
+                'ORDER BY MIN(due) LIMIT ?', (now, -1 if limit is None else limit))}
+            conn.executemany('UPDATE review_items SET queued = 0 WHERE chat_id = ? AND queued = 1 AND due <= ?',
+                             ((chat_id, now) for chat_id in chats))
+        return chats
+
+    def progress(self, chat_id):
+        """
+        :return: (words in learning, words remembered at least twice in a row)
+        """
+        with self.db.read() as conn:
+            n_learning, n_learned = conn.execute('SELECT COUNT(*), SUM(repetitions >= 2) FROM review_items '
+                                                 'WHERE chat_id = ?', (chat_id,)).fetchone()
+        return n_learning, n_learned or 0
+
+    def flush(self, context=None):
+        return 0
@@ -1,13 +1,22 @@
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
 import shutil
+import time
 
 import telegram
 import tqdm
 from PIL import Image
 from telegram.ext import CallbackContext
 
+import photo_dedup
+from engagement import ACCEPTED, SHOWN, SKIPPED, EngagementCounters
+from photo_catalog import PhotoCatalog
+from rate_limiter import TokenBucket
+from word_catalog import WordIndex, read_catalog
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,26 +26,151 @@ def error_handler(update: telegram.Update, context: CallbackContext):
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
-def upload_photos_and_store_file_ids(bot, chat_id, photos_dp_list, json_file_fp='photo_file_ids.json'):
-    logger.info(f'uploading photos to bot')
+def file_sha256(fp, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(fp, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 
-    photo_file_ids = {}
-    for cur_dp in photos_dp_list:
-        cur_photos_fps = get_photos_fps_from_dp(cur_dp)
-        for fp in tqdm.tqdm(cur_photos_fps, desc=cur_dp):
+def read_upload_journal(journal_fp):
+    """
+    :return: dict sha256 -> (file_id, orientation) of photos uploaded by previous runs.
+    orientation is None in records written before orientations were journaled
+    """
+    uploaded = {}
+    if not os.path.isfile(journal_fp):
+        return uploaded
+    with open(journal_fp) as fin:
+        for line in fin:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # last line could be truncated by a crash
+                logger.warning(f'skipping broken line in {journal_fp}: {line!r}')
+                continue
+            uploaded[record['sha256']] = record['file_id'], record.get('orientation')
+    return uploaded
+
+
+def upload_photo(bot, chat_id, fp, rate_limiter, max_retries=5):
+    """
+    Upload a single photo honoring `rate_limiter` and `retry_after` of flood control errors
+    :return: (file_id, orientation) of the uploaded photo. orientation is of the photo as Telegram shows it
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        try:
             with open(fp, 'rb') as fin:
                 res = bot.send_photo(chat_id, fin)
-            # it doesn't matter which of scaled images file_id would be saved.
-            # but sort images by resolution just in case
-            sorted_rev = sorted(res.photo, key=lambda x: max(x['height'], x['width']), reverse=True)
-            item = sorted_rev[0]
-            file_id = item["file_id"]
-            basename = os.path.basename(fp)
-            photo_file_ids[basename] = file_id
+            break
+        except telegram.error.RetryAfter as e:
+            logger.warning(f'flood control exceeded. pausing uploads for {e.retry_after} s')
+            rate_limiter.pause(e.retry_after)
+        except telegram.error.BadRequest:
+            raise
+        except telegram.error.NetworkError as e:
+            if attempt == max_retries:
+                raise
+            logger.warning(f'failed to upload "{fp}": {e}. retrying')
+            time.sleep(min(2 ** attempt, 30))
+    else:
+        raise RuntimeError(f'failed to upload "{fp}" after {max_retries} retries')
+
+    # it doesn't matter which of scaled images file_id would be saved.
+    # but sort images by resolution just in case
+    sorted_rev = sorted(res.photo, key=lambda x: max(x['height'], x['width']), reverse=True)
+    return sorted_rev[0]['file_id'], photo_orientation(sorted_rev[0]['width'], sorted_rev[0]['height'])
+
+
+def upload_photos_and_store_file_ids(bot, chat_id, photos_dp_list, json_file_fp='photo_file_ids.json',
+                                     journal_fp=None, max_workers=8, rate=1.0,
+                                     orientations_fp=None):
+    """
+    Upload photos in parallel and store their file_ids to `json_file_fp`
+    and their orientations to `orientations_fp`, the inputs of `PhotoCatalog.build_from_json`.
+    Photos are keyed by sha256 of their content: every upload is appended to `journal_fp` right away,
+    so photos uploaded by previous (possibly crashed) runs are not uploaded again.
+    A failed upload doesn't stop the others: they are journaled, and `json_file_fp` is only written
+    when every photo has a file_id, so a re-run uploads just the failed ones.
+    Invalid token or a blocked chat fail every upload: pending uploads are cancelled then,
+    uploads that have already finished are journaled before the error is raised
+    :param max_workers: number of parallel uploads
+    :param rate: max uploads per second
+    :param orientations_fp: `photo_orientations.json` next to `json_file_fp` if None
+    :raises RuntimeError: if some uploads failed
+    """
+    logger.info(f'uploading photos to bot')
+    journal_fp = journal_fp or f'{json_file_fp}.journal'
+    orientations_fp = orientations_fp or os.path.join(os.path.dirname(json_file_fp), 'photo_orientations.json')
+    uploaded = read_upload_journal(journal_fp)
+    logger.info(f'{len(uploaded)} photos are found in journal {journal_fp}')
+
+    photos_fps = [fp for cur_dp in photos_dp_list for fp in get_photos_fps_from_dp(cur_dp)]
+    hashes = {fp: file_sha256(fp) for fp in tqdm.tqdm(photos_fps, desc='hashing')}
+
+    to_upload = {}
+    for fp, sha in hashes.items():
+        if sha not in uploaded and sha not in to_upload:
+            to_upload[sha] = fp
+    logger.info(f'photos: {len(photos_fps)}, unique: {len(set(hashes.values()))}, to upload: {len(to_upload)}')
 
+    rate_limiter = TokenBucket(rate)
+    n_bytes = 0
+    failed = []
+    start = time.perf_counter()
+    with open(journal_fp, 'a') as journal, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload_photo, bot, chat_id, fp, rate_limiter): (sha, fp)
+                   for sha, fp in to_upload.items()}
+        handled = set()
+
+        def journal_upload(future):
+            sha, fp = futures[future]
+            file_id, orientation = uploaded[sha] = future.result()
+            journal.write(json.dumps({'sha256': sha, 'basename': os.path.basename(fp), 'file_id': file_id,
+                                      'orientation': orientation}) + '\n')
+            journal.flush()
+
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc='uploading'):
+            handled.add(future)
+            sha, fp = futures[future]
+            try:
+                future.result()
+            except (telegram.error.Unauthorized, telegram.error.InvalidToken) as e:
+                logger.error(f'failed to upload "{fp}": {e}. cancelling pending uploads')
+                for pending in futures:
+                    pending.cancel()
+                # uploads finished meanwhile or still running are not lost: a re-run skips them
+                concurrent.futures.wait(futures)
+                for done in futures:
+                    if done not in handled and not done.cancelled() and done.exception() is None:
+                        journal_upload(done)
+                raise
+            except Exception as e:
+                logger.error(f'failed to upload "{fp}": {e}')
+                failed.append(fp)
+                continue
+            journal_upload(future)
+            n_bytes += os.path.getsize(fp)
+    elapsed = time.perf_counter() - start
+    n_uploaded = len(to_upload) - len(failed)
+    if to_upload:
+        logger.info(f'uploaded {n_uploaded} photos in {elapsed:.1f} s: '
+                    f'{n_uploaded / elapsed:.1f} photos/s, {n_bytes / elapsed / 2 ** 20:.2f} MB/s')
+    if failed:
+        raise RuntimeError(f'failed to upload {len(failed)} photos, e.g. "{failed[0]}". '
+                           f'{n_uploaded} uploaded photos are kept in journal {journal_fp}, run again to retry')
+
+    photo_file_ids = {os.path.basename(fp): uploaded[sha][0] for fp, sha in hashes.items()}
     logger.info(f'storing photo file_ids to {json_file_fp}')
     with open(json_file_fp, 'w') as fout:
         json.dump(photo_file_ids, fout)
+    # photos journaled without orientation: from the image header
+    orientations = {os.path.basename(fp): uploaded[sha][1] or read_photo_orientation(fp) for fp, sha in hashes.items()}
+    _update_photo_orientations(orientations_fp, orientations)
+    return photo_file_ids
 
 
 def send_photos_by_file_ids(bot, chat_id, file_ids: dict):
@@ -62,9 +196,49 @@ def sort_vertical_from_horizontal_photos(photos_dp):
             shutil.copy(fp, horizontal_dp)
 
 
+def photo_orientation(width, height):
+    return 'vertical' if height >= width else 'horizontal'
+
+
+def read_photo_orientation(fp):
+    """
+    Only the image header is read
+    """
+    with Image.open(fp) as img:
+        return photo_orientation(*img.size)
+
+
+def _update_photo_orientations(orientations_fp, orientations):
+    """
+    Merge orientations into `orientations_fp`: orientations of photos stored by previous runs are kept
+    :return: all stored orientations
+    """
+    stored = {}
+    if os.path.isfile(orientations_fp):
+        with open(orientations_fp) as fin:
+            stored = json.load(fin)
+    stored.update(orientations)
+    with open(orientations_fp, 'w') as fout:
+        json.dump(stored, fout)
+    logger.info(f'stored orientations of {len(stored)} photos to "{orientations_fp}"')
+    return stored
+
+
+def store_photo_orientations(photos_dp_list, orientations_fp='photo_orientations.json'):
+    """
+    Store orientation of photos for `PhotoCatalog.build_from_json`, so /get N sends albums of a single layout.
+    `upload_photos_and_store_file_ids` stores them as well, this is for photos uploaded before it did.
+    Only image headers are read. Orientations stored by previous runs are kept
+    :return: dict: photo basename -> "vertical" or "horizontal"
+    """
+    return _update_photo_orientations(orientations_fp, {
+        os.path.basename(fp): read_photo_orientation(fp)
+        for photos_dp in photos_dp_list for fp in get_photos_fps_from_dp(photos_dp)})
+
+
 def get_photos_fps_from_dp(photos_dp):
     photos_fps = [os.path.join(photos_dp, x) for x in os.listdir(photos_dp)
-                  if os.path.splitext(x)[-1].lower() in ['.png', '.jpg', '.jpeg']]
+                  if os.path.splitext(x)[-1].lower() in ['.png', '.jpg', '.jpeg', '.webp']]
     return photos_fps
 
 
@@ -79,6 +253,149 @@ def crop_and_save_photo_dir(photos_dp, left, up, width, height):
         cropped.save(cropped_fp)
 
 
+# Telegram scales photos down to 1280 px on the longer side anyway
+TELEGRAM_PHOTO_MAX_SIDE = 1280
+
+
+def _preprocess_photo(task):
+    """
+    Crop, downscale and re-encode a single photo. Runs in a worker process
+    :return: (input fp, output fp, input size in bytes, output size in bytes)
+    """
+    fp, out_fp, crop_box, max_side, fmt, quality = task
+    with Image.open(fp) as img:
+        if img.format == 'JPEG' and crop_box is None:
+            # let JPEG decoder skip DCT scales we would throw away during the downscale.
+            # crop boxes are given in full resolution pixels, so drafting is possible only without cropping
+            img.draft('RGB', (max_side, max_side))
+        img = img.convert('RGB')
+        if crop_box is not None:
+            left, up, width, height = crop_box
+            img = img.crop((left, up, left + width, up + height))
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        tmp_fp = f'{out_fp}.tmp'
+        img.save(tmp_fp, format=fmt, quality=quality, optimize=True)
+    os.replace(tmp_fp, out_fp)
+    return fp, out_fp, os.path.getsize(fp), os.path.getsize(out_fp)
+
+
+def preprocess_photo_dir(photos_dp, out_dp, crop_vertical=None, crop_horizontal=None,
+                         max_side=TELEGRAM_PHOTO_MAX_SIDE, fmt='JPEG', quality=85, n_processes=None):
+    """
+    Sort photos to `vertical` and `horizontal` subdirectories of `out_dp`, crop them,
+    downscale to Telegram limits and re-encode in a single decode pass on a process pool.
+    Orientation is decided from image headers only. Outputs newer than their inputs are skipped.
+    :param crop_vertical: (left, up, width, height) crop box for vertical photos or None
+    :param crop_horizontal: (left, up, width, height) crop box for horizontal photos or None
+    :param fmt: output format supported by PIL, e.g. `JPEG` or `WEBP`
+    """
+    ext = {'JPEG': '.jpg', 'WEBP': '.webp'}.get(fmt.upper(), f'.{fmt.lower()}')
+    for orientation in ('vertical', 'horizontal'):
+        os.makedirs(os.path.join(out_dp, orientation), exist_ok=True)
+
+    tasks = []
+    n_skipped = 0
+    for fp in get_photos_fps_from_dp(photos_dp):
+        # `Image.open` is lazy: it reads the header, pixel data is not decoded
+        with Image.open(fp) as img:
+            width, height = img.size
+        orientation, crop_box = ('vertical', crop_vertical) if height >= width else ('horizontal', crop_horizontal)
+        out_fp = os.path.join(out_dp, orientation, os.path.splitext(os.path.basename(fp))[0] + ext)
+        if os.path.isfile(out_fp) and os.path.getmtime(out_fp) >= os.path.getmtime(fp):
+            n_skipped += 1
+            continue
+        tasks.append((fp, out_fp, crop_box, max_side, fmt, quality))
+    logger.info(f'preprocessing {len(tasks)} photos from {photos_dp}. up to date: {n_skipped}')
+
+    in_bytes = out_bytes = 0
+    start = time.perf_counter()
+    n_processes = n_processes or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        chunksize = max(1, len(tasks) // (8 * n_processes))
+        results = executor.map(_preprocess_photo, tasks, chunksize=chunksize)
+        for _, _, in_size, out_size in tqdm.tqdm(results, total=len(tasks), desc=photos_dp):
+            in_bytes += in_size
+            out_bytes += out_size
+    elapsed = time.perf_counter() - start
+    if tasks:
+        logger.info(f'preprocessed {len(tasks)} photos in {elapsed:.1f} s: {len(tasks) / elapsed:.1f} photos/s. '
+                    f'size: {in_bytes / 2 ** 20:.1f} MB -> {out_bytes / 2 ** 20:.1f} MB')
+    return len(tasks), n_skipped
+
+
+def find_duplicate_photos(photos_dp_list, radius=16, kind='dhash', hash_size=16, n_processes=None, report_fp=None):
+    """
+    Find near-duplicate screenshots, e.g. the same word captured in several batches.
+    Perceptual hashes survive rescaling, recompression and small crops that break sha256 in
+    `upload_photos_and_store_file_ids`. Run it before the upload and review the report
+    :param radius: max number of differing hash bits of duplicates
+    :param kind: "dhash" or "phash", see `photo_dedup.hash_pixels`
+    :param hash_size: hashes have hash_size ** 2 bits. screenshots of different words share the layout:
+    with 64 bit hashes they are only ~10 bits apart, with 256 bit hashes ~75 bits apart
+    :param report_fp: JSON file to store the groups to
+    :return: groups of near-duplicate photo paths. the largest file goes first
+    """
+    photos_fps = [fp for cur_dp in photos_dp_list for fp in get_photos_fps_from_dp(cur_dp)]
+    start = time.perf_counter()
+    photos_fps, hashes = photo_dedup.compute_photo_hashes(photos_fps, kind, hash_size, n_processes)
+    hashed_at = time.perf_counter()
+    i, j, _ = photo_dedup.MultiIndexHash(hashes, radius).pairs()
+    groups = [sorted((photos_fps[ix] for ix in group), key=os.path.getsize, reverse=True)
+              for group in photo_dedup.group_pairs(i, j, len(photos_fps))]
+    logger.info(f'hashed {len(photos_fps)} photos in {hashed_at - start:.1f} s, '
+                f'searched in {time.perf_counter() - hashed_at:.1f} s. '
+                f'near-duplicate groups: {len(groups)}, photos in them: {sum(map(len, groups))}')
+    if report_fp is not None:
+        with open(report_fp, 'w') as fout:
+            json.dump(groups, fout, indent=1)
+    return groups
+
+
+def move_duplicate_photos(groups, duplicates_dp):
+    """
+    Keep the first photo of every group of `find_duplicate_photos` in place and move the others to `duplicates_dp`,
+    so they are not uploaded. Moved files are prefixed with the group number to review them side by side
+    :return: number of moved photos
+    """
+    os.makedirs(duplicates_dp, exist_ok=True)
+    n_moved = 0
+    for group_ix, group in enumerate(groups):
+        for fp in group[1:]:
+            shutil.move(fp, os.path.join(duplicates_dp, f'{group_ix}_{os.path.basename(fp)}'))
+            n_moved += 1
+    logger.info(f'moved {n_moved} duplicate photos to {duplicates_dp}')
+    return n_moved
+
+
+def report_skip_rates(engagement_fps, catalog_fp='photo_catalog.bin', report_fp='skip_rates.json', min_reactions=20):
+    """
+    Skip rate of every word: share of "Змяніць бягучае" among reactions to it.
+    Counters of all shards are summed up. Words users skip most go first: candidates to recapture or remove
+    :param engagement_fps: `EngagementCounters` files, e.g. of every shard
+    :param min_reactions: words with fewer reactions are left out, their rate is noise
+    :return: list of dicts sorted by skip rate
+    """
+    catalog = PhotoCatalog(catalog_fp)
+    totals = sum(EngagementCounters.load(fp, len(catalog)).totals() for fp in engagement_fps)
+    reactions = totals[:, SKIPPED] + totals[:, ACCEPTED]
+    report = [{'word': catalog[ix][0], 'skip_rate': round(int(totals[ix, SKIPPED]) / int(reactions[ix]), 3),
+               'reactions': int(reactions[ix]), 'shown': int(totals[ix, SHOWN])}
+              for ix in range(len(catalog)) if reactions[ix] >= min_reactions and not catalog.is_removed(ix)]
+    catalog.close()
+    report.sort(key=lambda x: (-x['skip_rate'], -x['reactions']))
+    logger.info(f'skip rates of {len(report)} words with {min_reactions}+ reactions. '
+                f'median: {report[len(report) // 2]["skip_rate"] if report else None}')
+    with open(report_fp, 'w') as fout:
+        json.dump(report, fout, ensure_ascii=False, indent=1)
+    return report
+
+
+def build_word_index(catalog_fp='words.jsonl', index_fp='word_index.bin'):
+    start = time.perf_counter()
+    n_words = WordIndex.build(read_catalog(catalog_fp), index_fp)
+    logger.info(f'built index of {n_words} words from {catalog_fp} in {time.perf_counter() - start:.1f} s')
+
+
 def main():
     chat_id = os.environ.get('CONTACT_CHAT_ID')
 
@@ -87,7 +404,15 @@ def main():
     #     '/media/storage/lieksika_bot/screens/cropped/12.31.2019/lo_nav_bar_horizontal_cropped',
     #     '/media/storage/lieksika_bot/screens/cropped/12.31.2019/lo_nav_bar_vertical_cropped'
     # ]
+    # # review near-duplicates, then keep a single photo of every group
+    # groups = find_duplicate_photos(photos_dp_list, report_fp='photo_duplicates.json')
+    # move_duplicate_photos(groups, '/media/storage/lieksika_bot/screens/duplicates')
+    # # stores photo_file_ids.json and photo_orientations.json: commit both
     # upload_photos_and_store_file_ids(dp.bot, chat_id, photos_dp_list)
+    # # orientations of photos uploaded before the upload stored them
+    # store_photo_orientations(photos_dp_list)
+    # # binary catalog loaded by the bot. main.py rebuilds it when the JSON files are newer:
+    # # python photo_catalog.py photo_file_ids.json photo_catalog.bin --orientations photo_orientations.json
 
     # with open('photo_file_ids.json', 'rb') as fin:
     #     photo_file_ids = json.load(fin)
@@ -103,6 +428,18 @@ def main():
     # crop_and_save_photo_dir(f'{root_photos_dp}/lo_nav_bar_horizontal', 116, 72, 2119, 930)
     # crop_and_save_photo_dir(f'{root_photos_dp}/lo_nav_bar_vertical', 0, 117, 1065, 2118)
 
+    # # build word catalog from saved skarnik / slounik pages: python page_ingest.py saved_pages.tar.gz
+
+    # # words users skip most. engagement files of all shards are summed up
+    # report_skip_rates(['engagement.bin'], 'photo_catalog.bin', 'skip_rates.json')
+
+    # # build search index for /find
+    # build_word_index('words.jsonl', 'word_index.bin')
+
+    # # sort, crop and recompress photos in a single pass
+    # preprocess_photo_dir('/media/storage/lieksika_bot/screens/new', '/media/storage/lieksika_bot/screens/prepared',
+    #                      crop_vertical=(0, 117, 1065, 2019), crop_horizontal=(116, 72, 2119, 930))
+
 
 if __name__ == '__main__':
     main()
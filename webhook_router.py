@@ -0,0 +1,230 @@
+import bisect
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# update fields holding the user, in the order they are looked up
+UPDATE_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                 'channel_post', 'edited_channel_post', 'shipping_query', 'pre_checkout_query', 'poll_answer')
+
+
+def stable_hash(key):
+    # `hash()` of str is salted per process: the router and its restarts must agree on placement
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+def update_chat_key(update):
+    """
+    :param update: update as a dict
+    :return: id of the user the update comes from, i.e. `effective_user.id` the bot keys its state by.
+    id of the chat for channel posts, 0 if the update has neither
+    """
+    for field in UPDATE_FIELDS:
+        obj = update.get(field)
+        if obj is not None:
+            user = obj.get('from') or obj.get('user') or obj.get('chat') or {}
+            return user.get('id', 0)
+    return 0
+
+
+class HashRing:
+    """
+    Consistent hashing of chats onto workers. Every worker owns `n_vnodes` points on the ring,
+    so adding a worker only moves the chats that fall on its points: ~1/n of all chats
+    """
+
+    def __init__(self, nodes=(), n_vnodes=128):
+        self.n_vnodes = n_vnodes
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        for ix in range(self.n_vnodes):
+            point = stable_hash(f'{node}#{ix}')
+            pos = bisect.bisect(self._points, point)
+            self._points.insert(pos, point)
+            self._nodes.insert(pos, node)
+
+    def remove(self, node):
+        keep = [ix for ix, x in enumerate(self._nodes) if x != node]
+        self._points = [self._points[ix] for ix in keep]
+        self._nodes = [self._nodes[ix] for ix in keep]
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError('no workers in the ring')
+        pos = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._nodes[pos]
+
+
+class WebhookRouter:
+    """
+    Front webhook receiver of the sharded mode: forwards every update to the worker that owns its chat.
+
+    Workers are bots started with `LieksikaBot.set_worker_mode`, local processes or other nodes.
+    Chats are placed on workers by `HashRing`, so all updates of a chat, and with them its conversation
+    state, stay on one worker. Updates are acknowledged to Telegram once queued and forwarded by
+    `n_lanes` sender threads. A chat always goes through the same lane, which keeps its updates in order,
+    also while workers are added or removed: the worker is looked up when the update leaves the lane.
+    """
+
+    def __init__(self, worker_urls, host='0.0.0.0', port=8443, url_path='', n_lanes=32, max_queue=10_000,
+                 timeout=10, max_retries=5):
+        """
+        :param worker_urls: webhook urls of the workers, e.g. "http://127.0.0.1:5001/<token>"
+        :param url_path: path Telegram posts updates to, e.g. the bot token
+        :param max_queue: updates waiting in a lane. Telegram gets 503 and retries later when it is full
+        :param max_retries: attempts to forward an update to an unavailable worker before it is dropped
+        """
+        self.url_path = '/' + url_path.lstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.ring = HashRing(worker_urls)
+        self._ring_lock = threading.Lock()
+
+        self._lanes = [queue.Queue(maxsize=max_queue) for _ in range(n_lanes)]
+        self._threads = []
+
+        self.n_received = 0
+        self.n_rejected = 0
+        self.n_forwarded = 0
+        self.n_dropped = 0
+        self.n_retries = 0
+        self.forwarded_by_worker = {}
+
+        router = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if self.path.split('?')[0] != router.url_path:
+                    status = 404
+                else:
+                    status = 200 if router.route(body) else 503
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}{self.url_path}'
+
+    def start(self):
+        for ix, lane in enumerate(self._lanes):
+            thread = threading.Thread(target=self._forward_loop, args=(lane,), name=f'WebhookRouter-{ix}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='WebhookRouter', daemon=True)
+        self._thread.start()
+        logger.info(f'WebhookRouter. routing updates from {self.url} to {len(self.ring)} workers')
+        return self
+
+    def stop(self):
+        """
+        Stop receiving updates and forward the queued ones
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+        for lane in self._lanes:
+            lane.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def add_worker(self, url):
+        with self._ring_lock:
+            self.ring.add(url)
+        logger.info(f'WebhookRouter. added worker {url}. workers: {len(self.ring)}')
+
+    def remove_worker(self, url):
+        with self._ring_lock:
+            self.ring.remove(url)
+        logger.info(f'WebhookRouter. removed worker {url}. workers: {len(self.ring)}')
+
+    def route(self, body):
+        """
+        Queue the update for its worker. Called by the HTTP server threads
+        :param body: update as received from Telegram, forwarded as is
+        :return: False if the lane is full
+        """
+        try:
+            key = update_chat_key(json.loads(body))
+        except (ValueError, AttributeError) as e:
+            logger.error(f'WebhookRouter. failed to parse an update: {e}')
+            key = 0
+        self.n_received += 1
+        try:
+            self._lanes[stable_hash(key) % len(self._lanes)].put_nowait((key, body))
+            return True
+        except queue.Full:
+            self.n_rejected += 1
+            return False
+
+    def stats(self):
+        return {'workers': len(self.ring), 'received': self.n_received, 'rejected': self.n_rejected,
+                'forwarded': self.n_forwarded, 'dropped': self.n_dropped, 'retries': self.n_retries,
+                'queued': sum(lane.qsize() for lane in self._lanes),
+                'forwarded_by_worker': dict(self.forwarded_by_worker)}
+
+    # -------------- sender threads --------------
+
+    def _forward_loop(self, lane):
+        session = requests.Session()
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            key, body = item
+            self._forward(session, key, body)
+
+    def _forward(self, session, key, body):
+        backoff = 0.1
+        for attempt in range(self.max_retries):
+            with self._ring_lock:
+                url = self.ring.node_for(key)
+            try:
+                r = session.post(url, data=body, headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+                r.raise_for_status()
+                self.n_forwarded += 1
+                self.forwarded_by_worker[url] = self.forwarded_by_worker.get(url, 0) + 1
+                return
+            except requests.RequestException as e:
+                # the worker restarts or is overloaded. later updates of the chat wait in the lane behind this one
+                logger.warning(f'WebhookRouter. failed to forward an update to {url}: {e}. retrying in {backoff} s')
+                self.n_retries += 1
+                time.sleep(backoff)
+                backoff *= 2
+        logger.error(f'WebhookRouter. dropped an update of chat {key} after {self.max_retries} attempts')
+        self.n_dropped += 1
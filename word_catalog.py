@@ -0,0 +1,276 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import unicodedata
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# users often type on russian or latin keyboard layouts, without ў, і and typographic apostrophes
+NORMALIZATION_TABLE = str.maketrans({
+    'ў': 'у',
+    'i': 'і',
+    'и': 'і',
+    '’': "'",
+    'ʼ': "'",
+    '‘': "'",
+    '`': "'",
+    '´': "'",
+})
+STRESS_MARK = '\u0301'
+
+
+def normalize_word(text):
+    text = unicodedata.normalize('NFC', text.strip().lower()).translate(NORMALIZATION_TABLE)
+    if STRESS_MARK in unicodedata.normalize('NFD', text):
+        text = unicodedata.normalize('NFC', unicodedata.normalize('NFD', text).replace(STRESS_MARK, ''))
+    return text
+
+
+def read_catalog(catalog_fp):
+    """
+    Word catalog is a JSON Lines file. Every line is an object with keys:
+    `headword`, `definition` (may be empty) and `file_id` (screenshot of the word, may be null)
+    """
+    with open(catalog_fp, encoding='utf-8') as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_catalog(catalog_fp, entries):
+    tmp_fp = f'{catalog_fp}.tmp'
+    with open(tmp_fp, 'w', encoding='utf-8') as fout:
+        for entry in entries:
+            fout.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(tmp_fp, catalog_fp)
+
+
+def trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def pack_trigram(trigram):
+    a, b, c = (ord(ch) for ch in trigram)
+    return (a << 42) | (b << 21) | c
+
+
+def levenshtein(a, b, max_distance):
+    """
+    :return: edit distance between `a` and `b` or `max_distance + 1` if it is larger than `max_distance`
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ch_a in enumerate(a, start=1):
+        current = [i]
+        for j, ch_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ch_a != ch_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class WordIndex:
+    """
+    Memory-mapped search index over the word catalog.
+
+    Entries are sorted by normalized headword, so prefix lookups are binary searches
+    over the mapped file (a sorted string table, which gives trie-like prefix queries without pointer chasing).
+    Typo-tolerant lookups use trigram posting lists to pick candidates and verify them with edit distance.
+    Nothing is parsed at load time: sections are accessed through `memoryview.cast`.
+
+    File layout (little endian):
+        header
+        entry offsets:    uint32[n_entries + 1], offsets into the entries blob
+        entries blob:     `key \\0 headword \\0 file_id \\0 definition` utf-8 records
+        trigram keys:     uint64[n_trigrams], sorted packed trigrams
+        posting offsets:  uint32[n_trigrams + 1], offsets into postings
+        postings:         uint32[], entry ids
+    """
+
+    MAGIC = b'LKWI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIIQQQQQ')  # magic, version, n_entries, n_trigrams, section offsets
+
+    def __init__(self, index_fp):
+        self.index_fp = index_fp
+        self._file = open(index_fp, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = view = memoryview(self._mm)
+        (magic, version, self.n_entries, self.n_trigrams, entry_offsets_at, entries_at, trigrams_at,
+         posting_offsets_at, postings_at) = self.HEADER.unpack_from(self._mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f'"{index_fp}" is not a word index')
+        self._entry_offsets = view[entry_offsets_at:entries_at].cast('I')
+        self._entries_at = entries_at
+        self._trigram_keys = view[trigrams_at:posting_offsets_at].cast('Q')
+        self._posting_offsets = view[posting_offsets_at:postings_at].cast('I')
+        self._postings = view[postings_at:].cast('I')
+
+    def __len__(self):
+        return self.n_entries
+
+    def close(self):
+        for view in (self._entry_offsets, self._trigram_keys, self._posting_offsets, self._postings, self._view):
+            view.release()
+        self._mm.close()
+        self._file.close()
+
+    # -------------- building --------------
+
+    @classmethod
+    def build(cls, entries, index_fp):
+        """
+        Build the index from catalog entries. Entries with the same normalized headword are deduplicated
+        :return: number of indexed entries
+        """
+        records = {}
+        for entry in entries:
+            key = normalize_word(entry['headword'])
+            if key and key not in records:
+                records[key] = entry
+        keys = sorted(records, key=lambda k: k.encode('utf-8'))
+
+        entry_offsets = [0]
+        blob = bytearray()
+        postings = {}
+        for entry_id, key in enumerate(keys):
+            entry = records[key]
+            blob += '\0'.join((key, entry['headword'], entry.get('file_id') or '',
+                               entry.get('definition') or '')).encode('utf-8')
+            entry_offsets.append(len(blob))
+            for trigram in trigrams(key):
+                postings.setdefault(pack_trigram(trigram), []).append(entry_id)
+
+        trigram_keys = sorted(postings)
+        posting_offsets = [0]
+        posting_ids = []
+        for trigram in trigram_keys:
+            posting_ids.extend(postings[trigram])
+            posting_offsets.append(len(posting_ids))
+
+        entry_offsets = struct.pack(f'<{len(entry_offsets)}I', *entry_offsets)
+        # keep uint64 section aligned
+        blob += b'\0' * (-(cls.HEADER.size + len(entry_offsets) + len(blob)) % 8)
+        sections = [
+            entry_offsets,
+            bytes(blob),
+            struct.pack(f'<{len(trigram_keys)}Q', *trigram_keys),
+            struct.pack(f'<{len(posting_offsets)}I', *posting_offsets),
+            struct.pack(f'<{len(posting_ids)}I', *posting_ids),
+        ]
+        offsets = [cls.HEADER.size]
+        for section in sections[:-1]:
+            offsets.append(offsets[-1] + len(section))
+
+        tmp_fp = f'{index_fp}.tmp'
+        with open(tmp_fp, 'wb') as fout:
+            fout.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(keys), len(trigram_keys), *offsets))
+            for section in sections:
+                fout.write(section)
+        os.replace(tmp_fp, index_fp)
+        logger.info(f'WordIndex. indexed {len(keys)} words, {len(trigram_keys)} trigrams into "{index_fp}"')
+        return len(keys)
+
+    # -------------- querying --------------
+
+    def _record(self, entry_id):
+        start = self._entries_at + self._entry_offsets[entry_id]
+        end = self._entries_at + self._entry_offsets[entry_id + 1]
+        return self._mm[start:end]
+
+    def _key(self, entry_id):
+        start = self._entries_at + self._entry_offsets[entry_id]
+        end = self._mm.find(b'\0', start)
+        return self._mm[start:end]
+
+    def entry(self, entry_id):
+        """
+        :return: dict with `headword`, `file_id` and `definition` of the entry
+        """
+        _, headword, file_id, definition = self._record(entry_id).decode('utf-8').split('\0', 3)
+        return {'headword': headword, 'file_id': file_id or None, 'definition': definition}
+
+    def _lower_bound(self, key_bytes):
+        lo, hi = 0, self.n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix(self, query, limit=10):
+        """
+        :return: ids of entries whose normalized headword starts with the normalized query
+        """
+        prefix = normalize_word(query).encode('utf-8')
+        if not prefix:
+            return []
+        entry_id = self._lower_bound(prefix)
+        result = []
+        while entry_id < self.n_entries and len(result) < limit and self._key(entry_id).startswith(prefix):
+            result.append(entry_id)
+            entry_id += 1
+        return result
+
+    def exact(self, query):
+        key = normalize_word(query).encode('utf-8')
+        entry_id = self._lower_bound(key)
+        if entry_id < self.n_entries and self._key(entry_id) == key:
+            return entry_id
+        return None
+
+    def _postings_of(self, trigram):
+        packed = pack_trigram(trigram)
+        lo, hi = 0, self.n_trigrams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._trigram_keys[mid] < packed:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.n_trigrams or self._trigram_keys[lo] != packed:
+            return ()
+        return self._postings[self._posting_offsets[lo]:self._posting_offsets[lo + 1]]
+
+    def fuzzy(self, query, limit=5, max_distance=2, max_candidates=20):
+        """
+        :return: ids of entries within `max_distance` edits from the query, closest first
+        """
+        key = normalize_word(query)
+        if not key:
+            return []
+        postings = sorted((self._postings_of(trigram) for trigram in trigrams(key)), key=len)
+        # words within k edits share at least |trigrams| - 3k trigrams with the query, so every such word
+        # is in one of the |trigrams| - min_shared + 1 shortest posting lists. the longest lists are skipped
+        min_shared = max(1, len(postings) - 3 * max_distance)
+        counts = Counter()
+        for entry_ids in postings[:len(postings) - min_shared + 1]:
+            counts.update(entry_ids)
+        scored = []
+        for entry_id, shared in counts.most_common(max_candidates):
+            distance = levenshtein(key, self._key(entry_id).decode('utf-8'), max_distance)
+            if distance <= max_distance:
+                scored.append((distance, -shared, entry_id))
+        scored.sort()
+        return [entry_id for _, _, entry_id in scored[:limit]]
+
+    def find(self, query, limit=10):
+        """
+        :return: (list of entry dicts, True if matches are exact or prefix ones, False if they are fuzzy)
+        """
+        entry_id = self.exact(query)
+        if entry_id is not None:
+            return [self.entry(entry_id)], True
+        entry_ids = self.prefix(query, limit)
+        if entry_ids:
+            return [self.entry(x) for x in entry_ids], True
+        return [self.entry(x) for x in self.fuzzy(query, limit)], False
@@ -0,0 +1,247 @@
+import logging
+import os
+import struct
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(x):
+    """
+    splitmix64 finalizer. Used as a cheap keyed round function and to derive per-user keys
+    """
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def permutation_key(seed, chat_id, epoch):
+    """
+    :return: key of the permutation of the chat in the epoch
+    """
+    return mix64(seed ^ mix64(chat_id & MASK64) ^ (epoch << 32))
+
+
+class FeistelPermutation:
+    """
+    Seeded bijection on range [0, n).
+    Balanced Feistel network over the smallest even-bit domain >= n with cycle walking
+    to stay inside [0, n). The domain is less than 4 * n, so a lookup takes < 4 walks on average.
+    """
+
+    ROUNDS = 4
+
+    def __init__(self, n):
+        if n <= 0:
+            raise ValueError(f'permutation size must be positive, got {n}')
+        self.n = n
+        bits = max((n - 1).bit_length(), 1)
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def __call__(self, ix, key):
+        n, half_bits, half_mask = self.n, self.half_bits, self.half_mask
+        x = ix
+        while True:
+            left, right = x >> half_bits, x & half_mask
+            for r in range(self.ROUNDS):
+                left, right = right, left ^ (mix64(key ^ (r << 58) ^ right) & half_mask)
+            x = (left << half_bits) | right
+            if x < n:
+                return x
+
+
+class WordSampler:
+    """
+    Hands every chat its own pseudo-random permutation of word indices, so no word repeats
+    until the whole catalog has been shown.
+
+    Permutations are never materialized: for every chat only (position, epoch) is stored and
+    the next index is computed with a Feistel bijection keyed by (seed, chat_id, epoch).
+    When a chat walks through the whole catalog, its epoch is increased and a new permutation starts.
+    A permutation covers the catalog as it was when the epoch started: words added to the catalog later
+    join the next epoch of the chat, so a growing catalog doesn't restart anyone's permutation.
+
+    Per-chat state lives in an open-addressing hash table built on top of `array.array`
+    (8 bytes for chat_id + 4 bytes for position + 4 bytes for epoch + 4 bytes for the size of the epoch per slot),
+    so 1M users take ~40 MB and the whole table is saved/loaded with a few bulk writes.
+    """
+
+    EMPTY = -(1 << 63)
+    MAX_LOAD = 0.7
+    FILE_MAGIC = b'LKWS'
+    FILE_VERSION = 2
+    HEADER = struct.Struct('<4sIQQQQ')  # magic, version, n_words, seed, capacity, size
+
+    def __init__(self, n_words, seed=None, capacity=1024):
+        # catalog size -> permutation. sizes of the epochs chats are in
+        self._permutations = {n_words: FeistelPermutation(n_words)}
+        self.n_words = n_words
+        self.seed = int.from_bytes(os.urandom(8), 'little') if seed is None else seed & MASK64
+        self._lock = threading.Lock()
+        self._init_table(self._round_capacity(capacity))
+
+    @staticmethod
+    def _round_capacity(capacity):
+        return 1 << max(int(capacity) - 1, 7).bit_length()
+
+    def _init_table(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self._keys = array('q', [self.EMPTY]) * capacity
+        self._positions = array('I', [0]) * capacity
+        self._epochs = array('I', [0]) * capacity
+        self._sizes = array('I', [0]) * capacity
+
+    def __len__(self):
+        return self.size
+
+    def _find_slot(self, chat_id):
+        """
+        :return: index of the slot that holds `chat_id` or of the empty slot where it should be inserted
+        """
+        mask = self.capacity - 1
+        keys = self._keys
+        slot = mix64(chat_id & MASK64) & mask
+        while True:
+            key = keys[slot]
+            if key == chat_id or key == self.EMPTY:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        old_keys, old_positions, old_epochs, old_sizes = self._keys, self._positions, self._epochs, self._sizes
+        self._init_table(self.capacity * 2)
+        for old_slot, key in enumerate(old_keys):
+            if key == self.EMPTY:
+                continue
+            slot = self._find_slot(key)
+            self._keys[slot] = key
+            self._positions[slot] = old_positions[old_slot]
+            self._epochs[slot] = old_epochs[old_slot]
+            self._sizes[slot] = old_sizes[old_slot]
+            self.size += 1
+        logger.debug(f'WordSampler. table grown to capacity: {self.capacity}, users: {self.size}')
+
+    def _permutation_key(self, chat_id, epoch):
+        return permutation_key(self.seed, chat_id, epoch)
+
+    def draw(self, chat_id):
+        """
+        :return: index of the next word for the chat
+        """
+        with self._lock:
+            slot = self._find_slot(chat_id)
+            if self._keys[slot] == self.EMPTY:
+                if (self.size + 1) > self.capacity * self.MAX_LOAD:
+                    self._grow()
+                    slot = self._find_slot(chat_id)
+                self._keys[slot] = chat_id
+                self._sizes[slot] = self.n_words
+                self.size += 1
+
+            position = self._positions[slot]
+            epoch = self._epochs[slot]
+            n_words = self._sizes[slot]
+            if position + 1 >= n_words:
+                # the next epoch covers the whole current catalog
+                self._positions[slot] = 0
+                self._epochs[slot] = (epoch + 1) & 0xFFFFFFFF
+                self._sizes[slot] = self.n_words
+            else:
+                self._positions[slot] = position + 1
+            permutation = self._permutation(n_words)
+
+        return permutation(position, self._permutation_key(chat_id, epoch))
+
+    def _permutation(self, n_words):
+        permutation = self._permutations.get(n_words)
+        if permutation is None:
+            permutation = self._permutations[n_words] = FeistelPermutation(n_words)
+        return permutation
+
+    def _restart_permutations(self):
+        for slot in range(self.capacity):
+            self._positions[slot] = 0
+            self._epochs[slot] = (self._epochs[slot] + 1) & 0xFFFFFFFF
+        self._sizes = array('I', [self.n_words]) * self.capacity
+        self._permutations = {self.n_words: self._permutation(self.n_words)}
+
+    def resize(self, n_words):
+        """
+        Switch to a catalog of another size, e.g. after it was reloaded.
+        When the catalog grows, users keep their permutations and see the new words from their next epoch.
+        When it shrinks, positions of the current epochs may point out of it, so every user starts a new permutation
+        """
+        with self._lock:
+            if n_words == self.n_words:
+                return
+            previous, self.n_words = self.n_words, n_words
+            if n_words > previous:
+                logger.info(f'WordSampler. catalog grew: {previous} -> {n_words}. new words join the next epochs')
+                self._permutation(n_words)
+                return
+            logger.info(f'WordSampler. catalog shrank: {previous} -> {n_words}. restarting permutations')
+            self._restart_permutations()
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self._keys, self._positions, self._epochs, self._sizes))
+
+    def save(self, fp):
+        """
+        Write the whole state to `fp` in bulk. The file is replaced atomically
+        """
+        tmp_fp = f'{fp}.tmp'
+        with self._lock:
+            with open(tmp_fp, 'wb') as fout:
+                fout.write(self.HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, self.n_words,
+                                            self.seed, self.capacity, self.size))
+                self._keys.tofile(fout)
+                self._positions.tofile(fout)
+                self._epochs.tofile(fout)
+                self._sizes.tofile(fout)
+        os.replace(tmp_fp, fp)
+        logger.info(f'WordSampler. saved state of {self.size} users to "{fp}"')
+
+    @classmethod
+    def load(cls, fp, n_words):
+        """
+        Load state saved with `save`. Version 1 files have no sizes of the epochs: every epoch covers
+        the whole catalog of the file. If the catalog has grown since, users keep their permutations as in `resize`.
+        If it has shrunk, stored positions do not describe valid permutations anymore,
+        so every user starts a new permutation of the new catalog.
+        """
+        with open(fp, 'rb') as fin:
+            magic, version, stored_n_words, seed, capacity, size = cls.HEADER.unpack(fin.read(cls.HEADER.size))
+            if magic != cls.FILE_MAGIC or version not in (1, cls.FILE_VERSION):
+                raise ValueError(f'"{fp}" is not a WordSampler state file')
+            sampler = cls(stored_n_words, seed=seed)
+            sampler._keys, sampler._positions, sampler._epochs = array('q'), array('I'), array('I')
+            sampler._keys.fromfile(fin, capacity)
+            sampler._positions.fromfile(fin, capacity)
+            sampler._epochs.fromfile(fin, capacity)
+            if version == 1:
+                sampler._sizes = array('I', [stored_n_words]) * capacity
+            else:
+                sampler._sizes = array('I')
+                sampler._sizes.fromfile(fin, capacity)
+            sampler.capacity = capacity
+            sampler.size = size
+
+        sampler.resize(n_words)
+
+        logger.info(f'WordSampler. loaded state of {size} users from "{fp}"')
+        return sampler
+
+    @classmethod
+    def load_or_create(cls, fp, n_words):
+        if fp is not None and os.path.isfile(fp):
+            try:
+                return cls.load(fp, n_words)
+            except (OSError, ValueError, EOFError, struct.error) as e:
+                logger.error(f'WordSampler. failed to load state from "{fp}": {e}')
+        return cls(n_words)